@@ -0,0 +1,291 @@
+"""
+Job boards hosted by an ATS (Greenhouse, Lever, Ashby, ...) have public JSON / XML
+endpoints with the open positions. For links to those boards we get the titles with one
+HTTP request, instead of rendering the board and asking GPT for them.
+
+The test responses in fixtures/ats are trimmed copies of the public endpoints.
+"""
+
+import asyncio
+import json
+import re
+import xml.etree.ElementTree as ET
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+
+import httpx
+import pytest
+
+from .core import CRAWL_SCHEDULER, SCRAPE_FLIGHTS
+from .fetch import get_http_client
+
+pytest_plugins = ("pytest_asyncio",)
+
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures" / "ats"
+
+# Paginated endpoints: jobs per page, and pages we follow at most
+ATS_PAGE_SIZE = 100
+ATS_MAX_PAGES = 20
+
+
+@dataclass(frozen=True)
+class AtsAdapter:
+    name: str
+    # Board URLs, the first group that matched is the board token
+    pattern: re.Pattern
+    endpoint: Callable[[re.Match], str]
+    # Response body -> job titles
+    parse: Callable[[str], list[str]]
+    # (URL, response body) of a page -> URL of the next one, None after the last
+    next_page: Callable[[str, str], str | None] | None = None
+
+
+def _token(match: re.Match) -> str:
+    return next(group for group in match.groups() if group)
+
+
+def _json_titles(key: str | None, field: str, listed: str | None = None):
+    def parse(body: str) -> list[str]:
+        data = json.loads(body)
+        jobs = data if key is None else data[key]
+        return [
+            job[field].strip()
+            for job in jobs
+            if job.get(field) and (listed is None or job.get(listed, True))
+        ]
+
+    return parse
+
+
+def _offset_next_page(url: str, body: str) -> str | None:
+    data = json.loads(body)
+    offset = data["offset"] + len(data["content"])
+    if not data["content"] or offset >= data["totalFound"]:
+        return None
+    return re.sub(r"\boffset=\d+", f"offset={offset}", url)
+
+
+def _greenhouse_endpoint(match: re.Match) -> str:
+    # EU boards have their own API host
+    region = ".eu" if match.group(1) else ""
+    token = match.group(2) or match.group(3)
+    return f"https://boards-api{region}.greenhouse.io/v1/boards/{token}/jobs"
+
+
+def _personio_titles(body: str) -> list[str]:
+    root = ET.fromstring(body.encode())
+    return [
+        name.text.strip()
+        for name in root.iterfind("position/name")
+        if name.text and name.text.strip()
+    ]
+
+
+ATS_ADAPTERS = [
+    AtsAdapter(
+        "greenhouse",
+        re.compile(
+            r"^https?://(?:boards|job-boards)(\.eu)?\.greenhouse\.io/"
+            # embed/job_board, embed/job_app, ...: the board is in for=
+            r"(?:embed/[\w/]*\?(?:.*&)?for=([\w-]+)|(?!embed\b)([\w-]+))",
+            re.IGNORECASE,
+        ),
+        _greenhouse_endpoint,
+        _json_titles("jobs", "title"),
+    ),
+    AtsAdapter(
+        "lever",
+        re.compile(r"^https?://jobs\.(eu\.)?lever\.co/([\w.-]+)", re.IGNORECASE),
+        lambda m: f"https://api.{m.group(1) or ''}lever.co/v0/postings/{m.group(2)}"
+        "?mode=json",
+        _json_titles(None, "text"),
+    ),
+    AtsAdapter(
+        "ashby",
+        re.compile(r"^https?://jobs\.ashbyhq\.com/([\w.%-]+)", re.IGNORECASE),
+        lambda m: f"https://api.ashbyhq.com/posting-api/job-board/{_token(m)}",
+        _json_titles("jobs", "title", listed="isListed"),
+    ),
+    AtsAdapter(
+        "workable",
+        re.compile(
+            r"^https?://(?:apply\.workable\.com/(?!api/|embed/|j/)([\w-]+)"
+            r"|(?!www\.|apply\.)([\w-]+)\.workable\.com)",
+            re.IGNORECASE,
+        ),
+        lambda m: f"https://apply.workable.com/api/v1/widget/accounts/{_token(m)}",
+        _json_titles("jobs", "title"),
+    ),
+    AtsAdapter(
+        "recruitee",
+        re.compile(r"^https?://(?!www\.)([\w-]+)\.recruitee\.com", re.IGNORECASE),
+        lambda m: f"https://{_token(m)}.recruitee.com/api/offers/",
+        _json_titles("offers", "title"),
+    ),
+    AtsAdapter(
+        "personio",
+        re.compile(r"^https?://([\w-]+)\.jobs\.personio\.(de|com)", re.IGNORECASE),
+        lambda m: f"https://{m.group(1)}.jobs.personio.{m.group(2)}/xml",
+        _personio_titles,
+    ),
+    AtsAdapter(
+        "smartrecruiters",
+        re.compile(
+            r"^https?://(?:jobs|careers)\.smartrecruiters\.com/([\w-]+)", re.IGNORECASE
+        ),
+        lambda m: f"https://api.smartrecruiters.com/v1/companies/{_token(m)}/postings"
+        f"?limit={ATS_PAGE_SIZE}&offset=0",
+        _json_titles("content", "name"),
+        _offset_next_page,
+    ),
+]
+
+ats_stats = Counter()
+
+
+def find_adapter(url: str) -> tuple[AtsAdapter, str] | None:
+    """
+    The adapter for a board URL, with the endpoint that lists its jobs.
+    """
+    for adapter in ATS_ADAPTERS:
+        if match := adapter.pattern.match(url.strip()):
+            return adapter, adapter.endpoint(match)
+    return None
+
+
+def test_find_adapter():
+    def endpoint(url):
+        return find_adapter(url)[1]
+
+    assert endpoint("https://boards.greenhouse.io/acme/jobs/4012345") == (
+        "https://boards-api.greenhouse.io/v1/boards/acme/jobs"
+    )
+    assert endpoint("https://boards.greenhouse.io/embed/job_board?for=acme") == (
+        "https://boards-api.greenhouse.io/v1/boards/acme/jobs"
+    )
+    assert endpoint("https://boards.greenhouse.io/embed/job_app?for=acme") == (
+        "https://boards-api.greenhouse.io/v1/boards/acme/jobs"
+    )
+    assert (
+        find_adapter("https://boards.greenhouse.io/embed/job_app?token=4012345") is None
+    )
+    assert endpoint("https://job-boards.eu.greenhouse.io/acme") == (
+        "https://boards-api.eu.greenhouse.io/v1/boards/acme/jobs"
+    )
+    assert endpoint("https://jobs.eu.lever.co/acme") == (
+        "https://api.eu.lever.co/v0/postings/acme?mode=json"
+    )
+    assert endpoint("https://acme.workable.com/") == (
+        "https://apply.workable.com/api/v1/widget/accounts/acme"
+    )
+    assert endpoint("https://acme.jobs.personio.com/?language=en") == (
+        "https://acme.jobs.personio.com/xml"
+    )
+    assert find_adapter("https://www.workable.com/pricing") is None
+    assert find_adapter("https://apply.workable.com/j/6A1B2C3D4E") is None
+    assert find_adapter("https://acme.com/careers") is None
+
+
+async def ats_titles(url: str) -> list[str] | None:
+    """
+    Job titles of the board at `url`, or None if it isn't a known ATS board (or its
+    endpoint didn't give a usable answer), then the page has to be scraped as usual.
+    """
+    found = find_adapter(url)
+    if found is None:
+        return None
+    adapter, endpoint = found
+
+    titles = []
+    page = endpoint
+    try:
+        for _ in range(ATS_MAX_PAGES):
+            response = await SCRAPE_FLIGHTS.do(
+                ("ats", page), lambda page=page: _get(page)
+            )
+            response.raise_for_status()
+            titles += adapter.parse(response.text)
+            if adapter.next_page is None:
+                break
+            page = adapter.next_page(page, response.text)
+            if page is None:
+                break
+    except (httpx.HTTPError, ValueError, KeyError, TypeError, ET.ParseError) as e:
+        print(f"{adapter.name} endpoint failed for {url}: {e!r}")
+        ats_stats[f"{adapter.name} failed"] += 1
+        return None
+
+    ats_stats[adapter.name] += 1
+    return titles
+
+
+async def _get(endpoint: str) -> httpx.Response:
+    async with CRAWL_SCHEDULER.slot(endpoint):
+        return await get_http_client().get(
+            endpoint, headers={"Accept": "application/json, application/xml"}
+        )
+
+
+FIXTURES = {
+    "https://boards-api.greenhouse.io/v1/boards/acme/jobs": "greenhouse.json",
+    "https://api.lever.co/v0/postings/acme?mode=json": "lever.json",
+    "https://api.ashbyhq.com/posting-api/job-board/acme": "ashby.json",
+    "https://apply.workable.com/api/v1/widget/accounts/acme": "workable.json",
+    "https://acme.recruitee.com/api/offers/": "recruitee.json",
+    "https://acme.jobs.personio.de/xml": "personio.xml",
+    "https://api.smartrecruiters.com/v1/companies/acme/postings?limit=100&offset=0": (
+        "smartrecruiters.json"
+    ),
+    "https://api.smartrecruiters.com/v1/companies/acme/postings?limit=100&offset=1": (
+        "smartrecruiters_2.json"
+    ),
+}
+
+
+def _fixture_client() -> httpx.AsyncClient:
+    def handler(request):
+        name = FIXTURES.get(str(request.url))
+        if name is None:
+            return httpx.Response(404, json={"error": "not found"})
+        return httpx.Response(200, text=(FIXTURES_DIR / name).read_text())
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+@pytest.mark.asyncio
+async def test_ats_titles(monkeypatch):
+    monkeypatch.setattr("jobsfinder.fetch._client", _fixture_client())
+    monkeypatch.setattr("jobsfinder.fetch._client_loop", asyncio.get_running_loop())
+
+    assert await ats_titles("https://boards.greenhouse.io/acme") == [
+        "Account Executive, Mid-Market",
+        "Senior Backend Engineer",
+    ]
+    assert await ats_titles("https://jobs.lever.co/acme/5f1c1c1e") == [
+        "Sales Development Representative",
+        "Growth Marketing Manager",
+    ]
+    # unlisted postings are left out
+    assert await ats_titles("https://jobs.ashbyhq.com/acme") == [
+        "Founding Account Executive"
+    ]
+    assert await ats_titles("https://apply.workable.com/acme/") == [
+        "Customer Success Manager"
+    ]
+    assert await ats_titles("https://acme.recruitee.com") == ["Head of Sales"]
+    assert await ats_titles("https://acme.jobs.personio.de") == [
+        "Key Account Manager (m/w/d)",
+        "Werkstudent Softwareentwicklung (m/w/d)",
+    ]
+    # all the pages
+    assert await ats_titles("https://jobs.smartrecruiters.com/acme") == [
+        "Business Development Representative",
+        "Sales Operations Analyst",
+    ]
+
+    # unknown boards and failing endpoints go the usual way
+    assert await ats_titles("https://acme.com/careers") is None
+    assert await ats_titles("https://boards.greenhouse.io/gone") is None
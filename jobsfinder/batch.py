@@ -0,0 +1,485 @@
+"""
+Offline mode for the bulk classification stages: instead of thousands of live calls, the
+prompts go into one JSONL file for the Batch API, which runs them within 24h at half the
+price, without using up the rate limits of the live calls.
+
+The batch id is saved next to the file, so a stage that gets interrupted picks the same
+batch up again instead of submitting (and paying for) a new one.
+"""
+
+import asyncio
+import hashlib
+import json
+import time
+from pathlib import Path
+
+import httpx
+import pytest
+from openai import AsyncClient
+from openai.types import CompletionUsage
+from pydantic import BaseModel, ValidationError
+
+from . import core
+from .cache import LlmCache
+from .core import DEFAULT, GPT_MODEL, TEMP_DIR, gpt_messages, log_gpt_call
+from .llm import get_openai_client
+from .usage import UsageLedger, current_stage
+
+pytest_plugins = ("pytest_asyncio",)
+
+
+BATCH_DIR = TEMP_DIR / "batches"
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_POLL_INTERVAL = 60
+# Per batch limit of the API
+BATCH_MAX_REQUESTS = 50_000
+
+DONE_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def _strict(node):
+    """
+    Structured outputs in strict mode want every object closed, with all its properties
+    required (optional fields are nullable instead).
+    """
+    if isinstance(node, dict):
+        # a None default is implied by the nullable type, and not allowed in strict mode
+        node = {
+            key: _strict(value)
+            for key, value in node.items()
+            if not (key == "default" and value is None)
+        }
+        if "properties" in node:
+            node["additionalProperties"] = False
+            node["required"] = list(node["properties"])
+    elif isinstance(node, list):
+        node = [_strict(value) for value in node]
+    return node
+
+
+def response_format(schema: type[BaseModel]) -> dict:
+    """
+    The response_format parse_completion sends for `schema`, for a raw request.
+    """
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": schema.__name__,
+            "schema": _strict(schema.model_json_schema()),
+            "strict": True,
+        },
+    }
+
+
+def test_response_format():
+    class Job(BaseModel):
+        title: str
+        remote: bool | None = None
+
+    class Jobs(BaseModel):
+        jobs: list[Job]
+
+    fmt = response_format(Jobs)
+    schema = fmt["json_schema"]["schema"]
+    assert fmt["json_schema"]["name"] == "Jobs"
+    assert schema["additionalProperties"] is False
+    assert schema["required"] == ["jobs"]
+    assert schema["$defs"]["Job"]["additionalProperties"] is False
+    assert schema["$defs"]["Job"]["required"] == ["title", "remote"]
+    assert "default" not in schema["$defs"]["Job"]["properties"]["remote"]
+
+
+def batch_request(custom_id: str, system_msg, user_msg, schema, temperature=0) -> dict:
+    """
+    One line of the batch file: the same call simple_gpt makes.
+    """
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": {
+            "model": GPT_MODEL,
+            "messages": gpt_messages(system_msg, user_msg),
+            "response_format": response_format(schema),
+            "temperature": temperature,
+        },
+    }
+
+
+def write_batch_file(path: Path, requests: list[dict]):
+    if len(requests) > BATCH_MAX_REQUESTS:
+        raise ValueError(
+            f"{len(requests)} requests, a batch can have at most {BATCH_MAX_REQUESTS}"
+        )
+
+    with open(path, "w") as f:
+        for request in requests:
+            f.write(json.dumps(request) + "\n")
+
+
+def requests_hash(requests: list[dict]) -> str:
+    """
+    Identifies a set of requests, so a saved batch is only resumed for the same prompts.
+    """
+    ordered = sorted(requests, key=lambda request: request["custom_id"])
+    payload = json.dumps(ordered, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+async def submit_batch(path: Path, client: AsyncClient) -> str:
+    with open(path, "rb") as f:
+        batch_file = await client.files.create(file=f, purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window="24h",
+        metadata={"name": path.stem},
+    )
+    return batch.id
+
+
+async def wait_for_batch(batch_id: str, client: AsyncClient, poll_interval):
+    start = time.monotonic()
+    while True:
+        batch = await client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        print(
+            f"Batch {batch_id}: {batch.status}"
+            + (f" ({counts.completed}/{counts.total} done)" if counts else "")
+            + f" after {time.monotonic() - start:.0f}s"
+        )
+        if batch.status in DONE_STATUSES:
+            return batch
+        await asyncio.sleep(poll_interval)
+
+
+def parse_batch_output(text: str, schemas: dict) -> dict[str, tuple]:
+    """
+    :param schemas: {custom_id: schema of its response}
+    :return: {custom_id: (parsed result or None, usage or None)}. Failed requests come
+        back as None, so they can be run again live.
+    """
+    results = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except json.JSONDecodeError as e:
+            # without its custom_id it's reported as missing by run_batch
+            print(f"Unreadable batch output line: {e}")
+            continue
+
+        response = item.get("response") or {}
+        if item.get("error") or response.get("status_code") != 200:
+            print(f"Request {item['custom_id']} failed: {item.get('error')}")
+            results[item["custom_id"]] = (None, None)
+            continue
+
+        body = response["body"]
+        message = body["choices"][0]["message"]
+        parsed = None
+        try:
+            if message.get("content"):
+                parsed = schemas[item["custom_id"]].model_validate_json(
+                    message["content"]
+                )
+        except (ValidationError, json.JSONDecodeError) as e:
+            print(f"Request {item['custom_id']} has an invalid response: {e}")
+            results[item["custom_id"]] = (None, None)
+            continue
+        usage = CompletionUsage(**body["usage"]) if body.get("usage") else None
+        results[item["custom_id"]] = (parsed, usage)
+    return results
+
+
+def test_parse_batch_output():
+    def line(custom_id, content):
+        body = {"choices": [{"message": {"content": content}}]}
+        return json.dumps(
+            {"custom_id": custom_id, "response": {"status_code": 200, "body": body}}
+        )
+
+    text = "\n".join(
+        [
+            line("a", '{"classification": "valid"}'),
+            line("b", '{"classification": '),
+            line("c", '{"label": "valid"}'),
+            '{"custom_id": "d", "resp',
+            line("e", '{"classification": "invalid"}'),
+        ]
+    )
+    schemas = {custom_id: _Verdict for custom_id in "abce"}
+    results = parse_batch_output(text, schemas)
+    assert results["a"] == (_Verdict(classification="valid"), None)
+    assert results["b"] == results["c"] == (None, None)
+    assert "d" not in results
+    assert results["e"][0].classification == "invalid"
+
+
+async def run_batch(
+    name: str,
+    prompts: dict[str, tuple],
+    poll_interval=BATCH_POLL_INTERVAL,
+    cache: LlmCache | None = DEFAULT,
+    batch_dir: Path = BATCH_DIR,
+) -> dict:
+    """
+    Run {row id: (system_msg, user_msg, schema)} prompts through the Batch API.
+
+    Prompts already in the LLM cache aren't sent, and the results go into the cache, so
+    the live path (and reruns) get them for free.
+
+    :param name: Name of the batch (e.g. the stage), used for the files in `batch_dir`.
+    :param cache: Defaults to LLM_CACHE.
+    :return: {row id: parsed result}, None for the requests that failed.
+    """
+    if cache is DEFAULT:
+        cache = core.LLM_CACHE
+
+    results = {}
+    requests = []
+    keys = {}
+    for custom_id, (system_msg, user_msg, schema) in prompts.items():
+        if cache is not None:
+            keys[custom_id] = LlmCache.key(
+                GPT_MODEL, 0, gpt_messages(system_msg, user_msg), schema
+            )
+            cached = await asyncio.to_thread(cache.get, keys[custom_id], schema)
+            if cached is not None:
+                results[custom_id] = cached
+                continue
+        requests.append(batch_request(custom_id, system_msg, user_msg, schema))
+
+    print(f"{len(results)} cached, {len(requests)} to send")
+    if not requests:
+        return results
+
+    schemas = {custom_id: schema for custom_id, (_, _, schema) in prompts.items()}
+    messages = {custom_id: (s, u) for custom_id, (s, u, _) in prompts.items()}
+
+    batch_dir.mkdir(parents=True, exist_ok=True)
+    path = batch_dir / f"{name}.jsonl"
+    state_path = batch_dir / f"{name}.state.json"
+    client = get_openai_client()
+
+    batch_id = None
+    digest = requests_hash(requests)
+    if state_path.exists():
+        state = json.loads(state_path.read_text())
+        # a batch of other prompts (changed data or prompt) isn't ours to resume
+        if state.get("hash") == digest:
+            batch_id = state["batch_id"]
+            print(f"Resuming batch {batch_id}")
+
+    if batch_id is None:
+        write_batch_file(path, requests)
+        batch_id = await submit_batch(path, client)
+        state_path.write_text(
+            json.dumps(
+                {"batch_id": batch_id, "requests": len(requests), "hash": digest}
+            )
+        )
+        print(f"Submitted batch {batch_id} with {len(requests)} requests")
+
+    batch = await wait_for_batch(batch_id, client, poll_interval)
+
+    if batch.output_file_id is not None:
+        output = await client.files.content(batch.output_file_id)
+        for custom_id, (parsed, usage) in parse_batch_output(
+            output.text, schemas
+        ).items():
+            results[custom_id] = parsed
+            if usage is not None:
+                log_gpt_call(
+                    *messages[custom_id],
+                    usage,
+                    caller=schemas[custom_id].__name__,
+                    batch=True,
+                )
+            if parsed is not None and cache is not None:
+                await asyncio.to_thread(cache.put, keys[custom_id], parsed)
+
+    missing = [r["custom_id"] for r in requests if r["custom_id"] not in results]
+    if missing:
+        print(f"Batch {batch_id} ({batch.status}) has no result for {len(missing)}")
+    for custom_id in missing:
+        results[custom_id] = None
+
+    # Done with this batch, the next run of the stage starts a new one
+    state_path.unlink(missing_ok=True)
+    return results
+
+
+class _Verdict(BaseModel):
+    classification: str
+
+
+class _FakeBatchServer:
+    """
+    Stand-in for the files + batches endpoints, answering every request with its own
+    custom_id (and failing the ones that say "fail").
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.batches = {}
+        self.polls = 0
+
+    def _batch(self, batch_id):
+        batch = self.batches[batch_id]
+        return {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": BATCH_ENDPOINT,
+            "input_file_id": batch["input_file_id"],
+            "completion_window": "24h",
+            "status": batch["status"],
+            "output_file_id": batch.get("output_file_id"),
+            "created_at": 0,
+        }
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path.removeprefix("/v1")
+
+        if path == "/files" and request.method == "POST":
+            file_id = f"file-{len(self.files)}"
+            body = request.read().decode()
+            content = body[body.index('{"custom_id"') : body.rindex("}") + 1]
+            self.files[file_id] = content
+            return httpx.Response(
+                200,
+                json={
+                    "id": file_id,
+                    "object": "file",
+                    "bytes": len(content),
+                    "created_at": 0,
+                    "filename": "batch.jsonl",
+                    "purpose": "batch",
+                    "status": "processed",
+                },
+            )
+
+        if path == "/batches" and request.method == "POST":
+            batch_id = f"batch-{len(self.batches)}"
+            input_file_id = json.loads(request.read())["input_file_id"]
+            self.batches[batch_id] = {
+                "input_file_id": input_file_id,
+                "status": "in_progress",
+            }
+            return httpx.Response(200, json=self._batch(batch_id))
+
+        if path.startswith("/batches/"):
+            batch_id = path.split("/")[-1]
+            self.polls += 1
+            batch = self.batches[batch_id]
+            if self.polls > 1 and batch["status"] != "completed":
+                output = []
+                for line in self.files[batch["input_file_id"]].splitlines():
+                    custom_id = json.loads(line)["custom_id"]
+                    answer = {"classification": custom_id}
+                    output.append(
+                        json.dumps(
+                            {
+                                "custom_id": custom_id,
+                                "response": {
+                                    "status_code": 500 if "fail" in custom_id else 200,
+                                    "body": {
+                                        "choices": [
+                                            {"message": {"content": json.dumps(answer)}}
+                                        ],
+                                        "usage": {
+                                            "prompt_tokens": 10,
+                                            "completion_tokens": 5,
+                                            "total_tokens": 15,
+                                        },
+                                    },
+                                },
+                                "error": None,
+                            }
+                        )
+                    )
+                output_file_id = f"file-{len(self.files)}"
+                self.files[output_file_id] = "\n".join(output)
+                batch.update(status="completed", output_file_id=output_file_id)
+            return httpx.Response(200, json=self._batch(batch_id))
+
+        if path.startswith("/files/") and path.endswith("/content"):
+            return httpx.Response(200, text=self.files[path.split("/")[-2]])
+
+        return httpx.Response(404, json={"error": {"message": f"no route {path}"}})
+
+
+@pytest.mark.asyncio
+async def test_run_batch(tmp_path, monkeypatch):
+    server = _FakeBatchServer()
+    monkeypatch.setattr(
+        "jobsfinder.llm._client",
+        AsyncClient(
+            api_key="test",
+            max_retries=0,
+            http_client=httpx.AsyncClient(
+                transport=httpx.MockTransport(server.handler)
+            ),
+        ),
+    )
+    monkeypatch.setattr("jobsfinder.llm._client_loop", asyncio.get_running_loop())
+    ledger = UsageLedger(tmp_path / "usage.sqlite")
+    monkeypatch.setattr("jobsfinder.core.USAGE_LEDGER", ledger)
+
+    cache = LlmCache(tmp_path / "llm.sqlite")
+    cached = ("Classify", "cached page", _Verdict)
+    cache.put(
+        LlmCache.key(GPT_MODEL, 0, gpt_messages(*cached[:2]), _Verdict),
+        _Verdict(classification="from cache"),
+    )
+    prompts = {
+        "0": ("Classify", "page 0", _Verdict),
+        "1": cached,
+        "2-fail": ("Classify", "page 2", _Verdict),
+    }
+
+    results = await run_batch(
+        "test", prompts, poll_interval=0, cache=cache, batch_dir=tmp_path
+    )
+    assert results == {
+        "0": _Verdict(classification="0"),
+        "1": _Verdict(classification="from cache"),
+        "2-fail": None,
+    }
+    # only the uncached prompts were sent, and their results are cached now
+    assert len(server.files["file-0"].splitlines()) == 2
+    assert cache.get(
+        LlmCache.key(GPT_MODEL, 0, gpt_messages("Classify", "page 0"), _Verdict),
+        _Verdict,
+    ) == _Verdict(classification="0")
+    assert not (tmp_path / "test.state.json").exists()
+
+    assert ledger.summary()[current_stage()]["calls"] == 1
+    assert ledger.db.execute("SELECT batch, caller FROM calls").fetchall() == [
+        (1, "_Verdict")
+    ]
+
+    # a saved batch is resumed for the same prompts only, not for any with the same count
+    state_path = tmp_path / "again.state.json"
+    state = {"batch_id": "batch-0", "requests": 1, "hash": "other prompts"}
+    state_path.write_text(json.dumps(state))
+    again = {"3": ("Classify", "page 3", _Verdict)}
+    results = await run_batch(
+        "again", again, poll_interval=0, cache=cache, batch_dir=tmp_path
+    )
+    assert results == {"3": _Verdict(classification="3")}
+    assert len(server.batches) == 2
+
+    requests = [batch_request("0", "Classify", "page 0", _Verdict)]
+    state_path.write_text(
+        json.dumps({"batch_id": "batch-0", "hash": requests_hash(requests)})
+    )
+    results = await run_batch(
+        "again", {"0": prompts["0"]}, poll_interval=0, cache=None, batch_dir=tmp_path
+    )
+    assert results["0"] == _Verdict(classification="0")
+    assert len(server.batches) == 2
+
+    ledger.close()
+    cache.close()
@@ -0,0 +1,710 @@
+"""
+Pool of warm chromium browsers, so we don't pay a full browser launch for every scrape,
+plus a policy for blocking the requests we don't need (images, fonts, trackers), and
+a readiness check that returns as soon as the page has settled.
+"""
+
+import asyncio
+import math
+import os
+import subprocess
+import sys
+import time
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+
+import psutil
+import pytest
+from playwright.async_api import Browser, Playwright
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+from playwright.async_api import async_playwright
+
+from .loops import close_stale
+
+pytest_plugins = ("pytest_asyncio",)
+
+
+POOL_SIZE = 3
+MAX_PAGES_PER_BROWSER = 100
+MAX_BROWSER_RSS_MB = 1024
+
+# html2md throws these away anyway (only alt text is kept)
+BLOCKED_RESOURCE_TYPES = ("image", "media", "font")
+
+# Analytics, ads, session recording and chat widgets. Subdomains are blocked too.
+BLOCKED_DOMAINS = (
+    "google-analytics.com",
+    "googletagmanager.com",
+    "googlesyndication.com",
+    "googleadservices.com",
+    "doubleclick.net",
+    "adservice.google.com",
+    "connect.facebook.net",
+    "facebook.com/tr",
+    "snap.licdn.com",
+    "ads-twitter.com",
+    "analytics.tiktok.com",
+    "bat.bing.com",
+    "clarity.ms",
+    "hotjar.com",
+    "fullstory.com",
+    "mouseflow.com",
+    "cdn.segment.com",
+    "mixpanel.com",
+    "amplitude.com",
+    "heapanalytics.com",
+    "hs-analytics.net",
+    "js-agent.newrelic.com",
+    "browser.sentry-cdn.com",
+    "widget.intercom.io",
+    "js.driftt.com",
+    "client.crisp.chat",
+    "static.zdassets.com",
+)
+
+# Rough average transfer size per resource type, to estimate what blocking saved us.
+# Aborted requests never get a response, so we can't know the real number.
+TYPICAL_BYTES = {
+    "image": 60_000,
+    "media": 500_000,
+    "font": 35_000,
+    "stylesheet": 30_000,
+    "script": 45_000,
+}
+DEFAULT_TYPICAL_BYTES = 5_000
+
+# A page is ready when neither the DOM nor the network did anything for QUIET_MS
+NAVIGATION_TIMEOUT_MS = 20000
+QUIET_MS = 500
+READY_CAP_MS = 5000
+READY_POLL_MS = 100
+
+_OBSERVE_MUTATIONS = """
+() => {
+    if (window.__ugLastMutation !== undefined) return;
+    window.__ugLastMutation = performance.now();
+    new MutationObserver(() => { window.__ugLastMutation = performance.now(); })
+        .observe(document, {subtree: true, childList: true, attributes: true, characterData: true});
+}
+"""
+_SINCE_LAST_MUTATION = "() => performance.now() - window.__ugLastMutation"
+
+
+def _descendant_pids() -> set[int]:
+    try:
+        return {p.pid for p in psutil.Process(os.getpid()).children(recursive=True)}
+    except psutil.Error:
+        return set()
+
+
+def _root_pid(new_pids: set[int]) -> int | None:
+    """
+    Out of the processes that appeared during a launch, find the top level chromium one.
+    It's started by the playwright driver, a direct child of ours. Renderers that the
+    other pooled browsers spawned meanwhile are in `new_pids` too, but their parent is
+    their own chromium.
+    """
+    try:
+        drivers = {p.pid for p in psutil.Process(os.getpid()).children()}
+    except psutil.Error:
+        return None
+
+    for pid in new_pids:
+        try:
+            if psutil.Process(pid).ppid() in drivers:
+                return pid
+        except psutil.Error:
+            continue
+    return None
+
+
+# A fake driver: it already runs another "browser", which spawns a "renderer" at the same
+# time as the driver launches a new "browser" (a sleep)
+_FAKE_DRIVER = """
+import subprocess, sys, time
+other = subprocess.Popen(
+    [sys.executable, "-c", "import subprocess, sys; sys.stdin.readline(); "
+     "subprocess.Popen(['sleep', '30']); sys.stdin.readline()"],
+    stdin=subprocess.PIPE,
+)
+print("ready", flush=True)
+sys.stdin.readline()
+other.stdin.write(b"\\n")
+other.stdin.flush()
+root = subprocess.Popen(["sleep", "30"])
+time.sleep(0.5)
+print(root.pid, flush=True)
+sys.stdin.readline()
+"""
+
+
+def test__root_pid():
+    driver = subprocess.Popen(
+        [sys.executable, "-c", _FAKE_DRIVER],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        assert driver.stdout.readline().strip() == "ready"
+        before = _descendant_pids()
+        driver.stdin.write("\n")
+        driver.stdin.flush()
+        root = int(driver.stdout.readline())
+
+        new_pids = _descendant_pids() - before
+        # the other browser's renderer showed up too
+        assert len(new_pids) == 2
+        assert _root_pid(new_pids) == root
+    finally:
+        for proc in psutil.Process(driver.pid).children(recursive=True):
+            proc.kill()
+        driver.kill()
+
+
+def _tree_rss(pid: int | None) -> int:
+    if pid is None:
+        return 0
+
+    try:
+        root = psutil.Process(pid)
+        procs = [root] + root.children(recursive=True)
+    except psutil.Error:
+        return 0
+
+    total = 0
+    for proc in procs:
+        try:
+            total += proc.memory_info().rss
+        except psutil.Error:
+            continue
+    return total
+
+
+def test__tree_rss():
+    assert _tree_rss(None) == 0
+    assert _tree_rss(os.getpid()) > 0
+
+
+class PooledBrowser:
+    def __init__(self, browser: Browser, pid: int | None):
+        self.browser = browser
+        self.pid = pid
+        self.pages_served = 0
+        self.active = 0
+        self.retiring = False
+
+    def rss(self) -> int:
+        return _tree_rss(self.pid)
+
+
+async def _close_browser(pooled: PooledBrowser):
+    try:
+        await pooled.browser.close()
+    except Exception as e:
+        print(e)
+
+
+class BrowserPool:
+    """
+    Keeps up to `size` browsers alive and hands out a fresh context + page per scrape.
+
+    A browser gets retired after `max_pages` pages, when its process tree goes over
+    `max_rss_mb`, or when it crashed. Retired browsers finish their in-flight pages, then
+    get closed, and a new one is launched on demand.
+    """
+
+    def __init__(
+        self,
+        size=POOL_SIZE,
+        max_pages=MAX_PAGES_PER_BROWSER,
+        max_rss_mb=MAX_BROWSER_RSS_MB,
+        **launch_kwargs,
+    ):
+        if size < 1:
+            raise ValueError("size must be at least 1")
+
+        self.size = size
+        self.max_pages = max_pages
+        self.max_rss = max_rss_mb * 1024 * 1024
+        self.launch_kwargs = launch_kwargs
+
+        self._playwright: Playwright | None = None
+        self._browsers: list[PooledBrowser] = []
+        self._lock = asyncio.Lock()
+        # notified when a launch is done, for the ones waiting for a browser
+        self._changed = asyncio.Condition(self._lock)
+        self._launching = 0
+        self._start_lock = asyncio.Lock()
+
+        self.launched = 0
+        self.recycled = 0
+        self.pages_served = 0
+
+    async def _launch(self) -> PooledBrowser:
+        async with self._start_lock:
+            if self._playwright is None:
+                self._playwright = await async_playwright().start()
+
+        # other browsers can spawn renderers meanwhile, _root_pid filters those out
+        before = _descendant_pids()
+        browser = await self._playwright.chromium.launch(**self.launch_kwargs)
+        pid = _root_pid(_descendant_pids() - before)
+
+        self.launched += 1
+        return PooledBrowser(browser, pid)
+
+    def _prune(self) -> list[PooledBrowser]:
+        """
+        Retires the browsers that disconnected, and takes the idle ones out of the pool
+        (to be closed): nothing would release them.
+        """
+        dead = []
+        for pooled in list(self._browsers):
+            if not pooled.browser.is_connected():
+                pooled.retiring = True
+                if pooled.active == 0:
+                    self._browsers.remove(pooled)
+                    self.recycled += 1
+                    dead.append(pooled)
+        return dead
+
+    def _checkout(self, pooled: PooledBrowser) -> PooledBrowser:
+        pooled.active += 1
+        pooled.pages_served += 1
+        self.pages_served += 1
+
+        if pooled.pages_served >= self.max_pages:
+            pooled.retiring = True
+        return pooled
+
+    async def _acquire(self) -> PooledBrowser:
+        pooled = None
+        dead = []
+        async with self._changed:
+            while True:
+                dead += self._prune()
+                live = [b for b in self._browsers if not b.retiring]
+
+                # Only launch when every warm browser is already busy
+                if len(live) + self._launching < self.size and all(
+                    b.active > 0 for b in live
+                ):
+                    self._launching += 1
+                    break
+                if live:
+                    pooled = self._checkout(min(live, key=lambda b: b.active))
+                    break
+                # every slot is taken by a launch in flight
+                await self._changed.wait()
+
+        for stale in dead:
+            await _close_browser(stale)
+        if pooled is not None:
+            return pooled
+
+        # the slot is reserved, the launch doesn't hold up the others
+        try:
+            pooled = await self._launch()
+        finally:
+            async with self._changed:
+                self._launching -= 1
+                if pooled is not None:
+                    self._browsers.append(pooled)
+                    self._checkout(pooled)
+                self._changed.notify_all()
+        return pooled
+
+    async def _release(self, pooled: PooledBrowser):
+        pooled.active -= 1
+
+        if not pooled.retiring:
+            if not pooled.browser.is_connected() or pooled.rss() > self.max_rss:
+                pooled.retiring = True
+
+        if pooled.retiring and pooled.active == 0 and pooled in self._browsers:
+            self._browsers.remove(pooled)
+            self.recycled += 1
+            await _close_browser(pooled)
+
+    @asynccontextmanager
+    async def page(self, **context_kwargs):
+        """
+        Fresh (isolated) context + page on one of the warm browsers. Closed on exit.
+        """
+        pooled = await self._acquire()
+        context = None
+        try:
+            context = await pooled.browser.new_context(**context_kwargs)
+            yield await context.new_page()
+        finally:
+            if context is not None:
+                try:
+                    await context.close()
+                except Exception as e:
+                    print(e)
+            await self._release(pooled)
+
+    async def close(self):
+        async with self._lock:
+            for pooled in self._browsers:
+                await _close_browser(pooled)
+            self._browsers = []
+
+            if self._playwright is not None:
+                await self._playwright.stop()
+                self._playwright = None
+
+    def stats(self) -> dict:
+        return {
+            "browsers": len(self._browsers),
+            "active_pages": sum(b.active for b in self._browsers),
+            "rss_mb": sum(b.rss() for b in self._browsers) / 1024 / 1024,
+            "launched": self.launched,
+            "recycled": self.recycled,
+            "pages_served": self.pages_served,
+        }
+
+
+class BlockStats:
+    """
+    What a ResourcePolicy blocked on a single page.
+    """
+
+    def __init__(self):
+        self.blocked = Counter()
+        self.est_bytes_saved = 0
+
+    def add(self, resource_type: str, reason: str):
+        self.blocked[reason] += 1
+        self.est_bytes_saved += TYPICAL_BYTES.get(resource_type, DEFAULT_TYPICAL_BYTES)
+
+    def as_dict(self) -> dict:
+        return {
+            "blocked": sum(self.blocked.values()),
+            "by_reason": dict(self.blocked),
+            "est_kb_saved": self.est_bytes_saved / 1024,
+        }
+
+
+class ResourcePolicy:
+    """
+    Aborts requests for resource types and (tracker) domains we don't need for the markdown.
+    """
+
+    def __init__(self, resource_types=BLOCKED_RESOURCE_TYPES, domains=BLOCKED_DOMAINS):
+        self.resource_types = set(resource_types)
+        self.domains = tuple(domains)
+
+        self.scrapes = 0
+        self.totals = BlockStats()
+
+    def should_block(self, resource_type: str, url: str) -> str | None:
+        """
+        Returns the reason for blocking, or None if the request should go through.
+        """
+        if resource_type == "document":
+            return None
+
+        if resource_type in self.resource_types:
+            return resource_type
+
+        parsed = urlparse(url)
+        host = (parsed.hostname or "").lower()
+        host_path = host + parsed.path
+        for domain in self.domains:
+            if "/" in domain:
+                if host_path.startswith(domain) or f".{domain}" in host_path:
+                    return "tracker"
+            elif host == domain or host.endswith(f".{domain}"):
+                return "tracker"
+
+        return None
+
+    async def attach(self, page) -> BlockStats:
+        """
+        Start intercepting the page's requests. Returned stats fill up as the page loads.
+        """
+        stats = BlockStats()
+
+        async def handler(route):
+            request = route.request
+            reason = self.should_block(request.resource_type, request.url)
+            if reason is None:
+                await route.continue_()
+                return
+
+            stats.add(request.resource_type, reason)
+            await route.abort()
+
+        await page.route("**/*", handler)
+        return stats
+
+    def record(self, stats: BlockStats):
+        self.scrapes += 1
+        self.totals.blocked.update(stats.blocked)
+        self.totals.est_bytes_saved += stats.est_bytes_saved
+
+    def summary(self) -> dict:
+        return {
+            "scrapes": self.scrapes,
+            **self.totals.as_dict(),
+            "est_kb_saved_per_scrape": (
+                self.totals.est_bytes_saved / 1024 / self.scrapes if self.scrapes else 0
+            ),
+        }
+
+
+def test_resource_policy():
+    policy = ResourcePolicy()
+    assert policy.should_block("document", "https://www.google-analytics.com/") is None
+    assert policy.should_block("image", "https://acme.com/logo.png") == "image"
+    assert policy.should_block("font", "https://fonts.gstatic.com/x.woff2") == "font"
+    assert (
+        policy.should_block("script", "https://www.googletagmanager.com/gtm.js")
+        == "tracker"
+    )
+    assert policy.should_block("image", "https://www.facebook.com/tr?id=1") == "image"
+    assert policy.should_block("xhr", "https://www.facebook.com/tr?id=1") == "tracker"
+    assert policy.should_block("script", "https://acme.com/app.js") is None
+    assert policy.should_block("script", "https://notdoubleclick.net/app.js") is None
+
+    stats = BlockStats()
+    stats.add("image", "image")
+    stats.add("script", "tracker")
+    policy.record(stats)
+    assert policy.summary()["blocked"] == 2
+    assert policy.summary()["est_kb_saved_per_scrape"] > 0
+
+
+class PageReadiness:
+    """
+    Replaces the fixed load state waits: go to the page, then poll until the DOM stopped
+    changing and no requests are in flight for `quiet_ms`, but never longer than `cap_ms`.
+
+    Keeps the recent time-to-ready values, so we can see p95 and tune the numbers.
+    Navigations that time out count with the time they took, otherwise the slowest pages
+    would be missing from the p95.
+    """
+
+    def __init__(self, quiet_ms=QUIET_MS, cap_ms=READY_CAP_MS, history=1000):
+        self.quiet = quiet_ms / 1000
+        self.cap = cap_ms / 1000
+
+        self.times = deque(maxlen=history)
+        self.pages = 0
+        self.capped = 0
+        self.timeouts = 0
+
+    async def _since_last_mutation(self, page) -> float:
+        try:
+            await page.evaluate(_OBSERVE_MUTATIONS)
+            return await page.evaluate(_SINCE_LAST_MUTATION) / 1000
+        except Exception:
+            # Navigated in the meantime (JS redirect), the new document just started
+            return 0.0
+
+    async def goto(self, page, url) -> float:
+        """
+        Navigate and wait until the page is ready. Returns the time to ready in seconds.
+        """
+        in_flight = set()
+        last_network = time.monotonic()
+
+        def started(request):
+            nonlocal last_network
+            in_flight.add(request)
+            last_network = time.monotonic()
+
+        def finished(request):
+            nonlocal last_network
+            in_flight.discard(request)
+            last_network = time.monotonic()
+
+        page.on("request", started)
+        page.on("requestfinished", finished)
+        page.on("requestfailed", finished)
+
+        start = time.monotonic()
+        try:
+            await page.goto(
+                url, wait_until="domcontentloaded", timeout=NAVIGATION_TIMEOUT_MS
+            )
+        except PlaywrightTimeoutError:
+            self.timeouts += 1
+            self._record(time.monotonic() - start)
+            raise
+
+        # Some pages only load content once you scroll
+        await page.keyboard.press("PageDown")
+
+        while True:
+            now = time.monotonic()
+            if now - start >= self.cap:
+                self.capped += 1
+                break
+
+            network_quiet = not in_flight and now - last_network >= self.quiet
+            if network_quiet and await self._since_last_mutation(page) >= self.quiet:
+                break
+
+            await asyncio.sleep(READY_POLL_MS / 1000)
+
+        elapsed = time.monotonic() - start
+        self._record(elapsed)
+        return elapsed
+
+    def _record(self, elapsed: float):
+        self.pages += 1
+        self.times.append(elapsed)
+
+    def percentile(self, p: float) -> float | None:
+        if not self.times:
+            return None
+        ordered = sorted(self.times)
+        return ordered[min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1)]
+
+    def summary(self) -> dict:
+        return {
+            "pages": self.pages,
+            "capped": self.capped,
+            "timeouts": self.timeouts,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "max": max(self.times, default=None),
+        }
+
+
+def test_page_readiness_percentiles():
+    readiness = PageReadiness()
+    assert readiness.percentile(95) is None
+
+    readiness.times.extend([i / 10 for i in range(1, 21)])
+    assert readiness.percentile(50) == 1.0
+    assert readiness.percentile(95) == 1.9
+    assert readiness.summary()["max"] == 2.0
+
+
+@pytest.mark.asyncio
+async def test_page_readiness_timeouts():
+    class SlowPage:
+        def on(self, event, handler):
+            pass
+
+        async def goto(self, url, wait_until, timeout):
+            await asyncio.sleep(0.05)
+            raise PlaywrightTimeoutError(f"Timeout {timeout}ms exceeded")
+
+    readiness = PageReadiness()
+    with pytest.raises(PlaywrightTimeoutError):
+        await readiness.goto(SlowPage(), "https://slow.com")
+
+    # the timeout is in the p95
+    assert readiness.summary()["timeouts"] == 1
+    assert readiness.summary()["pages"] == 1
+    assert readiness.percentile(95) >= 0.05
+
+
+_pool: BrowserPool | None = None
+_pool_loop = None
+
+
+def get_browser_pool() -> BrowserPool:
+    """
+    Process wide pool. Playwright objects are tied to an event loop, so we start a new
+    pool if we're called from a different loop (e.g. separate asyncio.run calls).
+    """
+    global _pool, _pool_loop
+
+    loop = asyncio.get_running_loop()
+    if _pool is None or _pool_loop is not loop:
+        if _pool is not None:
+            close_stale(_pool.close(), _pool_loop)
+        _pool = BrowserPool()
+        _pool_loop = loop
+    return _pool
+
+
+async def close_browser_pool():
+    global _pool, _pool_loop
+
+    if _pool is not None:
+        await _pool.close()
+    _pool = None
+    _pool_loop = None
+
+
+@pytest.mark.slow
+@pytest.mark.asyncio
+async def test_page_readiness():
+    pool = BrowserPool(size=1)
+    readiness = PageReadiness(quiet_ms=200, cap_ms=3000)
+    try:
+        async with pool.page() as page:
+            elapsed = await readiness.goto(
+                page,
+                "data:text/html,<h1>static</h1><script>setTimeout(() => "
+                "document.body.append('late'), 300)</script>",
+            )
+            assert "late" in await page.content()
+            assert 0.3 <= elapsed < 3
+            assert readiness.capped == 0
+    finally:
+        await pool.close()
+
+
+@pytest.mark.slow
+@pytest.mark.asyncio
+async def test_browser_pool_recycles():
+    pool = BrowserPool(size=1, max_pages=2)
+    try:
+        for _ in range(3):
+            async with pool.page() as page:
+                await page.set_content("<h1>hello</h1>")
+                assert "hello" in await page.content()
+        assert pool.launched == 2
+        assert pool.recycled == 1
+    finally:
+        await pool.close()
+
+
+class _FakeBrowser:
+    def __init__(self):
+        self.connected = True
+        self.closed = False
+
+    def is_connected(self):
+        return self.connected
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.mark.asyncio
+async def test_browser_pool_launches_outside_lock():
+    pool = BrowserPool(size=2)
+    launches = []
+
+    async def fake_launch():
+        launches.append(asyncio.get_running_loop().time())
+        await asyncio.sleep(0.05)
+        pool.launched += 1
+        return PooledBrowser(_FakeBrowser(), None)
+
+    pool._launch = fake_launch
+    # both slots launch at the same time, the third waits for one of them
+    first, second, third = await asyncio.gather(*(pool._acquire() for _ in range(3)))
+    assert pool.launched == 2
+    assert launches[1] - launches[0] < 0.05
+    assert third in (first, second)
+
+    for pooled in (first, second, third):
+        await pool._release(pooled)
+
+    # a browser that disconnected while idle is closed, the other one takes the page
+    first.browser.connected = False
+    pooled = await pool._acquire()
+    assert first.browser.closed and first not in pool._browsers
+    assert pooled is second
+    assert pool.recycled == 1
@@ -0,0 +1,615 @@
+"""
+On-disk caches, so reruns don't scrape the same pages or pay for the same LLM calls again.
+
+Pages are keyed by normalized URL, and point to zlib compressed blobs keyed by the hash of
+their content (lots of sites serve the exact same parked / error pages). LLM results are
+keyed by the hash of everything that goes into the call.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from pydantic import BaseModel
+
+CACHE_TTL = 7 * 24 * 3600
+ERROR_TTL = 3600
+CACHE_MAX_MB = 2048
+LLM_CACHE_MAX_MB = 256
+# Reads note their access time, and write them in one go after this many
+ACCESS_FLUSH_EVERY = 100
+# Count the size from the database again after this many puts
+SIZE_RECOUNT_EVERY = 1000
+
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+# Query params that only track where a visitor came from
+TRACKING_PARAMS = {
+    "fbclid",
+    "gclid",
+    "gh_src",
+    "hsctatracking",
+    "igshid",
+    "lever-source",
+    "mc_cid",
+    "mc_eid",
+    "msclkid",
+    "ref",
+    "ref_src",
+    "_ga",
+    "_gl",
+    "_hsenc",
+    "_hsmi",
+}
+
+
+def normalize_url(url: str) -> str:
+    """
+    Cache key for a URL: lowercase scheme + host, no default port, no fragment, sorted
+    query params.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower() or "https"
+    host = (parts.hostname or "").lower()
+    if parts.port and parts.port != _DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    path = parts.path or "/"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, path, query, ""))
+
+
+def test_normalize_url():
+    assert normalize_url("HTTPS://Acme.COM") == "https://acme.com/"
+    assert normalize_url("https://acme.com:443/jobs#open") == "https://acme.com/jobs"
+    assert (
+        normalize_url("http://acme.com:8080/?b=2&a=1")
+        == "http://acme.com:8080/?a=1&b=2"
+    )
+
+
+def canonical_url(url: str) -> str:
+    """
+    Identity of a page, for loop detection: normalize_url, but http and https, www and
+    bare host, and trailing slashes are the same page, and tracking params are dropped.
+    Only for comparing URLs, the page itself is still fetched from the URL as is.
+    """
+    parts = urlsplit(normalize_url(url))
+    host = parts.netloc.removeprefix("www.")
+    path = parts.path.rstrip("/") or "/"
+    query = urlencode(
+        [
+            (key, value)
+            for key, value in parse_qsl(parts.query, keep_blank_values=True)
+            if key.lower() not in TRACKING_PARAMS and not key.lower().startswith("utm_")
+        ]
+    )
+    return urlunsplit(("https", host, path, query, ""))
+
+
+def test_canonical_url():
+    assert canonical_url("http://www.Acme.com/") == "https://acme.com/"
+    assert canonical_url("https://acme.com") == "https://acme.com/"
+    assert canonical_url("https://acme.com/careers/#jobs") == "https://acme.com/careers"
+    assert (
+        canonical_url("https://acme.com/careers?utm_source=x&gclid=1&team=eng&ref=hn")
+        == "https://acme.com/careers?team=eng"
+    )
+    assert canonical_url("https://acme.com:8443/jobs") == "https://acme.com:8443/jobs"
+    assert canonical_url("https://jobs.acme.com") != canonical_url("https://acme.com")
+
+
+@dataclass
+class CacheEntry:
+    url: str
+    html: str
+    etag: str | None
+    last_modified: str | None
+    source: str
+    fetched_at: float
+    expires_at: float
+
+    @property
+    def fresh(self) -> bool:
+        return time.time() < self.expires_at
+
+
+class _SqliteCache:
+    """
+    Lazily opened connection, in autocommit + WAL mode so several processes can share the
+    file. Async code calls it through asyncio.to_thread, so every method holds `lock`.
+
+    For the LRU eviction, reads only note their access time (written in batches), and the
+    size is a running count: the table is only scanned when that goes over the limit.
+    """
+
+    SCHEMA = ""
+    # Table with the `key` / `accessed_at` columns the eviction goes by
+    TABLE = ""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._db = None
+        self.lock = threading.RLock()
+        self.max_bytes = None
+
+        self._accessed = {}
+        self._size = None
+        self._puts = 0
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None, check_same_thread=False
+            )
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(self.SCHEMA)
+        return self._db
+
+    def close(self):
+        with self.lock:
+            if self._db is not None:
+                self._flush_accessed()
+                self._db.close()
+                self._db = None
+
+    def _touch(self, key: str):
+        self._accessed[key] = time.time()
+        if len(self._accessed) >= ACCESS_FLUSH_EVERY:
+            self._flush_accessed()
+
+    def _flush_accessed(self):
+        if self._accessed:
+            self.db.executemany(
+                f"UPDATE {self.TABLE} SET accessed_at = ? WHERE key = ?",
+                [(at, key) for key, at in self._accessed.items()],
+            )
+            self._accessed = {}
+
+    def _count_size(self) -> int:
+        raise NotImplementedError
+
+    def size(self) -> int:
+        with self.lock:
+            if self._size is None:
+                self._size = self._count_size()
+            return self._size
+
+    def _added(self, nbytes: int):
+        """
+        Count a put, and evict once we're over the limit.
+        """
+        if self._size is not None:
+            self._size += nbytes
+        self._puts += 1
+        # other processes write to the same file, so every so often count again
+        if self._puts % SIZE_RECOUNT_EVERY == 0:
+            self._size = None
+        if self.size() > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        raise NotImplementedError
+
+
+class HtmlCache(_SqliteCache):
+    """
+    SQLite index + compressed blobs. Entries have their own TTL; once stale they can still
+    be revalidated (ETag / Last-Modified) instead of downloaded again. When the blobs go
+    over `max_mb`, the least recently used pages are evicted.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY,
+            html BLOB NOT NULL,
+            size INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS pages (
+            key TEXT PRIMARY KEY,
+            hash TEXT NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            source TEXT NOT NULL,
+            fetched_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            accessed_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS pages_accessed ON pages (accessed_at);
+        CREATE INDEX IF NOT EXISTS pages_hash ON pages (hash);
+    """
+    TABLE = "pages"
+
+    def __init__(self, path: Path, max_mb=CACHE_MAX_MB, ttl=CACHE_TTL):
+        super().__init__(path)
+        self.max_bytes = max_mb * 1024 * 1024
+        self.ttl = ttl
+
+        self.hits = 0
+        self.stale = 0
+        self.misses = 0
+        self.revalidated = 0
+
+    def get(self, url: str) -> CacheEntry | None:
+        """
+        Returns the entry even when it's stale (check `.fresh`), so it can be revalidated.
+        """
+        key = normalize_url(url)
+        with self.lock:
+            row = self.db.execute(
+                """
+                SELECT blobs.html, etag, last_modified, source, fetched_at, expires_at
+                FROM pages JOIN blobs ON pages.hash = blobs.hash
+                WHERE key = ?
+                """,
+                (key,),
+            ).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+            self._touch(key)
+
+        html, etag, last_modified, source, fetched_at, expires_at = row
+        entry = CacheEntry(
+            url=key,
+            html=zlib.decompress(html).decode("utf-8"),
+            etag=etag,
+            last_modified=last_modified,
+            source=source,
+            fetched_at=fetched_at,
+            expires_at=expires_at,
+        )
+        if entry.fresh:
+            self.hits += 1
+        else:
+            self.stale += 1
+        return entry
+
+    def put(
+        self,
+        url: str,
+        html: str,
+        ttl: float | None = None,
+        etag: str | None = None,
+        last_modified: str | None = None,
+        source="http",
+    ):
+        now = time.time()
+        ttl = self.ttl if ttl is None else ttl
+        data = html.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+
+        blob = zlib.compress(data)
+        key = normalize_url(url)
+        with self.lock:
+            added = self.db.execute(
+                "INSERT OR IGNORE INTO blobs (hash, html, size) VALUES (?, ?, ?)",
+                (digest, blob, len(blob)),
+            ).rowcount
+            # A replaced page can leave its old blob behind, that's cleaned up in evict()
+            self.db.execute(
+                """
+                INSERT OR REPLACE INTO pages
+                (key, hash, etag, last_modified, source, fetched_at, expires_at,
+                accessed_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (key, digest, etag, last_modified, source, now, now + ttl, now),
+            )
+            self._accessed.pop(key, None)
+            self._added(len(blob) if added else 0)
+
+    def refresh(self, url: str, ttl: float | None = None):
+        """
+        The server told us (304) that our copy is still good: extend its TTL.
+        """
+        now = time.time()
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            self.db.execute(
+                "UPDATE pages SET expires_at = ?, accessed_at = ? WHERE key = ?",
+                (now + ttl, now, normalize_url(url)),
+            )
+            self.revalidated += 1
+
+    def _delete_orphans(self):
+        self.db.execute(
+            "DELETE FROM blobs WHERE hash NOT IN (SELECT DISTINCT hash FROM pages)"
+        )
+
+    def _count_size(self) -> int:
+        return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def evict(self):
+        """
+        Drop least recently used pages until we're back under the size limit (with some
+        headroom, so we don't evict on every put).
+        """
+        with self.lock:
+            self._flush_accessed()
+            self._delete_orphans()
+
+            while (size := self._count_size()) > self.max_bytes:
+                excess = size - self.max_bytes * 0.9
+                keys = []
+                for key, blob_size in self.db.execute(
+                    """
+                    SELECT key, blobs.size FROM pages
+                    JOIN blobs ON pages.hash = blobs.hash
+                    ORDER BY accessed_at
+                    """
+                ):
+                    keys.append(key)
+                    excess -= blob_size
+                    if excess <= 0:
+                        break
+
+                if not keys:
+                    break
+
+                self.db.executemany(
+                    "DELETE FROM pages WHERE key = ?", [(k,) for k in keys]
+                )
+                self._delete_orphans()
+            self._size = size
+
+    def stats(self) -> dict:
+        with self.lock:
+            pages, blobs = self.db.execute(
+                "SELECT (SELECT COUNT(*) FROM pages), (SELECT COUNT(*) FROM blobs)"
+            ).fetchone()
+        return {
+            "pages": pages,
+            "blobs": blobs,
+            "size_mb": self.size() / 1024 / 1024,
+            "hits": self.hits,
+            "stale": self.stale,
+            "misses": self.misses,
+            "revalidated": self.revalidated,
+        }
+
+
+def test_html_cache(tmp_path):
+    cache = HtmlCache(tmp_path / "cache.sqlite")
+
+    assert cache.get("https://acme.com") is None
+    cache.put("https://acme.com", "<h1>Acme</h1>", etag='"abc"')
+    entry = cache.get("https://ACME.com/#top")
+    assert entry.html == "<h1>Acme</h1>"
+    assert entry.etag == '"abc"'
+    assert entry.fresh
+
+    # Identical content is stored once
+    cache.put("https://parked-1.com", "<h1>Parked</h1>")
+    cache.put("https://parked-2.com", "<h1>Parked</h1>")
+    assert cache.stats()["blobs"] == 2
+
+    cache.put("https://old.com", "<h1>Old</h1>", ttl=-1)
+    assert not cache.get("https://old.com").fresh
+    cache.refresh("https://old.com")
+    assert cache.get("https://old.com").fresh
+
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["stale"] == 1
+    cache.close()
+
+
+def test_html_cache_evicts_lru(tmp_path):
+    cache = HtmlCache(tmp_path / "cache.sqlite", max_mb=0)
+    cache.max_bytes = 2000
+
+    for i in range(20):
+        # random-ish content so it doesn't compress away
+        html = "".join(
+            hashlib.sha256(f"{i}-{j}".encode()).hexdigest() for j in range(10)
+        )
+        cache.put(f"https://site{i}.com", html)
+        cache.get("https://site0.com")
+
+    assert cache.size() <= 2000
+    assert cache.get("https://site0.com") is not None
+    assert cache.get("https://site1.com") is None
+    cache.close()
+
+
+def test_html_cache_size_counter(tmp_path, monkeypatch):
+    cache = HtmlCache(tmp_path / "cache.sqlite")
+    evictions = []
+    monkeypatch.setattr(cache, "evict", lambda: evictions.append(1))
+
+    for i in range(10):
+        cache.put(f"https://site{i}.com", f"<h1>Site {i}</h1>")
+        cache.get("https://site0.com")
+    # the same page again doesn't add to the size
+    cache.put("https://site9.com", "<h1>Site 9</h1>")
+
+    # under the limit, no eviction and no access time written yet
+    assert evictions == []
+    assert cache.size() == cache._count_size()
+    key = normalize_url("https://site0.com")
+    written = cache.db.execute(
+        "SELECT accessed_at FROM pages WHERE key = ?", (key,)
+    ).fetchone()[0]
+    assert written < cache._accessed[key]
+    cache.close()
+
+
+class LlmCache(_SqliteCache):
+    """
+    Parsed structured output results, keyed by a hash of (model, temperature, messages,
+    schema). The schema's JSON schema goes into the key, so changing a field or its
+    description doesn't serve results for the old one. Least recently used results are
+    evicted above `max_mb`.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS results (
+            key TEXT PRIMARY KEY,
+            schema TEXT NOT NULL,
+            result TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            accessed_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed_at);
+    """
+    TABLE = "results"
+
+    def __init__(self, path: Path, max_mb=LLM_CACHE_MAX_MB):
+        super().__init__(path)
+        self.max_bytes = max_mb * 1024 * 1024
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model: str, temperature, messages: list[dict], schema: type[BaseModel]):
+        payload = json.dumps(
+            {
+                "model": model,
+                "temperature": temperature,
+                "messages": messages,
+                "schema": schema.model_json_schema(),
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str, schema: type[BaseModel]) -> BaseModel | None:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT result FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self._touch(key)
+            self.hits += 1
+        return schema.model_validate_json(row[0])
+
+    def put(self, key: str, result: BaseModel):
+        now = time.time()
+        data = result.model_dump_json()
+        with self.lock:
+            old = self.db.execute(
+                "SELECT size FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            self.db.execute(
+                """
+                INSERT OR REPLACE INTO results
+                (key, schema, result, size, created_at, accessed_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (key, type(result).__name__, data, len(data), now, now),
+            )
+            self._accessed.pop(key, None)
+            self._added(len(data) - (old[0] if old else 0))
+
+    def _count_size(self) -> int:
+        return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[
+            0
+        ]
+
+    def evict(self):
+        """
+        Drop least recently used results until we're under the size limit (with the same
+        headroom as the HTML cache).
+        """
+        with self.lock:
+            self._flush_accessed()
+            size = self._count_size()
+            if size > self.max_bytes:
+                excess = size - self.max_bytes * 0.9
+
+                keys = []
+                for key, result_size in self.db.execute(
+                    "SELECT key, size FROM results ORDER BY accessed_at"
+                ):
+                    keys.append(key)
+                    size -= result_size
+                    excess -= result_size
+                    if excess <= 0:
+                        break
+                self.db.executemany(
+                    "DELETE FROM results WHERE key = ?", [(k,) for k in keys]
+                )
+            self._size = size
+
+    def stats(self) -> dict:
+        with self.lock:
+            results = self.db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        return {
+            "results": results,
+            "size_mb": self.size() / 1024 / 1024,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class _Verdict(BaseModel):
+    valid: bool
+    reason: str
+
+
+def test_llm_cache(tmp_path):
+    cache = LlmCache(tmp_path / "llm.sqlite")
+    messages = [
+        {"role": "system", "content": "Is this a company website?"},
+        {"role": "user", "content": "# Acme\nWe make rockets."},
+    ]
+    key = LlmCache.key("gpt-4o-mini", 0, messages, _Verdict)
+
+    assert cache.get(key, _Verdict) is None
+    cache.put(key, _Verdict(valid=True, reason="rockets"))
+    assert cache.get(key, _Verdict) == _Verdict(valid=True, reason="rockets")
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+    # Anything that changes the answer changes the key
+    class Other(BaseModel):
+        valid: bool
+
+    assert key != LlmCache.key("gpt-4o", 0, messages, _Verdict)
+    assert key != LlmCache.key("gpt-4o-mini", 0.5, messages, _Verdict)
+    assert key != LlmCache.key("gpt-4o-mini", 0, messages[1:], _Verdict)
+    assert key != LlmCache.key("gpt-4o-mini", 0, messages, Other)
+    cache.close()
+
+
+def test_llm_cache_evicts_lru(tmp_path):
+    cache = LlmCache(tmp_path / "llm.sqlite", max_mb=0)
+    cache.max_bytes = 1000
+
+    keys = [LlmCache.key("m", 0, [{"content": str(i)}], _Verdict) for i in range(20)]
+    for key in keys:
+        cache.put(key, _Verdict(valid=False, reason="x" * 80))
+        cache.get(keys[0], _Verdict)
+
+    assert cache.size() <= 1000
+    assert cache.get(keys[0], _Verdict) is not None
+    assert cache.get(keys[1], _Verdict) is None
+    cache.close()
+
+
+def test_llm_cache_size_counter(tmp_path, monkeypatch):
+    cache = LlmCache(tmp_path / "llm.sqlite")
+    evictions = []
+    monkeypatch.setattr(cache, "evict", lambda: evictions.append(1))
+
+    keys = [LlmCache.key("m", 0, [{"content": str(i)}], _Verdict) for i in range(10)]
+    for key in keys:
+        cache.put(key, _Verdict(valid=True, reason="short"))
+    # a replaced result only counts its new size
+    cache.put(keys[0], _Verdict(valid=True, reason="a bit longer"))
+
+    assert evictions == []
+    assert cache.size() == cache._count_size()
+    cache.close()
@@ -0,0 +1,206 @@
+"""
+Local classifier cascade: a hashed n-gram + linear (softmax regression) model, trained on
+the labels GPT already gave us in the stage outputs. Pages it's confident about are
+answered locally, the rest still go to gpt-4o-mini.
+
+CPU only, numpy only. scripts/train_cascade.py trains the models, picks the confidence
+threshold for a target accuracy, and reports how many GPT calls that saves.
+"""
+
+import re
+import zlib
+from collections import Counter
+from functools import cache
+from pathlib import Path
+
+import numpy as np
+
+from .core import TEMP_DIR
+
+N_FEATURES = 2**18
+# Only the start of the page, that's where the decision is almost always made
+MAX_CHARS = 20_000
+# Accuracy (against GPT) the confident answers must have on held out pages
+TARGET_ACCURACY = 0.98
+# ...measured on at least this many answered pages, so a threshold isn't picked on the
+# handful of pages the model is most sure about
+MIN_ANSWERED = 100
+
+MODEL_DIR = TEMP_DIR / "cascade"
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+cascade_stats = Counter()
+
+
+def features(text: str, n_features=N_FEATURES) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Hashed word unigrams + bigrams and a page length bucket, L2 normalized.
+
+    :return: (indices, values) of the non zero features.
+    """
+    words = _WORD.findall(text[:MAX_CHARS].lower())
+    grams = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    # short pages are a big hint for the invalid ones
+    grams.append(f"__len_{min(len(text).bit_length(), 20)}")
+
+    counts = Counter(zlib.crc32(g.encode()) % n_features for g in grams)
+    indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+    values = np.log1p(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+    return indices, values / np.linalg.norm(values)
+
+
+def _softmax(scores: np.ndarray) -> np.ndarray:
+    exp = np.exp(scores - scores.max())
+    return exp / exp.sum()
+
+
+class LinearClassifier:
+    """
+    Softmax regression over hashed features, trained with SGD. `threshold` is the
+    probability above which `answer` trusts it.
+    """
+
+    def __init__(self, classes: list[str], n_features=N_FEATURES):
+        self.classes = list(classes)
+        self.n_features = n_features
+        self.weights = np.zeros((n_features, len(classes)), dtype=np.float32)
+        self.bias = np.zeros(len(classes), dtype=np.float32)
+        self.threshold = 1.0
+
+    def predict_proba(self, text: str) -> np.ndarray:
+        indices, values = features(text, self.n_features)
+        return _softmax(values @ self.weights[indices] + self.bias)
+
+    def predict(self, text: str) -> tuple[str, float]:
+        proba = self.predict_proba(text)
+        best = int(proba.argmax())
+        return self.classes[best], float(proba[best])
+
+    def fit(self, texts: list[str], labels: list[str], epochs=8, lr=0.5, seed=0):
+        """
+        Classes are weighted by inverse frequency, otherwise the rare ones (invalid
+        websites) never get confident predictions.
+        """
+        rows = [features(text, self.n_features) for text in texts]
+        targets = np.array([self.classes.index(label) for label in labels])
+        frequency = np.bincount(targets, minlength=len(self.classes))
+        class_weight = len(targets) / (len(self.classes) * np.maximum(frequency, 1))
+
+        rng = np.random.default_rng(seed)
+        for epoch in range(epochs):
+            step = lr / (1 + epoch)
+            for i in rng.permutation(len(rows)):
+                indices, values = rows[i]
+                proba = _softmax(values @ self.weights[indices] + self.bias)
+                proba[targets[i]] -= 1
+                grad = proba * class_weight[targets[i]] * step
+                self.weights[indices] -= np.outer(values, grad)
+                self.bias -= grad
+        return self
+
+    def calibrate(
+        self,
+        texts: list[str],
+        labels: list[str],
+        target=TARGET_ACCURACY,
+        min_answered=MIN_ANSWERED,
+    ):
+        """
+        Set `threshold` to the lowest confidence at which the answered pages are still at
+        least `target` accurate, counting only thresholds that answer `min_answered`
+        pages. If none does, the threshold stays at 1 (everything goes to GPT).
+
+        :return: [(threshold, coverage, accuracy)] for each candidate threshold.
+        """
+        predictions = [self.predict(text) for text in texts]
+        curve = []
+        self.threshold = 1.0
+        for threshold in sorted({p for _, p in predictions}, reverse=True):
+            answered = [
+                (pred, label)
+                for (pred, p), label in zip(predictions, labels)
+                if p >= threshold
+            ]
+            accuracy = sum(pred == label for pred, label in answered) / len(answered)
+            curve.append((threshold, len(answered) / len(labels), accuracy))
+            if accuracy >= target and len(answered) >= min_answered:
+                self.threshold = threshold
+        return curve
+
+    def answer(self, text: str, allowed=None) -> str | None:
+        """
+        The label if the model is confident (and it's one of `allowed`), otherwise None.
+        """
+        label, p = self.predict(text)
+        if p >= self.threshold and (allowed is None or label in allowed):
+            cascade_stats["local"] += 1
+            return label
+        cascade_stats["escalated"] += 1
+        return None
+
+    def save(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez_compressed(
+            path,
+            classes=np.array(self.classes),
+            weights=self.weights,
+            bias=self.bias,
+            threshold=self.threshold,
+        )
+
+    @classmethod
+    def load(cls, path: Path) -> "LinearClassifier":
+        data = np.load(path)
+        model = cls(
+            [str(c) for c in data["classes"]], n_features=data["weights"].shape[0]
+        )
+        model.weights = data["weights"]
+        model.bias = data["bias"]
+        model.threshold = float(data["threshold"])
+        return model
+
+
+@cache
+def load_model(name: str) -> LinearClassifier | None:
+    """
+    The trained model saved as `name`, None if there isn't one (then everything goes
+    to GPT).
+    """
+    path = MODEL_DIR / f"{name}.npz"
+    return LinearClassifier.load(path) if path.exists() else None
+
+
+def test_linear_classifier(tmp_path):
+    rng = np.random.default_rng(1)
+    topics = {
+        "invalid": ["404", "page not found", "domain for sale", "website expired"],
+        "valid": ["our products", "about us", "pricing plans", "customer stories"],
+    }
+    filler = "lorem ipsum dolor sit amet consectetur".split()
+
+    def page(label):
+        words = list(rng.choice(filler, 10)) + [rng.choice(topics[label])]
+        return " ".join(rng.permutation(words))
+
+    labels = ["valid", "invalid"] * 100
+    texts = [page(label) for label in labels]
+    model = LinearClassifier(["invalid", "valid"], n_features=2**12)
+    model.fit(texts[:150], labels[:150])
+
+    # too few held out pages to trust any threshold
+    model.calibrate(texts[150:], labels[150:], target=0.95)
+    assert model.threshold == 1.0
+
+    curve = model.calibrate(texts[150:], labels[150:], target=0.95, min_answered=20)
+    assert curve and model.threshold < 1.0
+    assert model.predict("404 page not found")[0] == "invalid"
+    assert model.answer("pricing plans and customer stories") == "valid"
+    assert model.answer("pricing plans", allowed=["invalid"]) is None
+
+    model.save(tmp_path / "model.npz")
+    loaded = LinearClassifier.load(tmp_path / "model.npz")
+    assert loaded.classes == model.classes
+    assert loaded.threshold == model.threshold
+    text = texts[0]
+    assert np.allclose(loaded.predict_proba(text), model.predict_proba(text))
@@ -3,6 +3,7 @@
 import argparse
 import asyncio
 
+from jobsfinder.core import close_clients
 from jobsfinder.gpts import follow_links, has_sales_roles
 
 
@@ -24,7 +25,7 @@ Best,
 async def async_process(url):
     print("\n\n*********** PROCESSING ***********")
 
-    result = await follow_links(url, url, [])
+    result = await follow_links(url, url, [], speculative=True)
 
     status = result["status"]
 
@@ -45,10 +46,9 @@ async def async_process(url):
         return
 
     if status == "Loop detected":
-        print("Looks like we're running in a loop. Our bad - this is a buggy well fix.")
-        import pdb
-
-        pdb.set_trace()
+        print(
+            "Their job links lead back to pages we've already checked, and we didn't find any jobs there."
+        )
         return
 
     if status == "Job open apply":
@@ -83,6 +83,13 @@ async def async_process(url):
     print(f"Use the following email: \n\n{email}")
 
 
+async def _run(url):
+    try:
+        await async_process(url)
+    finally:
+        await close_clients()
+
+
 def main():
     parser = argparse.ArgumentParser(description="Description of your script")
     parser.add_argument("url", help="Company url")
@@ -91,7 +98,7 @@ def main():
 
     print(f"Let's see if you should reach out to {args.url}")
 
-    asyncio.run(async_process(args.url))
+    asyncio.run(_run(args.url))
 
 
 if __name__ == "__main__":
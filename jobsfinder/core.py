@@ -1,38 +1,94 @@
 import asyncio
-import json
+import multiprocessing as mp
+import os
 import re
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
+import pytest
 import tqdm.asyncio
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
-from markdownify import markdownify
-from openai import AsyncClient
-from playwright.async_api import async_playwright
+from markdownify import MarkdownConverter, markdownify, whitespace_re
+
+from .browser import (
+    PageReadiness,
+    ResourcePolicy,
+    close_browser_pool,
+    get_browser_pool,
+)
+from .cache import ERROR_TTL, HtmlCache, LlmCache, normalize_url
+from .fetch import close_http_client, fetch_http
+from .llm import close_openai_client, parse_completion
+from .scheduler import CrawlScheduler
+from .singleflight import SingleFlight
+from .usage import UsageLedger, UsageRecord, current_stage
 
 PROJECT_DIR = Path(__file__).parent.parent
 DATA_DIR = PROJECT_DIR / "data"
 TEMP_DIR = PROJECT_DIR / ".temp"
-GPT_LOG = PROJECT_DIR / ".gpts.json"
+
+# "auto": plain HTTP first, browser only if needed. "browser": always render.
+SCRAPE_MODE = "auto"
+
+# Default of the arguments that come from one of the settings below: the setting is read
+# at call time, so changing it at runtime (e.g. `core.HTML_CACHE = None`) applies
+DEFAULT = object()
+
+# Requests the browser doesn't need to make. Set to None to load everything.
+RESOURCE_POLICY = ResourcePolicy()
+
+# When a rendered page counts as loaded. READINESS.summary() has the time-to-ready p95.
+READINESS = PageReadiness()
+
+# "html.parser" (the original converter) or "lxml" (faster, walks the tree once). lxml
+# stays opt-in until scripts/bench_html2md.py has been run on full pages: the git friendly
+# data is cut to 100 characters, which says nothing about the output of real pages.
+HTML2MD_ENGINE = "html.parser"
+
+# Processes for html2md_async / html2md_many
+MD_WORKERS = os.cpu_count() or 1
+
+# Scraped pages, shared between reruns. Set to None to always scrape.
+HTML_CACHE = HtmlCache(TEMP_DIR / "html_cache.sqlite")
+
+# Parsed LLM results of deterministic (temperature 0) calls. Set to None to always call.
+LLM_CACHE = LlmCache(TEMP_DIR / "llm_cache.sqlite")
+
+# Per host concurrency / spacing for everything that goes over the network
+CRAWL_SCHEDULER = CrawlScheduler()
+
+# Concurrent identical scrapes / LLM calls wait for the one already in flight
+SCRAPE_FLIGHTS = SingleFlight()
+GPT_FLIGHTS = SingleFlight()
+
+GPT_MODEL = "gpt-4o-mini-2024-07-18"
 
 INPUT_PRICE = 0.150 / 1000000
 OUTPUT_PRICE = 0.075 / 1000000
+# Batch API calls are billed at half the price
+BATCH_DISCOUNT = 0.5
+
+# Tokens / cost / latency of every LLM call. Set prompts_path=None to not keep the prompts.
+USAGE_LEDGER = UsageLedger(
+    TEMP_DIR / "usage.sqlite", prompts_path=TEMP_DIR / "prompts.sqlite"
+)
 
 TEMP_DIR.mkdir(exist_ok=True)
 
 
 load_dotenv(PROJECT_DIR / ".env")
 
+pytest_plugins = ("pytest_asyncio",)
 
-def cost_so_far():
-    with open(GPT_LOG, "r") as f:
-        return sum(
-            [
-                json.loads(line)["cost"]
-                for line in f.readlines()
-                if "cost" in json.loads(line)
-            ]
-        )
+
+def cost_so_far(stage=None, since=None, until=None):
+    """
+    Total cost in $ of the LLM calls, optionally of one stage / in a time window (unix
+    timestamps, rounded to the hour). USAGE_LEDGER.summary() has it per stage.
+    """
+    return USAGE_LEDGER.cost(stage=stage, since=since, until=until)
 
 
 async def limit_parallel(tasks, n=5):
@@ -56,103 +112,431 @@ async def limit_parallel(tasks, n=5):
     return await tqdm.asyncio.tqdm.gather(*wrapped_tasks)
 
 
-async def scrape_url(url):
+async def close_clients():
     """
-    This can be more advanced, but for now, it will do
+    Close the long lived clients (browsers, http and OpenAI connections, html2md
+    processes). Call before the loop ends.
     """
+    await close_browser_pool()
+    await close_http_client()
+    await close_openai_client()
+    close_md_pool()
 
-    try:
-        async with async_playwright() as p:
-            browser = await p.chromium.launch()
-            page = await browser.new_page()
 
-            await page.goto(url)
+async def scrape_url(url, mode=DEFAULT, cache: HtmlCache | None = DEFAULT):
+    """
+    :param mode: Defaults to SCRAPE_MODE.
+    :param cache: Defaults to HTML_CACHE, None to always scrape.
+    """
+    if mode is DEFAULT:
+        mode = SCRAPE_MODE
+    if cache is DEFAULT:
+        cache = HTML_CACHE
+    # the caches are SQLite, keep that off the event loop
+    cached = await asyncio.to_thread(cache.get, url) if cache is not None else None
+    if cached is not None and cached.fresh:
+        return cached.html
+
+    # the cache is part of the key: a caller with another cache (or none) doesn't get
+    # the page from (or put it into) this one
+    return await SCRAPE_FLIGHTS.do(
+        (normalize_url(url), mode, cache),
+        lambda: _scrape_scheduled(url, mode, cache, cached),
+    )
+
+
+async def _scrape_scheduled(url, mode, cache: HtmlCache | None, cached):
+    async with CRAWL_SCHEDULER.slot(url):
+        return await _scrape_uncached(url, mode, cache, cached)
+
+
+async def _scrape_uncached(url, mode, cache: HtmlCache | None, cached):
+    if mode == "auto":
+        # only pages that came from the HTTP tier can be revalidated
+        validators = {}
+        if cached is not None and cached.source == "http":
+            validators = {"etag": cached.etag, "last_modified": cached.last_modified}
+
+        response = await fetch_http(url, **validators)
+        # a 304 without a copy of ours to refresh has no page in it, that's rendered
+        if response is not None and response.status_code == 304:
+            if cache is not None and cached is not None:
+                await asyncio.to_thread(cache.refresh, url)
+                return cached.html
+            response = None
+
+        if response is not None:
+            content = response.text
+            if cache is not None:
+                await asyncio.to_thread(
+                    cache.put,
+                    url,
+                    content,
+                    ttl=ERROR_TTL if response.status_code >= 400 else None,
+                    etag=response.headers.get("etag"),
+                    last_modified=response.headers.get("last-modified"),
+                )
+            return content
+
+    content = await render_url(url)
+    if content is not None and cache is not None:
+        await asyncio.to_thread(cache.put, url, content, source="browser")
+    return content
+
+
+@pytest.mark.asyncio
+async def test_scrape_url_cache_setting(tmp_path, monkeypatch):
+    modes = []
+
+    async def fake_scrape(url, mode, cache, cached):
+        modes.append(mode)
+        return "<p>live</p>"
+
+    monkeypatch.setattr("jobsfinder.core._scrape_uncached", fake_scrape)
+    cache = HtmlCache(tmp_path / "html.sqlite")
+    cache.put("https://acme.com", "<p>cached</p>")
+
+    # the setting is read at call time
+    monkeypatch.setattr("jobsfinder.core.HTML_CACHE", cache)
+    assert await scrape_url("https://acme.com") == "<p>cached</p>"
+    monkeypatch.setattr("jobsfinder.core.HTML_CACHE", None)
+    assert await scrape_url("https://acme.com") == "<p>live</p>"
+    monkeypatch.setattr("jobsfinder.core.SCRAPE_MODE", "browser")
+    await scrape_url("https://acme.com")
+    assert modes == ["auto", "browser"]
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_scrape_url_single_flight(tmp_path, monkeypatch):
+    fetched = []
+
+    async def fake_scrape(url, mode, cache, cached):
+        fetched.append(url)
+        await asyncio.sleep(0.01)
+        return f"<p>{url}</p>"
+
+    monkeypatch.setattr("jobsfinder.core._scrape_uncached", fake_scrape)
+    pages = await asyncio.gather(
+        scrape_url("https://acme.com/jobs", cache=None),
+        scrape_url("https://ACME.com/jobs#open", cache=None),
+        scrape_url("https://acme.com/about", cache=None),
+    )
+    assert pages[0] == pages[1] == "<p>https://acme.com/jobs</p>"
+    assert sorted(fetched) == ["https://acme.com/about", "https://acme.com/jobs"]
+
+    # a caller with a cache doesn't share the scrape of one without
+    fetched.clear()
+    cache = HtmlCache(tmp_path / "html.sqlite")
+    await asyncio.gather(
+        scrape_url("https://acme.com/team", cache=None),
+        scrape_url("https://acme.com/team", cache=cache),
+    )
+    assert fetched == ["https://acme.com/team", "https://acme.com/team"]
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_scrape_url_unexpected_304(monkeypatch):
+    class NotModified:
+        status_code = 304
+
+    async def fake_fetch_http(url, **validators):
+        assert not validators
+        return NotModified()
+
+    async def fake_render(url):
+        return "<p>rendered</p>"
+
+    monkeypatch.setattr("jobsfinder.core.fetch_http", fake_fetch_http)
+    monkeypatch.setattr("jobsfinder.core.render_url", fake_render)
+    # nothing cached to refresh: the page is rendered instead
+    assert await scrape_url("https://acme.com/jobs", cache=None) == "<p>rendered</p>"
+
+
+async def render_url(url, policy: ResourcePolicy | None = DEFAULT):
+    """
+    Renders the page in a fresh context on one of the pooled (warm) browsers.
 
-            await page.wait_for_load_state(timeout=20000)
-            await page.keyboard.press("PageDown")
-            await page.wait_for_load_state(timeout=20000)
+    :param policy: Defaults to RESOURCE_POLICY.
+    """
+    if policy is DEFAULT:
+        policy = RESOURCE_POLICY
 
-            await page.evaluate("() => document.location.href")
-            await page.wait_for_load_state(timeout=20000)
+    try:
+        async with get_browser_pool().page() as page:
+            block_stats = await policy.attach(page) if policy is not None else None
 
+            await READINESS.goto(page, url)
             content = await page.content()
-            await browser.close()
-            return content
+
+        if block_stats is not None:
+            policy.record(block_stats)
+        return content
     except Exception as e:
         print(e)
         return None
 
 
-def _init_openai() -> AsyncClient:
-    return AsyncClient()
-
-
-async def simple_gpt(system_msg, user_msg, schema, temperature=0):
-    client = _init_openai()
-    for i in range(5):
-        try:
-            completion = await client.beta.chat.completions.parse(
-                model="gpt-4o-mini-2024-07-18",
-                messages=[
-                    {"role": "system", "content": system_msg},
-                    {"role": "user", "content": user_msg},
-                ],
-                response_format=schema,
-                temperature=temperature,
-            )
-            with open(GPT_LOG, "a") as f:
-                f.write(
-                    json.dumps(
-                        {
-                            "system_msg": system_msg,
-                            "user_msg": user_msg,
-                            "trial": i,
-                            "cost": completion.usage.completion_tokens * OUTPUT_PRICE
-                            + completion.usage.prompt_tokens * INPUT_PRICE,
-                        }
-                    )
-                    + "\n"
-                )
-
-            return completion.choices[0].message.parsed
-        except Exception as err:
-            print(err)
-            await asyncio.sleep(20)
-    raise ValueError("5 iterations did not succeed!")
+async def simple_gpt(
+    system_msg, user_msg, schema, temperature=0, cache: LlmCache | None = DEFAULT
+):
+    """
+    :param cache: Defaults to LLM_CACHE. Pass None to bypass the cache (calls with
+        temperature > 0 always do).
+    """
+    if cache is DEFAULT:
+        cache = LLM_CACHE
+    if temperature != 0:
+        return await _call_gpt(system_msg, user_msg, schema, temperature, None, None)
+
+    key = LlmCache.key(GPT_MODEL, 0, gpt_messages(system_msg, user_msg), schema)
+    if cache is not None:
+        cached = await asyncio.to_thread(cache.get, key, schema)
+        if cached is not None:
+            return cached
+
+    return await GPT_FLIGHTS.do(
+        key,
+        lambda: _call_gpt(system_msg, user_msg, schema, temperature, key, cache),
+    )
+
+
+async def _call_gpt(system_msg, user_msg, schema, temperature, key, cache):
+    messages = gpt_messages(system_msg, user_msg)
+    start = time.monotonic()
+    completion, attempt = await parse_completion(
+        model=GPT_MODEL,
+        messages=messages,
+        response_format=schema,
+        temperature=temperature,
+    )
+    log_gpt_call(
+        system_msg,
+        user_msg,
+        completion.usage,
+        caller=schema.__name__,
+        latency=time.monotonic() - start,
+        attempt=attempt,
+    )
+
+    parsed = completion.choices[0].message.parsed
+    if cache is not None and parsed is not None:
+        await asyncio.to_thread(cache.put, key, parsed)
+    return parsed
+
+
+def gpt_messages(system_msg, user_msg) -> list[dict]:
+    return [
+        {"role": "system", "content": system_msg},
+        {"role": "user", "content": user_msg},
+    ]
+
+
+def log_gpt_call(
+    system_msg, user_msg, usage, caller, latency=None, attempt=0, batch=False
+):
+    """
+    :param caller: What made the call, simple_gpt uses the name of the schema.
+    """
+    cost = usage.completion_tokens * OUTPUT_PRICE + usage.prompt_tokens * INPUT_PRICE
+    if batch:
+        cost *= BATCH_DISCOUNT
+
+    USAGE_LEDGER.record(
+        UsageRecord(
+            stage=current_stage(),
+            caller=caller,
+            model=GPT_MODEL,
+            prompt_tokens=usage.prompt_tokens,
+            completion_tokens=usage.completion_tokens,
+            cost=cost,
+            latency=latency,
+            attempt=attempt,
+            batch=batch,
+            system_msg=system_msg,
+            user_msg=user_msg,
+        )
+    )
 
 
 def replace_empty_newlines(text):
     return re.sub(r"(\n{4,})", "\n\n\n", text)
 
 
-def html2md(html: str | None):
-    if html is None:
-        return None
+class _FastConverter(MarkdownConverter):
+    """
+    markdownify, but doing the cleaning from the old html2md while converting, so the page
+    is parsed and walked only once: noscript is dropped, and images only keep their alt
+    text. It's still a BeautifulSoup tree, only built with the lxml parser.
+    """
+
+    def convert_noscript(self, el, text, convert_as_inline):
+        return ""
+
+    def convert_img(self, el, text, convert_as_inline):
+        alt = el.attrs.get("alt", None) or ""
+        if (
+            convert_as_inline
+            and el.parent.name not in self.options["keep_inline_images_in"]
+        ):
+            return alt
+        return "![%s]()" % alt
+
+    def process_text(self, el):
+        # Same as markdownify, but with one walk up the tree instead of two per text node
+        parents = {parent.name for parent in el.parents}
+        text = str(el) or ""
+
+        if "pre" not in parents:
+            text = whitespace_re.sub(" ", text)
 
+        if parents.isdisjoint(("pre", "code", "kbd", "samp")):
+            text = self.escape(text)
+
+        if el.parent.name == "li" and (
+            not el.next_sibling or el.next_sibling.name in ["ul", "ol"]
+        ):
+            text = text.rstrip()
+
+        return text
+
+
+_fast_converter = _FastConverter()
+
+
+def _html2md_legacy(html: str):
     soup = BeautifulSoup(html, "html.parser")
 
+    # Noticed this issue in some of the first datapoints.
+    # We can also do more cleaning if necessary, but not need to over-optimize this
+    # before doing a proper markdown-converter comparison
+    for noscript in soup.find_all("noscript"):
+        noscript.decompose()
+
+    # Remove all attributes except for alt tags for images (so we don't have bs64 encoded long strings)
+    for tag in soup.find_all(["img", "video", "svg"]):
+        attributes = {key: value for key, value in tag.attrs.items() if key == "alt"}
+        tag.attrs = attributes
+
+    cleaned_html = str(soup)
+    return markdownify(cleaned_html)
+
+
+def html2md(html: str | None, engine=DEFAULT):
+    """
+    engine="html.parser" is the original converter (parses twice), "lxml" the single pass
+    one, defaults to HTML2MD_ENGINE. scripts/bench_html2md.py compares the two.
+    """
+    if html is None:
+        return None
+    if engine is DEFAULT:
+        engine = HTML2MD_ENGINE
+
     try:
-        # Noticed this issue in some of the first datapoints.
-        # We can also do more cleaning if necessary, but not need to over-optimize this
-        # before doing a proper markdown-converter comparison
-        for noscript in soup.find_all("noscript"):
-            noscript.decompose()
-
-        # Remove all attributes except for alt tags for images (so we don't have bs64 encoded long strings)
-        for tag in soup.find_all(["img", "video", "svg"]):
-            attributes = {
-                key: value for key, value in tag.attrs.items() if key == "alt"
-            }
-            tag.attrs = attributes
-
-        cleaned_html = str(soup)
-        md = markdownify(cleaned_html)
+        if engine == "html.parser":
+            md = _html2md_legacy(html)
+        else:
+            md = _fast_converter.convert_soup(BeautifulSoup(html, "lxml"))
         return replace_empty_newlines(md)
     except Exception as e:
         print(e)
         return None
 
 
+def test_html2md():
+    html = """
+    <html><head><title>Acme</title><noscript><img src="pixel.gif"></noscript></head>
+    <body>
+      <h1>Careers at Acme</h1>
+      <p>We're <b>hiring</b>! See <a href="/jobs">open roles</a>.</p>
+      <img alt="team photo" src="data:image/png;base64,AAAA" title="team">
+      <ul><li>Sales Manager</li><li>Account_Executive</li></ul>
+      <pre>  keep   spacing </pre>
+    </body></html>
+    """
+    fast = html2md(html, engine="lxml")
+    # lxml drops the whitespace around <html>, otherwise the output is the same
+    assert fast.strip() == html2md(html, engine="html.parser").strip()
+    assert "![team photo]()" in fast
+    assert "pixel.gif" not in fast
+    assert "Account\\_Executive" in fast
+    assert html2md(None) is None
+
+
+_md_pool: ProcessPoolExecutor | None = None
+
+
+def _get_md_pool() -> ProcessPoolExecutor:
+    global _md_pool
+
+    if _md_pool is None:
+        # spawn: we don't want to fork a process that has a browser driver and threads
+        _md_pool = ProcessPoolExecutor(
+            max_workers=MD_WORKERS, mp_context=mp.get_context("spawn")
+        )
+    return _md_pool
+
+
+def close_md_pool():
+    global _md_pool
+
+    if _md_pool is not None:
+        _md_pool.shutdown()
+    _md_pool = None
+
+
+async def html2md_async(html: str | None, engine=DEFAULT):
+    """
+    html2md in a worker process, so parsing a big page doesn't block the event loop (other
+    scrapes, SSE streams) while it runs.
+    """
+    if html is None:
+        return None
+    # the workers are spawned, they only see the setting's value at import
+    if engine is DEFAULT:
+        engine = HTML2MD_ENGINE
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_md_pool(), html2md, html, engine)
+
+
+def html2md_many(htmls: list, engine=DEFAULT, chunksize=8) -> list:
+    """
+    Convert a batch of pages in parallel, results in the same order.
+    """
+    if engine is DEFAULT:
+        engine = HTML2MD_ENGINE
+    engines = [engine] * len(htmls)
+    return list(_get_md_pool().map(html2md, htmls, engines, chunksize=chunksize))
+
+
+@pytest.mark.asyncio
+async def test_html2md_in_processes():
+    htmls = [f"<h1>Page {i}</h1><p>Hello <b>world</b></p>" for i in range(5)]
+    try:
+        assert html2md_many(htmls + [None]) == [html2md(h) for h in htmls] + [None]
+        assert await html2md_async(htmls[0]) == html2md(htmls[0])
+        assert await html2md_async(None) is None
+    finally:
+        close_md_pool()
+
+
+@pytest.mark.asyncio
+async def test_html2md_engine_setting(monkeypatch):
+    # the engine is read in this process, when the work is handed out
+    monkeypatch.setattr("jobsfinder.core.html2md", lambda html, engine: engine)
+    pool = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr("jobsfinder.core._get_md_pool", lambda: pool)
+    monkeypatch.setattr("jobsfinder.core.HTML2MD_ENGINE", "lxml")
+    try:
+        assert html2md_many(["<p>a</p>", "<p>b</p>"]) == ["lxml", "lxml"]
+        assert await html2md_async("<p>a</p>") == "lxml"
+        assert await html2md_async("<p>a</p>", engine="html.parser") == "html.parser"
+    finally:
+        pool.shutdown()
+
+
 def limit_string(x: str, n=100) -> str:
     if n < 3:
         raise ValueError("n must be at least 3")
@@ -0,0 +1,296 @@
+"""
+Near-duplicate pages (parked domains, template error pages, shared ATS boards) get the
+classification of the page they're a copy of, instead of an LLM call.
+
+Pages are fingerprinted with a 64 bit SimHash over word shingles. The fingerprint is split
+in 4 bands of 16 bits: two fingerprints within 3 bits of each other always have one band in
+common, so lookups only compare against the pages that share a band.
+"""
+
+import asyncio
+import hashlib
+import json
+import re
+import time
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+import pytest
+from pydantic import BaseModel
+
+from .cache import _SqliteCache
+
+pytest_plugins = ("pytest_asyncio",)
+
+# Words per shingle
+SHINGLE = 3
+BANDS = 4
+BAND_BITS = 64 // BANDS
+# Max Hamming distance between fingerprints that counts as a duplicate (< BANDS)
+NEAR_DUP_DISTANCE = 3
+# Least recently used pages are evicted above this
+NEAR_DUPS_MAX_MB = 64
+
+_WORD = re.compile(r"\w+")
+
+
+def simhash(text: str) -> int:
+    """
+    64 bit SimHash of the word shingles of `text`, weighted by how often they occur.
+    """
+    words = _WORD.findall(text.lower())
+    shingles = Counter(
+        " ".join(words[i : i + SHINGLE])
+        for i in range(max(1, len(words) - SHINGLE + 1))
+    )
+
+    hashes = np.array(
+        [
+            int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "big")
+            for s in shingles
+        ],
+        dtype=np.uint64,
+    )
+    weights = np.array(list(shingles.values()), dtype=np.float64)
+    # bits[i, j] is bit j (most significant first) of the hash of shingle i
+    bits = np.unpackbits(hashes.byteswap().view(np.uint8).reshape(-1, 8), axis=1)
+    votes = weights @ (bits.astype(np.float64) * 2 - 1)
+    return int("".join("1" if v > 0 else "0" for v in votes), 2)
+
+
+def distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def _bands(fingerprint: int) -> list[int]:
+    mask = (1 << BAND_BITS) - 1
+    return [(fingerprint >> (i * BAND_BITS)) & mask for i in range(BANDS)]
+
+
+def _signed(fingerprint: int) -> int:
+    # SQLite integers are signed 64 bit
+    return fingerprint - (1 << 64) if fingerprint >= 1 << 63 else fingerprint
+
+
+def test_simhash():
+    page = "Acme builds rockets. " + " ".join(
+        f"Feature {i} is great." for i in range(50)
+    )
+    assert simhash(page) == simhash(page)
+    assert distance(simhash(page), simhash(page + " Call us today!")) <= 3
+    assert distance(simhash(page), simhash("Totally different page " * 20)) > 10
+    assert 0 <= simhash("") < 1 << 64
+
+
+class NearDupIndex(_SqliteCache):
+    """
+    Fingerprints of classified pages with their (parsed) results, per namespace (the
+    prompt + schema that produced them). Least recently used pages are evicted above
+    `max_mb`, like in the other caches.
+    """
+
+    # (not "pages": files from before there was a size / accessed_at keep that table)
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS fingerprints (
+            key TEXT PRIMARY KEY,
+            namespace TEXT NOT NULL,
+            fingerprint INTEGER NOT NULL,
+            b0 INTEGER NOT NULL,
+            b1 INTEGER NOT NULL,
+            b2 INTEGER NOT NULL,
+            b3 INTEGER NOT NULL,
+            result TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            accessed_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS fingerprints_b0 ON fingerprints (namespace, b0);
+        CREATE INDEX IF NOT EXISTS fingerprints_b1 ON fingerprints (namespace, b1);
+        CREATE INDEX IF NOT EXISTS fingerprints_b2 ON fingerprints (namespace, b2);
+        CREATE INDEX IF NOT EXISTS fingerprints_b3 ON fingerprints (namespace, b3);
+        CREATE INDEX IF NOT EXISTS fingerprints_accessed ON fingerprints (accessed_at);
+    """
+    TABLE = "fingerprints"
+
+    def __init__(
+        self, path: Path, max_distance=NEAR_DUP_DISTANCE, max_mb=NEAR_DUPS_MAX_MB
+    ):
+        if max_distance >= BANDS:
+            raise ValueError(f"max_distance must be below {BANDS}")
+        super().__init__(path)
+        self.max_distance = max_distance
+        self.max_bytes = max_mb * 1024 * 1024
+
+        self.misses = 0
+        # hits per distance, to see what a lower / higher threshold would do
+        self.hits = Counter()
+
+    @staticmethod
+    def namespace(system_msg: str, schema: type[BaseModel]) -> str:
+        payload = json.dumps([system_msg, schema.model_json_schema()], sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+    def get(self, namespace: str, text: str, schema: type[BaseModel]):
+        """
+        The result of the closest already classified page, if it's within max_distance.
+        """
+        fingerprint = simhash(text)
+        with self.lock:
+            rows = self.db.execute(
+                """
+                SELECT key, fingerprint, result FROM fingerprints
+                WHERE namespace = ? AND (b0 = ? OR b1 = ? OR b2 = ? OR b3 = ?)
+                """,
+                (namespace, *_bands(fingerprint)),
+            ).fetchall()
+
+            best = None
+            for key, other, result in rows:
+                d = distance(fingerprint, other % (1 << 64))
+                if d <= self.max_distance and (best is None or d < best[0]):
+                    best = (d, key, result)
+
+            if best is None:
+                self.misses += 1
+                return None
+            self._touch(best[1])
+            self.hits[best[0]] += 1
+        return schema.model_validate_json(best[2])
+
+    def add(self, namespace: str, text: str, result: BaseModel):
+        fingerprint = simhash(text)
+        key = f"{namespace}:{fingerprint:016x}"
+        data = result.model_dump_json()
+        with self.lock:
+            old = self.db.execute(
+                "SELECT size FROM fingerprints WHERE key = ?", (key,)
+            ).fetchone()
+            self.db.execute(
+                "INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    namespace,
+                    _signed(fingerprint),
+                    *_bands(fingerprint),
+                    data,
+                    len(data),
+                    time.time(),
+                ),
+            )
+            self._accessed.pop(key, None)
+            self._added(len(data) - (old[0] if old else 0))
+
+    def _count_size(self) -> int:
+        return self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM fingerprints"
+        ).fetchone()[0]
+
+    def evict(self):
+        """
+        Drop least recently used pages until we're under the size limit (with the same
+        headroom as the caches).
+        """
+        with self.lock:
+            self._flush_accessed()
+            size = self._count_size()
+            if size > self.max_bytes:
+                excess = size - self.max_bytes * 0.9
+
+                keys = []
+                for key, page_size in self.db.execute(
+                    "SELECT key, size FROM fingerprints ORDER BY accessed_at"
+                ):
+                    keys.append(key)
+                    size -= page_size
+                    excess -= page_size
+                    if excess <= 0:
+                        break
+                self.db.executemany(
+                    "DELETE FROM fingerprints WHERE key = ?", [(k,) for k in keys]
+                )
+            self._size = size
+
+    def stats(self) -> dict:
+        hits = sum(self.hits.values())
+        lookups = hits + self.misses
+        with self.lock:
+            pages = self.db.execute("SELECT COUNT(*) FROM fingerprints").fetchone()[0]
+        return {
+            "pages": pages,
+            "lookups": lookups,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "hits_by_distance": dict(sorted(self.hits.items())),
+        }
+
+
+async def dedup_gpt(
+    gpt, system_msg, user_msg, schema, index: NearDupIndex | None, reusable=None
+):
+    """
+    gpt(system_msg, user_msg, schema), unless a near duplicate of `user_msg` was already
+    classified with the same prompt.
+
+    :param reusable: Check on a result before it's handed to another page (e.g. no job
+        titles of someone else's site). Results that fail it aren't stored either.
+    """
+    if index is None or not isinstance(user_msg, str):
+        return await gpt(system_msg, user_msg, schema)
+
+    namespace = NearDupIndex.namespace(system_msg, schema)
+    # SQLite and the SimHash, keep them off the event loop
+    result = await asyncio.to_thread(index.get, namespace, user_msg, schema)
+    if result is not None and reusable is not None and not reusable(result):
+        result = None
+    if result is None:
+        result = await gpt(system_msg, user_msg, schema)
+        if result is not None and (reusable is None or reusable(result)):
+            await asyncio.to_thread(index.add, namespace, user_msg, result)
+    return result
+
+
+class _Verdict(BaseModel):
+    classification: str
+
+
+@pytest.mark.asyncio
+async def test_dedup_gpt(tmp_path):
+    index = NearDupIndex(tmp_path / "dups.sqlite")
+    calls = []
+
+    async def gpt(system_msg, user_msg, schema):
+        calls.append(user_msg)
+        return schema(classification=f"call {len(calls)}")
+
+    parked = "This domain is for sale. " + " ".join(
+        f"Related search {i}: cheap flights, hotels and insurance." for i in range(30)
+    )
+    first = await dedup_gpt(gpt, "Classify", parked, _Verdict, index)
+    clone = await dedup_gpt(gpt, "Classify", parked + " acme.io", _Verdict, index)
+    assert clone == first
+    assert len(calls) == 1
+
+    # other prompts don't share results, and different pages are classified
+    await dedup_gpt(gpt, "Classify jobs", parked, _Verdict, index)
+    await dedup_gpt(gpt, "Classify", "We build rockets. " * 30, _Verdict, index)
+    assert len(calls) == 3
+
+    stats = index.stats()
+    assert stats["lookups"] == 4
+    assert stats["hit_rate"] == 0.25
+    assert sum(stats["hits_by_distance"].values()) == 1
+    index.close()
+
+
+def test_near_dup_index_evicts_lru(tmp_path):
+    index = NearDupIndex(tmp_path / "dups.sqlite", max_mb=0)
+    index.max_bytes = 1000
+    pages = [f"Page {i}: " + f"words of page {i} " * 20 for i in range(20)]
+
+    for page in pages:
+        index.add("ns", page, _Verdict(classification="x" * 80))
+        index.get("ns", pages[0], _Verdict)
+
+    assert index.size() <= 1000
+    assert index.get("ns", pages[0], _Verdict) is not None
+    assert index.get("ns", pages[1], _Verdict) is None
+    index.close()
@@ -0,0 +1,192 @@
+"""
+Plain HTTP fetch tier. Most homepages are server rendered, so we try a pooled keep-alive
+client first, and only fall back to a browser when the response looks like a JS app shell
+or a bot wall.
+"""
+
+import asyncio
+import re
+from collections import Counter
+
+import httpx
+import pytest
+
+from .loops import close_stale
+
+pytest_plugins = ("pytest_asyncio",)
+
+HTTP_TIMEOUT = 15
+HTTP_LIMITS = httpx.Limits(
+    max_connections=100, max_keepalive_connections=20, keepalive_expiry=30
+)
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.9",
+}
+
+# Below this much visible text (and with scripts on the page) we assume it's rendered client side
+MIN_VISIBLE_TEXT = 200
+
+BLOCKED_STATUSES = {401, 403, 405, 406, 429, 503}
+
+BOT_WALL_MARKERS = re.compile(
+    r"cf-challenge|cf_chl_|challenge-platform|just a moment\.\.\.|attention required!? \| cloudflare"
+    r"|_incapsula_resource|captcha-delivery\.com|px-captcha"
+    r"|please enable (?:javascript|js) and cookies",
+    re.IGNORECASE,
+)
+
+SPA_MARKERS = re.compile(
+    r"<div[^>]+id=[\"'](?:root|app|__next|__nuxt|svelte)[\"'][^>]*>\s*</div>"
+    r"|you need to enable javascript to run this app"
+    r"|this (?:site|app|page) requires javascript",
+    re.IGNORECASE,
+)
+
+_INVISIBLE = re.compile(
+    r"<(script|style|noscript|template|svg)\b.*?</\1\s*>|<!--.*?-->",
+    re.IGNORECASE | re.DOTALL,
+)
+_TAGS = re.compile(r"<[^>]+>")
+_WHITESPACE = re.compile(r"\s+")
+
+fetch_stats = Counter()
+
+
+def visible_text(html: str) -> str:
+    """
+    Very rough visible text, good enough for the heuristics below (no full parse).
+    """
+    text = _INVISIBLE.sub(" ", html)
+    text = _TAGS.sub(" ", text)
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def needs_browser(status: int, content_type: str, html: str) -> str | None:
+    """
+    Returns the reason we should escalate to a real browser, or None if the plain HTTP
+    response is good enough.
+    """
+    if status in BLOCKED_STATUSES:
+        return "blocked"
+
+    if "html" not in content_type:
+        return "not html"
+
+    if BOT_WALL_MARKERS.search(html):
+        return "bot wall"
+
+    if SPA_MARKERS.search(html):
+        return "spa shell"
+
+    if len(visible_text(html)) < MIN_VISIBLE_TEXT and "<script" in html.lower():
+        return "little text"
+
+    return None
+
+
+def test_needs_browser():
+    article = (
+        "<html><body><h1>Acme</h1><p>"
+        + "We build rockets. " * 30
+        + "</p></body></html>"
+    )
+    assert needs_browser(200, "text/html; charset=utf-8", article) is None
+    assert needs_browser(403, "text/html", article) == "blocked"
+    assert needs_browser(200, "application/pdf", "") == "not html"
+    assert (
+        needs_browser(200, "text/html", "<title>Just a moment...</title>" + article)
+        == "bot wall"
+    )
+    assert (
+        needs_browser(
+            200, "text/html", '<body><div id="root"></div><script src="/a.js"></script>'
+        )
+        == "spa shell"
+    )
+    assert (
+        needs_browser(200, "text/html", "<body><p>Hi</p><script>boot()</script></body>")
+        == "little text"
+    )
+    # Short but static pages (e.g. error pages) are fine as they are
+    assert needs_browser(404, "text/html", "<h1>404 Not Found</h1>") is None
+
+
+@pytest.mark.asyncio
+async def test_fetch_http_bad_url():
+    # the browser tier gets to deal with these
+    assert await fetch_http("http://[::1") is None  # InvalidURL
+    assert await fetch_http("http://xn--a.com") is None  # IDNAError (a UnicodeError)
+
+
+_client: httpx.AsyncClient | None = None
+_client_loop = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Process wide client, so connections are kept alive between fetches. Like the browser
+    pool, it's tied to the running event loop.
+    """
+    global _client, _client_loop
+
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop:
+        if _client is not None:
+            close_stale(_client.aclose(), _client_loop)
+        _client = httpx.AsyncClient(
+            headers=HEADERS,
+            limits=HTTP_LIMITS,
+            timeout=HTTP_TIMEOUT,
+            follow_redirects=True,
+        )
+        _client_loop = loop
+    return _client
+
+
+async def close_http_client():
+    global _client, _client_loop
+
+    if _client is not None:
+        await _client.aclose()
+    _client = None
+    _client_loop = None
+
+
+async def fetch_http(
+    url: str, etag: str | None = None, last_modified: str | None = None
+) -> httpx.Response | None:
+    """
+    Fetch the page without rendering it. Returns None if it needs a browser instead.
+
+    With `etag` / `last_modified` (from a cached copy) this is a conditional request, and
+    the response can be a 304.
+    """
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    try:
+        response = await get_http_client().get(url, headers=headers)
+    # InvalidURL and UnicodeError (odd hosts) aren't HTTPErrors
+    except (httpx.HTTPError, httpx.InvalidURL, ValueError) as e:
+        print(f"HTTP fetch failed for {url}: {e!r}")
+        fetch_stats["escalated: http error"] += 1
+        return None
+
+    if response.status_code == 304 and headers:
+        fetch_stats["not modified"] += 1
+        return response
+
+    reason = needs_browser(
+        response.status_code, response.headers.get("content-type", ""), response.text
+    )
+    if reason is not None:
+        fetch_stats[f"escalated: {reason}"] += 1
+        return None
+
+    fetch_stats["http"] += 1
+    return response
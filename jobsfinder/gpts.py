@@ -2,16 +2,35 @@
 File for all the GPT calls. Will also add the unit tests here for simplicity.
 """
 
+import asyncio
 import json
 import re
 from datetime import datetime
+from functools import partial
 from typing import Literal, Optional
+from urllib.parse import urlparse
 
 import pandas as pd
 import pytest
 from pydantic import BaseModel
 
-from .core import TEMP_DIR, html2md, limit_parallel, scrape_url, simple_gpt
+from .ats import ats_titles, find_adapter
+from .cache import canonical_url
+from .cascade import load_model
+from .core import (
+    DEFAULT,
+    TEMP_DIR,
+    html2md_async,
+    limit_parallel,
+    scrape_url,
+    simple_gpt,
+)
+from .dedup import NearDupIndex, dedup_gpt, distance, simhash
+from .packing import packed_gpt
+from .prefetch import Prefetcher, career_links
+from .prune import PRUNE_TOKEN_BUDGET, prune_markdown
+from .rules import invalid_reason
+from .structured import structured_jobs
 from .testcases import (
     jobs_links,
     jobs_list,
@@ -27,6 +46,14 @@ pytest_plugins = ("pytest_asyncio",)
 
 FOLLOW_DEPTH = 3
 
+# What the local cascade may answer for jobs_status: the other classes need a link or
+# titles, which only GPT gives us
+LOCAL_JOBS_ANSWERS = ("No jobs", "Job open apply")
+
+# Results of already classified pages, handed to their near duplicates. Set to None to
+# always classify.
+NEAR_DUPS = NearDupIndex(TEMP_DIR / "near_dups.sqlite")
+
 
 class WebsiteClassification(BaseModel):
     reasoning: str
@@ -46,8 +73,25 @@ class SalesRoles(BaseModel):
     email_line: Optional[str]
 
 
-async def valid_website(content) -> WebsiteClassification:
-    _system_msg = """
+def _prune(content, budget):
+    if budget is None or not isinstance(content, str):
+        return content
+    return prune_markdown(content, budget).md
+
+
+def _reusable(result) -> bool:
+    """
+    Whether a result can be handed to a near duplicate page. Job titles and absolute links
+    belong to the page they were made for: career pages on the same ATS / site builder
+    template can differ by only a few titles.
+    """
+    link = getattr(result, "link", None)
+    return not getattr(result, "titles", None) and (
+        not link or not urlparse(link).netloc
+    )
+
+
+VALID_WEBSITE_MSG = """
 
 You are a website classifier. I'm going to give you access to a website content (converted to markdown). Your job is to classify it into valid and invalid.
 
@@ -65,7 +109,60 @@ For the output, give your very short reasoning (max 1-2 sentence), plus your cla
 
 """.strip()
 
-    return await simple_gpt(_system_msg, content, WebsiteClassification)
+
+def valid_website_prompt(content, budget=PRUNE_TOKEN_BUDGET) -> tuple:
+    """
+    (system_msg, user_msg, schema) of the valid_website call, also used for batches.
+    """
+    return VALID_WEBSITE_MSG, _prune(content, budget), WebsiteClassification
+
+
+async def valid_website(
+    content,
+    budget=PRUNE_TOKEN_BUDGET,
+    local=True,
+    rules=True,
+    packed=True,
+    dedup: NearDupIndex | None = DEFAULT,
+) -> WebsiteClassification:
+    """
+    :param local: Let the local classifier answer when it's confident (if it's trained,
+        see scripts/train_cascade.py).
+    :param rules: Reject the obvious error / parked / bot wall pages without a call.
+    :param packed: Short pages share their call with other pages classified at the same
+        time (see packing.py).
+    :param dedup: Reuse the result of a near duplicate page (see dedup.py). Defaults to
+        NEAR_DUPS.
+    """
+    if rules and isinstance(content, str) and (reason := invalid_reason(content)):
+        return WebsiteClassification(
+            reasoning=f"Rule: {reason}", classification="invalid"
+        )
+
+    model = load_model("valid_website") if local and isinstance(content, str) else None
+    if model is not None and (label := model.answer(content)) is not None:
+        return WebsiteClassification(reasoning="Local classifier", classification=label)
+
+    gpt = packed_gpt if packed else simple_gpt
+    return await dedup_gpt(
+        gpt,
+        *valid_website_prompt(content, budget),
+        index=NEAR_DUPS if dedup is DEFAULT else dedup,
+    )
+
+
+async def page_validity(pages: list[str]) -> list[str]:
+    """
+    valid_website labels made from the pages by GPT alone, to train and evaluate the
+    shortcuts in front of it (rules, local model). The valid_website column of the stage
+    outputs can't be used for that, it was classified from the URL. Each page gets a call
+    of its own, so the labels don't depend on what it was packed with.
+    """
+    tasks = [
+        valid_website(page, local=False, rules=False, packed=False, dedup=None)
+        for page in pages
+    ]
+    return [result.classification for result in await limit_parallel(tasks, 10)]
 
 
 async def quickcases(process_func, cases):
@@ -89,10 +186,20 @@ async def quickcases(process_func, cases):
     return classification
 
 
+def _gpt_only(classify):
+    """
+    The suites test the prompts, so no local model, rules or near duplicate answers.
+    """
+    kwargs = {"local": False, "dedup": None}
+    if classify is valid_website:
+        kwargs["rules"] = False
+    return partial(classify, **kwargs)
+
+
 @pytest.mark.slow
 @pytest.mark.asyncio
 async def test_invalid():
-    results = await quickcases(valid_website, websites_invalid)
+    results = await quickcases(_gpt_only(valid_website), websites_invalid)
     failed = [
         case for case, result in zip(websites_invalid, results) if result != "invalid"
     ]
@@ -102,15 +209,14 @@ async def test_invalid():
 @pytest.mark.slow
 @pytest.mark.asyncio
 async def test_valid():
-    results = await quickcases(valid_website, websites_valid)
+    results = await quickcases(_gpt_only(valid_website), websites_valid)
     failed = [
         case for case, result in zip(websites_valid, results) if result != "valid"
     ]
     assert not failed, f"Failed cases: {failed}"
 
 
-async def jobs_status(content) -> JobsClassification:
-    _system_msg = """
+JOBS_STATUS_MSG = """
 
 You are a website classifier. I'm going to give you access to a website content (converted to markdown). Your job is to determine whether the website contains jobs.
 
@@ -153,13 +259,80 @@ TravelPro is an award-winning travel agency offering luxury vacations and person
 
 """.strip()
 
-    return await simple_gpt(_system_msg, content, JobsClassification)
+
+def jobs_status_prompt(content, budget=PRUNE_TOKEN_BUDGET) -> tuple:
+    """
+    (system_msg, user_msg, schema) of the jobs_status call, also used for batches.
+    """
+    return JOBS_STATUS_MSG, _prune(content, budget), JobsClassification
+
+
+async def jobs_status(
+    content,
+    budget=PRUNE_TOKEN_BUDGET,
+    local=True,
+    dedup: NearDupIndex | None = DEFAULT,
+) -> JobsClassification:
+    """
+    :param local: Let the local classifier answer when it's confident (if it's trained,
+        see scripts/train_cascade.py).
+    :param dedup: Reuse the result of a near duplicate page (see dedup.py). Defaults to
+        NEAR_DUPS.
+    """
+    model = load_model("jobs_status") if local and isinstance(content, str) else None
+    if model is not None:
+        label = model.answer(content, allowed=LOCAL_JOBS_ANSWERS)
+        if label is not None:
+            return JobsClassification(
+                reasoning="Local classifier", classification=label
+            )
+
+    return await dedup_gpt(
+        simple_gpt,
+        *jobs_status_prompt(content, budget),
+        index=NEAR_DUPS if dedup is DEFAULT else dedup,
+        reusable=_reusable,
+    )
+
+
+@pytest.mark.asyncio
+async def test_jobs_status_near_dups(tmp_path, monkeypatch):
+    index = NearDupIndex(tmp_path / "dups.sqlite")
+    calls = []
+
+    async def fake_gpt(system_msg, user_msg, schema):
+        calls.append(user_msg)
+        titles = [line[2:] for line in user_msg.splitlines() if line.startswith("- ")]
+        if titles:
+            return schema(reasoning="", classification="Job list", titles=titles)
+        return schema(reasoning="", classification="No jobs")
+
+    monkeypatch.setattr("jobsfinder.gpts.simple_gpt", fake_gpt)
+
+    template = "# Careers at Acme\n\n" + " ".join(
+        f"Reason {i} to join: we build great things together." for i in range(40)
+    )
+    a = template + "\n\n- Account Executive\n- Sales Development Representative"
+    b = template + "\n\n- Account Executive\n- Product Designer"
+    assert distance(simhash(a), simhash(b)) <= index.max_distance
+
+    # another company on the same template doesn't get our titles
+    await jobs_status(a, budget=None, local=False, dedup=index)
+    result = await jobs_status(b, budget=None, local=False, dedup=index)
+    assert result.titles == ["Account Executive", "Product Designer"]
+    assert len(calls) == 2
+
+    # results without titles are still shared
+    await jobs_status(template + "\n\nNo open roles.", None, local=False, dedup=index)
+    await jobs_status(template + "\n\nNo open roles!", None, local=False, dedup=index)
+    assert len(calls) == 3
+    index.close()
 
 
 @pytest.mark.slow
 @pytest.mark.asyncio
 async def test_jobs_list():
-    results = await quickcases(jobs_status, jobs_list)
+    results = await quickcases(_gpt_only(jobs_status), jobs_list)
     failed = [case for case, result in zip(jobs_list, results) if result != "Job list"]
     assert not failed, f"Failed cases: {failed}"
 
@@ -167,7 +340,7 @@ async def test_jobs_list():
 @pytest.mark.slow
 @pytest.mark.asyncio
 async def test_jobs_none():
-    results = await quickcases(jobs_status, jobs_none)
+    results = await quickcases(_gpt_only(jobs_status), jobs_none)
     failed = [case for case, result in zip(jobs_none, results) if result != "No jobs"]
     assert not failed, f"Failed cases: {failed}"
 
@@ -175,7 +348,7 @@ async def test_jobs_none():
 @pytest.mark.slow
 @pytest.mark.asyncio
 async def test_jobs_links():
-    results = await quickcases(jobs_status, jobs_links)
+    results = await quickcases(_gpt_only(jobs_status), jobs_links)
     failed = [
         case for case, result in zip(jobs_links, results) if result != "Link to jobs"
     ]
@@ -187,7 +360,7 @@ async def test_jobs_links():
 @pytest.mark.slow
 @pytest.mark.asyncio
 async def test_jobs_open_apply():
-    results = await quickcases(jobs_status, jobs_open_apply)
+    results = await quickcases(_gpt_only(jobs_status), jobs_open_apply)
     failed = [
         case
         for case, result in zip(jobs_open_apply, results)
@@ -199,7 +372,7 @@ async def test_jobs_open_apply():
 @pytest.mark.slow
 @pytest.mark.asyncio
 async def test_jobs_zero():
-    results = await quickcases(jobs_status, jobs_zero)
+    results = await quickcases(_gpt_only(jobs_status), jobs_zero)
     failed = [
         case
         for case, result in zip(jobs_zero, results)
@@ -208,6 +381,120 @@ async def test_jobs_zero():
     assert not failed, f"Failed cases: {failed}"
 
 
+class HomepageClassification(BaseModel):
+    reasoning: str
+    validity: Literal["invalid", "valid"]
+    classification: Literal["Job list", "Job open apply", "Link to jobs", "No jobs"]
+    link: Optional[str] = None
+    titles: Optional[list[str]] = None
+
+    def website(self) -> WebsiteClassification:
+        return WebsiteClassification(
+            reasoning=self.reasoning, classification=self.validity
+        )
+
+    def jobs(self) -> JobsClassification:
+        return JobsClassification(
+            reasoning=self.reasoning,
+            classification=self.classification,
+            link=self.link,
+            titles=self.titles,
+        )
+
+
+HOMEPAGE_MSG = f"""
+
+You are a website classifier. I'm going to give you access to a website content (converted to markdown). You have two tasks on it, answer both in the same output: first whether the website is valid, then whether it contains jobs.
+
+# Task 1: validity (the `validity` field)
+
+{VALID_WEBSITE_MSG}
+
+# Task 2: jobs (the `classification`, `link` and `titles` fields)
+
+{JOBS_STATUS_MSG}
+
+# Output
+
+Give one very short reasoning (max 1-2 sentences) covering both tasks. If the website is invalid, the jobs classification is "No jobs".
+
+""".strip()
+
+
+def homepage_prompt(content, budget=PRUNE_TOKEN_BUDGET) -> tuple:
+    """
+    (system_msg, user_msg, schema) of the homepage_status call, also used for batches.
+    """
+    return HOMEPAGE_MSG, _prune(content, budget), HomepageClassification
+
+
+async def homepage_status(
+    content,
+    budget=PRUNE_TOKEN_BUDGET,
+    rules=True,
+    dedup: NearDupIndex | None = DEFAULT,
+) -> HomepageClassification:
+    """
+    valid_website and jobs_status in one call, so the page content is only paid for once.
+
+    :param dedup: Reuse the result of a near duplicate page (see dedup.py). Defaults to
+        NEAR_DUPS.
+    """
+    if rules and isinstance(content, str) and (reason := invalid_reason(content)):
+        return HomepageClassification(
+            reasoning=f"Rule: {reason}", validity="invalid", classification="No jobs"
+        )
+
+    return await dedup_gpt(
+        simple_gpt,
+        *homepage_prompt(content, budget),
+        index=NEAR_DUPS if dedup is DEFAULT else dedup,
+        reusable=_reusable,
+    )
+
+
+def test_homepage_classification():
+    result = HomepageClassification(
+        reasoning="Lists two roles",
+        validity="valid",
+        classification="Job list",
+        titles=["Sales Manager", "Engineer"],
+    )
+    assert result.website().classification == "valid"
+    assert result.jobs().titles == ["Sales Manager", "Engineer"]
+    assert VALID_WEBSITE_MSG in HOMEPAGE_MSG and JOBS_STATUS_MSG in HOMEPAGE_MSG
+
+
+# suite: (expected validity, accepted job classifications, None for any)
+HOMEPAGE_SUITES = {
+    "websites_invalid": (websites_invalid, "invalid", None),
+    "websites_valid": (websites_valid, "valid", None),
+    "jobs_list": (jobs_list, "valid", ["Job list"]),
+    "jobs_none": (jobs_none, "valid", ["No jobs"]),
+    "jobs_links": (jobs_links, "valid", ["Link to jobs"]),
+    # same leniency as test_jobs_open_apply / test_jobs_zero
+    "jobs_open_apply": (jobs_open_apply, "valid", ["No jobs", "Job open apply"]),
+    "jobs_zero": (jobs_zero, "valid", ["No jobs", "Job open apply"]),
+}
+
+
+@pytest.mark.slow
+@pytest.mark.asyncio
+async def test_homepage_status():
+    failed = {}
+    for suite, (cases, validity, classifications) in HOMEPAGE_SUITES.items():
+        results = await limit_parallel(
+            [homepage_status(case, rules=False, dedup=None) for case in cases], 10
+        )
+        failed[suite] = [
+            (case[:100], result.validity, result.classification)
+            for case, result in zip(cases, results)
+            if result.validity != validity
+            or (classifications and result.classification not in classifications)
+        ]
+    assert not any(failed.values()), f"Failed cases: {failed}"
+
+
 def _strip_leading_dots(x: str) -> str:
     return x.lstrip(".")
 
@@ -248,7 +535,84 @@ def test_prep_link():
     assert prep_link("https://example.com", "...jobs") == "https://example.com/jobs"
 
 
-async def follow_links(base_url: str, next_link: str, history: list[str]):
+async def _fetch_page(url: str) -> tuple:
+    """
+    (html, md) of the page.
+    """
+    print("Scraping page", url)
+    content = await scrape_url(url)
+    print("converting to md")
+    return content, await html2md_async(content)
+
+
+async def _structured_status(html) -> JobsClassification | None:
+    """
+    jobs_status straight from the JobPosting data / embedded ATS board of the raw HTML,
+    if it has any (see structured.py). If the board's endpoint fails, the page is
+    classified as usual: following the board link would scrape its embed script.
+    """
+    found = structured_jobs(html)
+    if found is None:
+        return None
+    if found.titles:
+        return JobsClassification(
+            reasoning="JobPosting structured data",
+            classification="Job list",
+            titles=found.titles,
+        )
+
+    titles = await ats_titles(found.board)
+    if titles is None:
+        return None
+    print(f"Got {len(titles)} titles from the embedded ATS board")
+    return JobsClassification(
+        reasoning="Embedded ATS board",
+        classification="Job list" if titles else "No jobs",
+        link=found.board,
+        titles=titles,
+    )
+
+
+def _prefetch_candidates(base_url: str, md: str, seen: set[str]) -> list[str]:
+    links = [prep_link(base_url, link) for link in career_links(md)]
+    # ATS boards aren't scraped, see ats.py
+    return [
+        link
+        for link in links
+        if canonical_url(link) not in seen and find_adapter(link) is None
+    ]
+
+
+async def follow_links(
+    base_url: str,
+    next_link: str,
+    history: list[str],
+    visited: dict[str, JobsClassification] | None = None,
+    speculative=False,
+):
+    """
+    :param visited: jobs_status of the pages of this company seen so far, by
+        canonical_url. Links back to one of them are a loop, and end the search without
+        scraping the page again.
+    :param speculative: Fetch the likely careers links of a page while it's classified
+        (see prefetch.py).
+    """
+    pages = Prefetcher(_fetch_page, speculative)
+    try:
+        return await _follow_links(
+            base_url, next_link, history, {} if visited is None else visited, pages
+        )
+    finally:
+        pages.discard()
+
+
+async def _follow_links(
+    base_url: str,
+    next_link: str,
+    history: list[str],
+    visited: dict[str, JobsClassification],
+    pages: Prefetcher,
+):
     if len(history) > FOLLOW_DEPTH + 1:
         return {
             "status": "Max depth reached",
@@ -258,28 +622,31 @@ async def follow_links(base_url: str, next_link: str, history: list[str]):
         }
 
     _next_link = prep_link(base_url, next_link)
+    key = canonical_url(_next_link)
 
     print("Starting next link", _next_link)
 
-    # this was buggy, so disabled it for now
-    if False:
-        print(history)
-        print(_next_link)
-        import pdb
-
-        pdb.set_trace()
+    if key in visited:
+        print("Already visited", key)
         return {
             "status": "Loop detected",
             "history": history,
-            "titles": [],
+            "titles": visited[key].titles or [],
             "error": None,
         }
 
     try:
-        print("Scraping page")
-        content = await scrape_url(_next_link)
-        print("converting to md")
-        md = html2md(content)
+        titles = await ats_titles(_next_link)
+        if titles is not None:
+            print(f"Got {len(titles)} titles from the ATS board")
+            return {
+                "status": "Job list" if titles else "No jobs",
+                "titles": titles,
+                "history": history,
+                "error": None,
+            }
+
+        html, md = await pages.fetch(_next_link)
 
         if not md:
             return {
@@ -289,13 +656,20 @@ async def follow_links(base_url: str, next_link: str, history: list[str]):
                 "error": None,
             }
 
-        print("judging website status")
-        status = await jobs_status(md)
+        status = await _structured_status(html)
+        if status is None:
+            print("judging website status")
+            pages.start(_prefetch_candidates(base_url, md, {*visited, key}))
+            status = await jobs_status(md)
+        visited[key] = status
 
         print("Status", status)
 
         if status.classification == "Link to jobs":
-            return await follow_links(base_url, status.link, history + [status.link])
+            pages.keep(prep_link(base_url, status.link))
+            return await _follow_links(
+                base_url, status.link, history + [status.link], visited, pages
+            )
 
         return {
             "status": status.classification,
@@ -308,8 +682,55 @@ async def follow_links(base_url: str, next_link: str, history: list[str]):
         return {"status": "Error", "history": history, "error": str(e), "titles": []}
 
 
+@pytest.mark.asyncio
+async def test_follow_links_loop(monkeypatch):
+    links = {
+        "https://acme.com": "/about",
+        "https://acme.com/about": "http://www.acme.com/?utm_source=about",
+    }
+    scraped = []
+
+    async def fake_scrape(url):
+        scraped.append(url)
+        return url
+
+    async def fake_html2md(html):
+        return html
+
+    async def fake_jobs_status(md):
+        return JobsClassification(
+            reasoning="", classification="Link to jobs", link=links[md]
+        )
+
+    monkeypatch.setattr("jobsfinder.gpts.scrape_url", fake_scrape)
+    monkeypatch.setattr("jobsfinder.gpts.html2md_async", fake_html2md)
+    monkeypatch.setattr("jobsfinder.gpts.jobs_status", fake_jobs_status)
+
+    res = await follow_links("https://acme.com", "https://acme.com", [])
+    assert res["status"] == "Loop detected"
+    assert scraped == ["https://acme.com", "https://acme.com/about"]
+
+
 # this is just to skip the first scrape, we've already done that
-async def follow_scrape(base_url: str, md):
+async def follow_scrape(
+    base_url: str,
+    md,
+    status: JobsClassification | HomepageClassification | None = None,
+    fused=False,
+    speculative=False,
+    html: str | None = None,
+):
+    """
+    :param status: jobs_status (or homepage_status) of `md`, if it's already known (e.g.
+        from a batch).
+    :param fused: Classify `md` with homepage_status, so the validity comes from the same
+        call. The result then also has "valid_website".
+    :param speculative: Fetch the likely careers links of each page while it's classified
+        (see prefetch.py).
+    :param html: The raw HTML `md` was made from, if the caller has it, for the job data
+        that's lost in html2md (see structured.py).
+    """
+    pages = Prefetcher(_fetch_page, speculative)
     try:
         if not md:
             return {
@@ -319,26 +740,152 @@ async def follow_scrape(base_url: str, md):
                 "error": None,
             }
 
-        print("judging website status")
-        status = await jobs_status(md)
+        if status is None:
+            status = await _structured_status(html)
+            if status is not None and fused:
+                status = HomepageClassification(validity="valid", **status.model_dump())
 
-        print("Status", status)
+        if status is None:
+            print("judging website status")
+            pages.start(_prefetch_candidates(base_url, md, {canonical_url(base_url)}))
+            status = await (homepage_status if fused else jobs_status)(md)
 
-        if status.classification == "Link to jobs":
-            return await follow_links(base_url, status.link, [base_url, status.link])
-
-        return {
-            "status": status.classification,
-            "titles": status.titles,
-            "history": [base_url],
-            "error": None,
-        }
+        return await _follow_status(base_url, status, pages)
     except Exception as e:
         return {"status": "Error", "history": [base_url], "error": str(e), "titles": []}
+    finally:
+        pages.discard()
+
+
+async def _follow_status(
+    base_url: str,
+    status: JobsClassification | HomepageClassification,
+    pages: Prefetcher,
+):
+    print("Status", status)
+
+    if isinstance(status, HomepageClassification):
+        if status.validity == "invalid":
+            return {
+                "status": "Invalid website",
+                "history": [base_url],
+                "titles": [],
+                "error": None,
+                "valid_website": "invalid",
+            }
+        result = await _follow_status(base_url, status.jobs(), pages)
+        return {**result, "valid_website": "valid"}
+
+    if status.classification == "Link to jobs":
+        pages.keep(prep_link(base_url, status.link))
+        return await _follow_links(
+            base_url,
+            status.link,
+            [base_url, status.link],
+            {canonical_url(base_url): status},
+            pages,
+        )
+
+    return {
+        "status": status.classification,
+        "titles": status.titles,
+        "history": [base_url],
+        "error": None,
+    }
+
+
+@pytest.mark.asyncio
+async def test_follow_scrape_fused_status():
+    invalid = HomepageClassification(
+        reasoning="404", validity="invalid", classification="No jobs"
+    )
+    res = await follow_scrape("https://acme.com", "# 404", status=invalid)
+    assert res["status"] == "Invalid website"
+    assert res["valid_website"] == "invalid"
+
+    no_jobs = HomepageClassification(
+        reasoning="Shop", validity="valid", classification="No jobs"
+    )
+    res = await follow_scrape("https://acme.com", "# Shop", status=no_jobs)
+    assert res["status"] == "No jobs"
+    assert res["valid_website"] == "valid"
+    assert res["history"] == ["https://acme.com"]
+
+
+@pytest.mark.asyncio
+async def test_follow_scrape_speculative(monkeypatch):
+    scraped = []
+
+    async def fake_scrape(url):
+        scraped.append(url)
+        return "# Open roles\n\n- Account Executive"
+
+    async def fake_html2md(html):
+        return html
+
+    async def fake_jobs_status(md):
+        if "Open roles" in md:
+            return JobsClassification(
+                reasoning="", classification="Job list", titles=["Account Executive"]
+            )
+        # the careers page is fetched while the homepage is classified
+        await asyncio.sleep(0.01)
+        assert scraped == ["https://acme.com/careers"]
+        return JobsClassification(
+            reasoning="", classification="Link to jobs", link="/careers/"
+        )
+
+    monkeypatch.setattr("jobsfinder.gpts.scrape_url", fake_scrape)
+    monkeypatch.setattr("jobsfinder.gpts.html2md_async", fake_html2md)
+    monkeypatch.setattr("jobsfinder.gpts.jobs_status", fake_jobs_status)
+    homepage = "# Acme\n\n[About](/about) [Careers](/careers)"
+    res = await follow_scrape("https://acme.com", homepage, speculative=True)
+    assert res["status"] == "Job list"
+    assert res["titles"] == ["Account Executive"]
+    assert scraped == ["https://acme.com/careers"]
+
+
+@pytest.mark.asyncio
+async def test_follow_links_structured(monkeypatch):
+    pages = {
+        "https://acme.com": '<a href="/careers">Careers</a>',
+        "https://acme.com/careers": '<script src="https://jobs.ashbyhq.com/acme/embed">'
+        "</script>",
+    }
+
+    async def fake_scrape(url):
+        return pages[url]
+
+    async def fake_html2md(html):
+        return "[Careers](/careers)" if "href" in html else "# Careers"
+
+    async def fake_jobs_status(md):
+        assert md == "[Careers](/careers)"
+        return JobsClassification(
+            reasoning="", classification="Link to jobs", link="/careers"
+        )
+
+    async def fake_ats_titles(url):
+        return ["Founding Account Executive"] if "ashbyhq" in url else None
+
+    monkeypatch.setattr("jobsfinder.gpts.scrape_url", fake_scrape)
+    monkeypatch.setattr("jobsfinder.gpts.html2md_async", fake_html2md)
+    monkeypatch.setattr("jobsfinder.gpts.jobs_status", fake_jobs_status)
+    monkeypatch.setattr("jobsfinder.gpts.ats_titles", fake_ats_titles)
+
+    # the careers page embeds the board, its jobs come from the ATS without a GPT call
+    res = await follow_links("https://acme.com", "https://acme.com", [])
+    assert res["status"] == "Job list"
+    assert res["titles"] == ["Founding Account Executive"]
 
 
 # Note: untested function, out of time
-async def has_sales_roles(content) -> SalesRoles:
+async def has_sales_roles(content, packed=False) -> SalesRoles:
+    """
+    :param packed: Share the call with other companies' titles (see packing.py). Off by
+        default: the answer is an email line for one company, and mixing in the titles of
+        another would be worse than the saved tokens are worth.
+    """
     _system_msg = """
 You're an AI sales qualifier and email line generator.
 
@@ -359,4 +906,40 @@ Respond with the following output:
     if type(content) is list:
         content = "\n".join(content)
 
-    return await simple_gpt(_system_msg, content, SalesRoles)
+    gpt = packed_gpt if packed else simple_gpt
+    return await gpt(_system_msg, content, SalesRoles)
+
+
+@pytest.mark.asyncio
+async def test_follow_links_broken_board(monkeypatch):
+    page = '<script src="https://boards.greenhouse.io/embed/job_board/js?for=gone">'
+    scraped = []
+
+    async def fake_scrape(url):
+        scraped.append(url)
+        return page
+
+    async def fake_html2md(html):
+        return "# Careers\n\n- Account Executive"
+
+    async def fake_jobs_status(md):
+        return JobsClassification(
+            reasoning="", classification="Job list", titles=["Account Executive"]
+        )
+
+    async def fake_ats_titles(url):
+        return None
+
+    monkeypatch.setattr("jobsfinder.gpts.scrape_url", fake_scrape)
+    monkeypatch.setattr("jobsfinder.gpts.html2md_async", fake_html2md)
+    monkeypatch.setattr("jobsfinder.gpts.jobs_status", fake_jobs_status)
+    monkeypatch.setattr("jobsfinder.gpts.ats_titles", fake_ats_titles)
+
+    # the board's endpoint fails: the page's own content, not the embed script
+    res = await follow_links("https://acme.com", "https://acme.com/careers", [])
+    assert res["titles"] == ["Account Executive"]
+    assert scraped == ["https://acme.com/careers"]
+
+    res = await follow_scrape("https://acme.com", "# Careers", html=page)
+    assert res["titles"] == ["Account Executive"]
+    assert scraped == ["https://acme.com/careers"]
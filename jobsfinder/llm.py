@@ -0,0 +1,396 @@
+"""
+Plumbing for the OpenAI calls in core.simple_gpt: a shared client, and rate limit aware
+dispatch (token buckets for requests / tokens per minute, Retry-After, jittered backoff).
+"""
+
+import asyncio
+import json
+import random
+import re
+import time
+from collections import Counter
+from email.utils import parsedate_to_datetime
+
+import httpx
+import pytest
+from openai import (
+    APIStatusError,
+    AsyncClient,
+    AuthenticationError,
+    BadRequestError,
+    NotFoundError,
+    PermissionDeniedError,
+    UnprocessableEntityError,
+)
+from pydantic import BaseModel
+
+from .loops import close_stale
+from .prune import count_tokens
+
+pytest_plugins = ("pytest_asyncio",)
+
+
+# Keep-alive pool shared by all the LLM calls of the process
+OPENAI_MAX_CONNECTIONS = 100
+OPENAI_MAX_KEEPALIVE = 50
+OPENAI_KEEPALIVE_EXPIRY = 60
+OPENAI_TIMEOUT = 120
+
+# Starting budgets, they get replaced by the limits the API reports in its headers
+OPENAI_RPM = 500
+OPENAI_TPM = 200_000
+OUTPUT_TOKENS_ESTIMATE = 300
+
+MAX_ATTEMPTS = 6
+BACKOFF_BASE = 1
+BACKOFF_CAP = 60
+
+# Retrying these won't help
+NOT_RETRYABLE = (
+    AuthenticationError,
+    BadRequestError,
+    NotFoundError,
+    PermissionDeniedError,
+    UnprocessableEntityError,
+)
+
+
+def _parse_duration(value: str) -> float | None:
+    """
+    OpenAI's reset headers look like "20ms", "1s", "6m0s" or "1h2m3.5s".
+    """
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value or "")
+    if not parts:
+        return None
+    scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(n) * scale[unit] for n, unit in parts)
+
+
+def retry_after(headers) -> float | None:
+    """
+    Seconds the server asked us to wait, if it did.
+    """
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt: int) -> float:
+    """
+    Exponential backoff with full jitter, so parallel tasks don't retry in lockstep.
+    """
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt))
+
+
+def test_rate_limit_headers():
+    assert _parse_duration("20ms") == 0.02
+    assert _parse_duration("6m0s") == 360
+    assert _parse_duration("1h2m3.5s") == 3723.5
+    assert _parse_duration("") is None
+
+    assert retry_after({"retry-after-ms": "1500", "retry-after": "9"}) == 1.5
+    assert retry_after({"retry-after": "9"}) == 9
+    assert retry_after({}) is None
+
+    assert all(0 <= backoff(i) <= BACKOFF_CAP for i in range(20))
+
+
+class TokenBucket:
+    """
+    Refills at `per_minute`, holds at most a minute's worth.
+    """
+
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(
+            self.per_minute,
+            self.level + (now - self.updated) * self.per_minute / 60,
+        )
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        self._refill()
+        # Never wait for more than a full bucket, so oversized requests still go through
+        missing = min(amount, self.per_minute) - self.level
+        return max(0.0, missing * 60 / self.per_minute)
+
+    def take(self, amount: float):
+        self._refill()
+        self.level -= amount
+
+    def cap(self, remaining: float):
+        """
+        The server says there's only this much left (e.g. other processes use the key).
+        """
+        self._refill()
+        self.level = min(self.level, remaining)
+
+    def set_rate(self, per_minute: float):
+        self._refill()
+        self.per_minute = per_minute
+        self.level = min(self.level, per_minute)
+
+
+class RateLimiter:
+    """
+    Requests and tokens per minute budgets. Requests wait here until both buckets have room,
+    instead of going out and coming back as 429s. On a 429 with Retry-After, everyone
+    pauses, not just the request that got it.
+    """
+
+    def __init__(self, rpm=OPENAI_RPM, tpm=OPENAI_TPM):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.paused_until = 0.0
+        self.stats = Counter()
+
+    async def acquire(self, tokens: int):
+        waited = False
+        while True:
+            wait = max(
+                self.paused_until - time.monotonic(),
+                self.requests.wait_time(1),
+                self.tokens.wait_time(tokens),
+            )
+            if wait <= 0:
+                self.requests.take(1)
+                self.tokens.take(tokens)
+                self.stats["requests"] += 1
+                return
+
+            if not waited:
+                self.stats["throttled"] += 1
+                waited = True
+            await asyncio.sleep(wait + random.uniform(0, 0.05))
+
+    def settle(self, estimated: int, actual: int):
+        """
+        Correct the token bucket once we know what the request really used.
+        """
+        self.tokens.take(actual - estimated)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.stats["paused"] += 1
+
+    def observe(self, status: int, headers):
+        """
+        Follow the x-ratelimit-* headers, so we run at the real limits of the account.
+        """
+        for bucket, kind in [(self.requests, "requests"), (self.tokens, "tokens")]:
+            try:
+                limit = headers.get(f"x-ratelimit-limit-{kind}")
+                if limit:
+                    bucket.set_rate(float(limit))
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                if remaining:
+                    bucket.cap(float(remaining))
+            except ValueError:
+                continue
+
+        if status == 429:
+            self.stats["429"] += 1
+            wait = retry_after(headers)
+            if wait is None:
+                resets = [
+                    _parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                    for kind in ["requests", "tokens"]
+                ]
+                wait = max([r for r in resets if r is not None], default=None)
+            if wait is not None:
+                self.pause(wait)
+
+
+rate_limiter = RateLimiter()
+
+
+async def _observe_response(response: httpx.Response):
+    rate_limiter.observe(response.status_code, response.headers)
+
+
+_client: AsyncClient | None = None
+_client_loop = None
+
+
+def get_openai_client() -> AsyncClient:
+    """
+    One client (and connection pool) per process, instead of a new one with its own TLS
+    handshakes for every call. Tied to the running event loop, like the other pools.
+    """
+    global _client, _client_loop
+
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop:
+        if _client is not None:
+            close_stale(_client.close(), _client_loop)
+        _client = AsyncClient(
+            timeout=OPENAI_TIMEOUT,
+            # retries are handled in parse_completion, with the rate limiter
+            max_retries=0,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=OPENAI_MAX_CONNECTIONS,
+                    max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+                    keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+                ),
+                timeout=OPENAI_TIMEOUT,
+                event_hooks={"response": [_observe_response]},
+            ),
+        )
+        _client_loop = loop
+    return _client
+
+
+async def close_openai_client():
+    global _client, _client_loop
+
+    if _client is not None:
+        await _client.close()
+    _client = None
+    _client_loop = None
+
+
+async def parse_completion(**kwargs):
+    """
+    beta.chat.completions.parse, going through the rate limiter, and retried with backoff
+    (or as long as the server asks us to wait).
+
+    :return: (completion, attempt) where attempt is the 0-based try that worked.
+    """
+    estimate = (
+        sum(count_tokens(m["content"]) for m in kwargs["messages"])
+        + OUTPUT_TOKENS_ESTIMATE
+    )
+
+    for attempt in range(MAX_ATTEMPTS):
+        await rate_limiter.acquire(estimate)
+        try:
+            completion = await get_openai_client().beta.chat.completions.parse(**kwargs)
+        except NOT_RETRYABLE:
+            raise
+        except Exception as err:
+            print(err)
+            delay = backoff(attempt)
+            if isinstance(err, APIStatusError):
+                wait = retry_after(err.response.headers)
+                if wait is not None:
+                    delay = wait + random.uniform(0, 1)
+            await asyncio.sleep(delay)
+            continue
+
+        if completion.usage is not None:
+            rate_limiter.settle(estimate, completion.usage.total_tokens)
+        return completion, attempt
+
+    raise ValueError(f"{MAX_ATTEMPTS} iterations did not succeed!")
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_waits_for_budget():
+    limiter = RateLimiter(rpm=600, tpm=10_000)
+    limiter.requests.level = 0
+
+    start = time.monotonic()
+    await limiter.acquire(100)
+    assert time.monotonic() - start >= 0.09
+    assert limiter.stats["throttled"] == 1
+
+    limiter.observe(
+        429,
+        {
+            "x-ratelimit-limit-requests": "1200",
+            "x-ratelimit-remaining-tokens": "50",
+            "retry-after-ms": "30",
+        },
+    )
+    assert limiter.requests.per_minute == 1200
+    assert limiter.tokens.level <= 50
+    assert limiter.paused_until > time.monotonic()
+
+
+class _Answer(BaseModel):
+    answer: str
+
+
+@pytest.mark.asyncio
+async def test_parse_completion_retries_429(monkeypatch):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) == 1:
+            return httpx.Response(
+                429,
+                headers={"retry-after-ms": "10"},
+                json={"error": {"message": "slow down", "type": "requests"}},
+            )
+        return httpx.Response(
+            200,
+            headers={"x-ratelimit-limit-requests": "10000"},
+            json={
+                "id": "chatcmpl-1",
+                "object": "chat.completion",
+                "created": 0,
+                "model": "gpt-4o-mini-2024-07-18",
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {
+                            "role": "assistant",
+                            "content": json.dumps({"answer": "yes"}),
+                        },
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": 10,
+                    "completion_tokens": 5,
+                    "total_tokens": 15,
+                },
+            },
+        )
+
+    monkeypatch.setattr("jobsfinder.llm.rate_limiter", RateLimiter())
+    monkeypatch.setattr("jobsfinder.llm.random.uniform", lambda a, b: 0)
+    monkeypatch.setattr(
+        "jobsfinder.llm._client",
+        AsyncClient(
+            api_key="test",
+            max_retries=0,
+            http_client=httpx.AsyncClient(
+                transport=httpx.MockTransport(handler),
+                event_hooks={"response": [_observe_response]},
+            ),
+        ),
+    )
+    monkeypatch.setattr("jobsfinder.llm._client_loop", asyncio.get_running_loop())
+
+    completion, attempt = await parse_completion(
+        model="gpt-4o-mini-2024-07-18",
+        messages=[{"role": "user", "content": "hi"}],
+        response_format=_Answer,
+    )
+    assert completion.choices[0].message.parsed == _Answer(answer="yes")
+    assert attempt == 1
+    assert len(calls) == 2
+    assert rate_limiter.stats["429"] == 1
+    assert rate_limiter.requests.per_minute == 10000
@@ -0,0 +1,53 @@
+"""
+The process wide clients (browser pool, http and OpenAI connections) are tied to the event
+loop they were made in. When a new loop asks for one (e.g. separate asyncio.run calls),
+the old client is closed before it's replaced, so its connections and processes don't
+leak.
+"""
+
+import asyncio
+
+import httpx
+
+# Closes in flight, so they aren't garbage collected before they're done
+_closing = set()
+
+
+def close_stale(close, loop: asyncio.AbstractEventLoop | None):
+    """
+    Run `close` (the old client's close coroutine) on its own loop if that's still running
+    in another thread, otherwise on the running one. Errors are only reported: a client
+    whose loop is gone can't always be closed cleanly.
+    """
+    running = asyncio.get_running_loop()
+    if loop is not None and loop is not running and loop.is_running():
+        asyncio.run_coroutine_threadsafe(close, loop)
+        return
+
+    task = running.create_task(close)
+    _closing.add(task)
+    task.add_done_callback(_closed)
+
+
+def _closed(task: asyncio.Task):
+    _closing.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Closing a client of an old event loop failed: {task.exception()!r}")
+
+
+def test_close_stale():
+    client = None
+
+    async def first():
+        nonlocal client
+        client = httpx.AsyncClient()
+        return asyncio.get_running_loop()
+
+    async def second(loop):
+        close_stale(client.aclose(), loop)
+        await asyncio.sleep(0)
+        await asyncio.gather(*_closing)
+
+    old_loop = asyncio.run(first())
+    asyncio.run(second(old_loop))
+    assert client.is_closed
@@ -0,0 +1,195 @@
+"""
+Speculative prefetch for follow_links: while jobs_status of a page is in flight, the most
+likely careers links on it are already fetched. If the verdict is "Link to jobs" to one of
+them, the next page is ready; the others are cancelled.
+
+Prefetches that aren't used are wasted scrapes, so after a warmup prefetching pauses when
+too many of the recent ones are.
+"""
+
+import asyncio
+import re
+import time
+from collections import Counter, deque
+from urllib.parse import urlsplit
+
+import pytest
+
+from .cache import canonical_url
+
+pytest_plugins = ("pytest_asyncio",)
+
+
+# Candidate links fetched per page
+PREFETCH_LINKS = 2
+# Prefetching pauses while more than this share of the prefetches is wasted...
+PREFETCH_MAX_WASTE = 0.7
+# ...counted after this many
+PREFETCH_WARMUP = 20
+# ...of those that ended in the last so many seconds
+PREFETCH_WINDOW = 600
+
+_MD_LINK = re.compile(r"(?<!!)\[([^\]]*)\]\(<?([^)\s>]+)")
+_CAREER_TEXT = re.compile(
+    r"career|\bjobs?\b|join (?:us|our team|the team)|work (?:with|for|at) us|hiring"
+    r"|vacanc|open (?:positions|roles)|openings|karriere|stellen",
+    re.IGNORECASE,
+)
+_CAREER_PATH = re.compile(
+    r"career|\bjobs?\b|join|hiring|vacanc|openings|positions|karriere", re.IGNORECASE
+)
+_ATS_HOST = re.compile(
+    r"greenhouse\.io|lever\.co|ashbyhq\.com|workable\.com|recruitee\.com|personio\."
+    r"|bamboohr\.com|smartrecruiters\.com|teamtailor\.com|join\.com",
+    re.IGNORECASE,
+)
+_SKIP = re.compile(
+    r"^(?:mailto:|tel:|javascript:|#)|\.(?:png|jpe?g|gif|svg|webp|pdf)$", re.IGNORECASE
+)
+
+# Totals of the process, for reporting
+prefetch_stats = Counter()
+# (time.monotonic(), wasted) of the prefetches that ended recently, for _wasteful
+_outcomes = deque(maxlen=1000)
+
+
+def career_links(md: str, limit=PREFETCH_LINKS) -> list[str]:
+    """
+    The links (as written in the page) most likely to lead to the jobs, best first.
+    """
+    scores = {}
+    for text, href in _MD_LINK.findall(md):
+        if _SKIP.search(href):
+            continue
+        parts = urlsplit(href)
+        score = (
+            2 * bool(_CAREER_TEXT.search(text))
+            + bool(_CAREER_PATH.search(parts.path))
+            + 2 * bool(_ATS_HOST.search(parts.netloc))
+        )
+        if score:
+            scores[href] = max(scores.get(href, 0), score)
+    # sorted is stable, so ties keep their order on the page
+    return sorted(scores, key=lambda href: -scores[href])[:limit]
+
+
+def test_career_links():
+    md = """
+[Home](/) [About](/about) [Blog](/blog/jobs-to-be-done)
+![careers](/img/careers.png)
+[Careers](/careers) [Contact](mailto:jobs@acme.com)
+[We're hiring!](https://boards.greenhouse.io/acme)
+"""
+    assert career_links(md) == ["https://boards.greenhouse.io/acme", "/careers"]
+    assert career_links("[Home](/) [About](/about)") == []
+
+
+def _ended(wasted: bool):
+    prefetch_stats["wasted" if wasted else "used"] += 1
+    _outcomes.append((time.monotonic(), wasted))
+
+
+def _wasteful() -> bool:
+    # only the recent prefetches count: while it's paused nothing new ends, so the old
+    # ones have to age out for prefetching to be tried again
+    cutoff = time.monotonic() - PREFETCH_WINDOW
+    while _outcomes and _outcomes[0][0] < cutoff:
+        _outcomes.popleft()
+    wasted = sum(wasted for _, wasted in _outcomes)
+    return len(_outcomes) >= PREFETCH_WARMUP and wasted > PREFETCH_MAX_WASTE * len(
+        _outcomes
+    )
+
+
+def _retrieve(task: asyncio.Task):
+    # failed prefetches are only reported when they're used
+    if not task.cancelled():
+        task.exception()
+
+
+class Prefetcher:
+    """
+    Pages of one company, fetched with `fetch(url)` either ahead of time (start) or when
+    they're asked for.
+    """
+
+    def __init__(self, fetch, speculative=True):
+        self._fetch = fetch
+        self.speculative = speculative
+        self._tasks = {}
+
+    def start(self, urls: list[str]):
+        if not self.speculative or _wasteful():
+            return
+        for url in urls:
+            key = canonical_url(url)
+            if key not in self._tasks:
+                task = asyncio.create_task(self._fetch(url))
+                task.add_done_callback(_retrieve)
+                self._tasks[key] = task
+                prefetch_stats["started"] += 1
+
+    async def fetch(self, url: str):
+        task = self._tasks.pop(canonical_url(url), None)
+        if task is None:
+            return await self._fetch(url)
+        _ended(wasted=False)
+        return await task
+
+    def keep(self, url: str | None):
+        """
+        The verdict of a page is in: cancels its prefetches except the one of `url`, the
+        link that's followed next (if any).
+        """
+        key = None if url is None else canonical_url(url)
+        for other, task in list(self._tasks.items()):
+            if other != key:
+                task.cancel()
+                _ended(wasted=True)
+                del self._tasks[other]
+
+    def discard(self):
+        """
+        Cancels the prefetches that weren't used.
+        """
+        self.keep(None)
+
+
+@pytest.mark.asyncio
+async def test_prefetcher(monkeypatch):
+    monkeypatch.setattr("jobsfinder.prefetch.prefetch_stats", Counter())
+    monkeypatch.setattr("jobsfinder.prefetch._outcomes", deque())
+    fetched = []
+
+    async def fetch(url):
+        fetched.append(url)
+        await asyncio.sleep(0)
+        return f"md of {url}"
+
+    pages = Prefetcher(fetch)
+    pages.start(["https://acme.com/careers", "https://acme.com/jobs"])
+    assert await pages.fetch("http://www.acme.com/careers/") == (
+        "md of https://acme.com/careers"
+    )
+    pages.discard()
+    assert await pages.fetch("https://acme.com/about") == "md of https://acme.com/about"
+    assert prefetch_stats == {"started": 2, "used": 1, "wasted": 1}
+
+    # only the followed link survives the verdict
+    pages.start(["https://acme.com/careers", "https://acme.com/jobs"])
+    pages.keep("https://acme.com/jobs")
+    assert list(pages._tasks) == [canonical_url("https://acme.com/jobs")]
+    pages.discard()
+    assert prefetch_stats["wasted"] == 3
+
+    # too much recent waste, no more prefetching
+    _outcomes.extend([(time.monotonic(), True)] * PREFETCH_WARMUP)
+    pages.start(["https://acme.com/team"])
+    assert "https://acme.com/team" not in fetched
+
+    # until it's old
+    _outcomes.clear()
+    _outcomes.extend([(time.monotonic() - PREFETCH_WINDOW - 1, True)] * PREFETCH_WARMUP)
+    pages.start(["https://acme.com/team"])
+    pages.discard()
+    assert prefetch_stats["started"] == 5
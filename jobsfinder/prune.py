@@ -0,0 +1,165 @@
+"""
+Prune page markdown down to a token budget before it goes to the classifiers. Nav menus,
+cookie banners, footers and repeated link lists make up a lot of the input tokens, while
+what we actually need are the career / job sections and links.
+"""
+
+import re
+from collections import Counter
+from dataclasses import dataclass
+
+PRUNE_TOKEN_BUDGET = 3000
+
+# No tokenizer dependency; ~4 characters per token is close enough for English pages
+CHARS_PER_TOKEN = 4
+
+CAREER_WORDS = re.compile(
+    r"career|\bjobs?\b|hiring|vacanc|open (?:positions|roles)|openings|join (?:us|our team)"
+    r"|work (?:with|for|at) us|\bapply\b|recruit|talent"
+    r"|greenhouse\.io|lever\.co|ashbyhq|workable|bamboohr|smartrecruiters|jobvite"
+    r"|recruitee|personio|teamtailor|breezy\.hr|workday",
+    re.IGNORECASE,
+)
+# Where the careers link often lives, the classifier needs to see these too
+COMPANY_WORDS = re.compile(
+    r"\babout\b|\bcompany\b|\bteam\b|\bpeople\b|culture|who we are", re.IGNORECASE
+)
+BOILERPLATE_WORDS = re.compile(
+    r"cookie|privacy (?:policy|notice)|terms (?:of|&|and) (?:use|service)|all rights reserved"
+    r"|©|\(c\) \d{4}|newsletter|subscribe|gdpr|consent",
+    re.IGNORECASE,
+)
+
+_LINK = re.compile(r"!?\[([^\]]*)\]\(([^)\s]*)[^)]*\)")
+_EMPTY_IMAGE = re.compile(r"!\[\]\(\)")
+# Links are mostly nav when they make up this much of a block
+LINK_HEAVY = 0.6
+
+prune_stats = Counter()
+
+
+def count_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+@dataclass
+class Pruned:
+    md: str
+    tokens_before: int
+    tokens_after: int
+
+    @property
+    def saved(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+
+def _relevant_links(block: str) -> str:
+    """
+    Only the links of a nav-like block that can lead to jobs.
+    """
+    links = []
+    for match in _LINK.finditer(_EMPTY_IMAGE.sub("", block)):
+        text, href = match.group(1), match.group(2)
+        target = f"{text} {href}"
+        if CAREER_WORDS.search(target) or COMPANY_WORDS.search(target):
+            links.append(f"[{text}]({href})")
+    return " ".join(dict.fromkeys(links))
+
+
+def _score(i: int, block: str) -> tuple[int, str]:
+    """
+    Priority of a block (higher is kept first), and the text to keep for it.
+    """
+    if i == 0:
+        return 3, block
+
+    link_chars = sum(len(m.group(0)) for m in _LINK.finditer(block))
+    if link_chars / max(len(block), 1) > LINK_HEAVY:
+        links = _relevant_links(block)
+        return (3 if CAREER_WORDS.search(links) else 2 if links else 0), links
+
+    if CAREER_WORDS.search(block):
+        return 3, block
+
+    if BOILERPLATE_WORDS.search(block):
+        return 0, block
+
+    return 2, block
+
+
+def prune_markdown(md: str, budget=PRUNE_TOKEN_BUDGET) -> Pruned:
+    """
+    Drop duplicate, boilerplate and nav blocks, keeping career related ones first, until
+    the page fits in `budget` tokens. Pages that already fit are left alone.
+    """
+    before = count_tokens(md)
+    if before <= budget:
+        prune_stats["pages"] += 1
+        prune_stats["tokens_before"] += before
+        prune_stats["tokens_after"] += before
+        return Pruned(md, before, before)
+
+    seen = set()
+    candidates = []
+    for i, block in enumerate(re.split(r"\n\s*\n", md)):
+        key = block.strip()
+        if not key or key in seen:
+            continue
+        seen.add(key)
+
+        score, text = _score(i, block)
+        if score > 0 and text.strip():
+            candidates.append((score, i, text))
+
+    kept = []
+    used = 0
+    for score, i, text in sorted(candidates, key=lambda c: (-c[0], c[1])):
+        tokens = count_tokens(text) + 1
+        if used + tokens > budget:
+            if score < 3:
+                continue
+            # An important block that doesn't fit: keep what we can of it
+            text = text[: max(0, budget - used - 1) * CHARS_PER_TOKEN]
+            if not text:
+                continue
+            tokens = count_tokens(text) + 1
+        kept.append((i, text))
+        used += tokens
+
+    pruned = "\n\n".join(text for _, text in sorted(kept))
+    after = count_tokens(pruned)
+
+    prune_stats["pages"] += 1
+    prune_stats["pruned"] += 1
+    prune_stats["tokens_before"] += before
+    prune_stats["tokens_after"] += after
+    return Pruned(pruned, before, after)
+
+
+def test_prune_markdown():
+    small = "Acme\n\nWe make rockets. [Careers](/careers)"
+    assert prune_markdown(small).md == small
+
+    nav = "[![]()](/)[Home](/)[Products](/products)[About us](/about)[Blog](/blog)[Login](/login)"
+    filler = "\n\n".join(
+        f"Feature {i}: our platform does thing number {i} really well." * 5
+        for i in range(40)
+    )
+    careers = (
+        "We're hiring! See our [open positions](https://boards.greenhouse.io/acme)."
+    )
+    cookie = "We use cookies to improve your experience. Accept all cookies."
+    footer = "© 2024 Acme Inc. All rights reserved. [Privacy](/privacy) [Terms](/terms)"
+    md = "\n\n".join(
+        ["Acme | Rockets", nav, filler, careers, cookie, filler, footer, nav]
+    )
+
+    result = prune_markdown(md, budget=500)
+    assert result.tokens_before > 500 >= result.tokens_after
+    assert result.saved > 0
+    assert result.md.startswith("Acme | Rockets")
+    assert "https://boards.greenhouse.io/acme" in result.md
+    assert "[About us](/about)" in result.md
+    assert "[Blog](/blog)" not in result.md
+    assert "cookies" not in result.md
+    assert "All rights reserved" not in result.md
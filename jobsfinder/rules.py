@@ -0,0 +1,142 @@
+"""
+Rule based fast path for the obviously invalid websites (expired / parked domains, error
+pages, bot walls, cookie walls), so they don't need an LLM call. The rules only fire on
+short pages, since a real site can mention "404" or "cookies" too.
+
+scripts/eval_rules.py reports their coverage and precision.
+"""
+
+import re
+from collections import Counter
+from dataclasses import dataclass
+
+# Fewer words than this and there's nothing to classify
+MIN_WORDS = 5
+# Only look at the start of the page
+HEAD_CHARS = 3000
+
+_MD_LINK_TARGET = re.compile(r"\]\([^)]*\)")
+_WORDS = re.compile(r"\w+")
+
+
+@dataclass(frozen=True)
+class Rule:
+    name: str
+    pattern: re.Pattern
+    # Longer pages than this are left to the classifiers
+    max_words: int
+
+
+RULES = [
+    Rule(
+        "expired",
+        re.compile(
+            r"website expired|(?:account|site|domain|subscription) (?:has )?"
+            r"(?:expired|been suspended|is suspended)|account suspended",
+            re.IGNORECASE,
+        ),
+        150,
+    ),
+    Rule(
+        "parked domain",
+        re.compile(
+            r"domain (?:name )?(?:is |may be )?for sale|buy this domain"
+            r"|(?:parked|hosted) (?:free )?(?:by|courtesy of|domain)|domain parking",
+            re.IGNORECASE,
+        ),
+        300,
+    ),
+    Rule(
+        "http error",
+        re.compile(
+            r"\b(?:40[0134]|50[0234])\b.{0,5}(?:page )?(?:not found|forbidden|error"
+            r"|bad gateway|service unavailable|gateway time-?out|unauthorized)"
+            r"|page not found|internal server error|bad gateway|service unavailable"
+            r"|page you (?:are|were) looking for (?:doesn.t|does not|might|may|could)"
+            r"|(?:don.t|do not) have permission to access",
+            re.IGNORECASE,
+        ),
+        150,
+    ),
+    Rule(
+        "bot wall",
+        re.compile(
+            r"attention required|just a moment\.\.\.|checking (?:if the site connection"
+            r"|your browser)|verify (?:that )?you(?:.re| are) (?:a )?human"
+            r"|prove (?:that )?you.re (?:a )?human|complete the captcha"
+            r"|enable javascript and cookies to continue",
+            re.IGNORECASE,
+        ),
+        150,
+    ),
+    Rule(
+        "connection error",
+        re.compile(
+            r"connection timed out|took too long to respond|connection is not private"
+            r"|(?:site|page) can.t be reached|err_[a-z_]+",
+            re.IGNORECASE,
+        ),
+        150,
+    ),
+    Rule(
+        "invalid link",
+        re.compile(
+            r"invite (?:is )?invalid|(?:link|invite) (?:is |has |may be )?"
+            r"(?:invalid|expired)",
+            re.IGNORECASE,
+        ),
+        150,
+    ),
+    # Pages that are only a cookie banner or a spinner
+    Rule(
+        "cookie wall",
+        re.compile(
+            r"accept (?:all |our )?(?:use of )?cookies|cookie consent", re.IGNORECASE
+        ),
+        60,
+    ),
+    Rule(
+        "loading",
+        re.compile(r"page is loading|^\W*loading\W*$", re.IGNORECASE | re.MULTILINE),
+        60,
+    ),
+]
+
+rule_stats = Counter()
+
+
+def invalid_reason(md: str) -> str | None:
+    """
+    Why the page is obviously invalid, or None if it needs a real classification.
+    """
+    text = _MD_LINK_TARGET.sub("]", md)
+    words = len(_WORDS.findall(text))
+    head = text[:HEAD_CHARS]
+
+    reason = "empty" if words < MIN_WORDS else None
+    for rule in RULES:
+        if reason is not None:
+            break
+        if words <= rule.max_words and rule.pattern.search(head):
+            reason = rule.name
+
+    rule_stats["pages"] += 1
+    if reason is not None:
+        rule_stats[reason] += 1
+    return reason
+
+
+def test_invalid_reason():
+    assert invalid_reason("Website Expired\n\nThis account has expired.") == "expired"
+    assert invalid_reason("# 404\n\nThe page you are looking for doesn't exist.") == (
+        "http error"
+    )
+    assert invalid_reason("Just a moment...\n\nChecking your browser") == "bot wall"
+    assert invalid_reason("acme.com is for sale! Buy this domain.") == "parked domain"
+    assert invalid_reason("Loading...") == "empty"
+
+    # Real pages can mention these too
+    rockets = "We make rockets and ship them to the moon. " * 20
+    assert invalid_reason("Acme | Rockets\n\n" + rockets) is None
+    assert invalid_reason("Acme\n\nWe accept cookies. " + rockets) is None
+    assert invalid_reason("# 404 error\n\n" + rockets * 2) is None
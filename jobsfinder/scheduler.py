@@ -0,0 +1,222 @@
+"""
+Per host politeness for crawling. `limit_parallel` only has a global limit, so a batch of
+companies that all link to the same ATS host ends up hammering that one host.
+"""
+
+import asyncio
+import time
+from collections import Counter, defaultdict, deque
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+
+import pytest
+import tqdm
+
+pytest_plugins = ("pytest_asyncio",)
+
+
+PER_HOST_LIMIT = 2
+MIN_HOST_INTERVAL = 0.5
+
+
+def host_of(url: str) -> str:
+    host = (urlsplit(url.strip()).hostname or "").lower()
+    return host.removeprefix("www.")
+
+
+def test_host_of():
+    assert host_of("https://www.Acme.com/jobs") == "acme.com"
+    assert host_of("https://boards.greenhouse.io/acme") == "boards.greenhouse.io"
+
+
+def _decrement(counter: Counter, key):
+    counter[key] -= 1
+    if counter[key] <= 0:
+        del counter[key]
+
+
+class CrawlScheduler:
+    """
+    Two levels:
+    - `slot(url)`: every request waits for its host to have a free slot (at most `per_host`
+      at once, and at least `min_interval` seconds between starts).
+    - `run(jobs, n)`: like limit_parallel for (url, coroutine) jobs, but never gives more
+      than `per_host` of the `n` global slots to one host, so the others stay busy.
+    """
+
+    def __init__(self, per_host=PER_HOST_LIMIT, min_interval=MIN_HOST_INTERVAL):
+        self.per_host = per_host
+        self.min_interval = min_interval
+
+        self.queued = Counter()
+        self.waiting = Counter()
+        self.active = Counter()
+
+        self._next_start = {}
+        self._cond = None
+        self._cond_loop = None
+
+    def _condition(self) -> asyncio.Condition:
+        # Conditions are bound to a loop, and scripts / tests use a fresh loop per run
+        loop = asyncio.get_running_loop()
+        if self._cond is None or self._cond_loop is not loop:
+            self._cond = asyncio.Condition()
+            self._cond_loop = loop
+        return self._cond
+
+    def _wait_time(self, host: str) -> float | None:
+        """
+        0 if the host is free now, the seconds left if only the spacing is in the way,
+        None if it's at its concurrency limit.
+        """
+        if self.active[host] >= self.per_host:
+            return None
+        return max(0.0, self._next_start.get(host, 0) - time.monotonic())
+
+    @asynccontextmanager
+    async def slot(self, url: str):
+        host = host_of(url)
+        cond = self._condition()
+
+        self.waiting[host] += 1
+        try:
+            async with cond:
+                while (wait := self._wait_time(host)) != 0:
+                    try:
+                        await asyncio.wait_for(cond.wait(), timeout=wait)
+                    except asyncio.TimeoutError:
+                        pass
+                self.active[host] += 1
+                self._next_start[host] = time.monotonic() + self.min_interval
+        finally:
+            _decrement(self.waiting, host)
+
+        try:
+            yield
+        finally:
+            _decrement(self.active, host)
+            async with cond:
+                cond.notify_all()
+
+    async def run(self, jobs, n=5, show_progress=True):
+        """
+        Run (url, coroutine) jobs, up to n at a time, round robin between hosts.
+
+        :return: List of results, in the order of the jobs.
+        """
+        jobs = list(jobs)
+        results = [None] * len(jobs)
+
+        pending = defaultdict(deque)
+        for i, (url, coro) in enumerate(jobs):
+            host = host_of(url)
+            pending[host].append((i, coro))
+            self.queued[host] += 1
+
+        hosts = deque(pending)
+        running = {}
+        in_flight = Counter()
+        progress = tqdm.tqdm(total=len(jobs), disable=not show_progress)
+
+        def start_next() -> bool:
+            for _ in range(len(hosts)):
+                host = hosts[0]
+                hosts.rotate(-1)
+                if in_flight[host] >= self.per_host:
+                    continue
+
+                i, coro = pending[host].popleft()
+                if not pending[host]:
+                    del pending[host]
+                    hosts.remove(host)
+                _decrement(self.queued, host)
+
+                running[asyncio.ensure_future(coro)] = (i, host)
+                in_flight[host] += 1
+                return True
+            return False
+
+        try:
+            while pending or running:
+                while len(running) < n and start_next():
+                    pass
+
+                done, _ = await asyncio.wait(
+                    running, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    i, host = running.pop(task)
+                    in_flight[host] -= 1
+                    results[i] = task.result()
+                    progress.update()
+
+                busiest = next(iter(self.queue_depths().items()), None)
+                if busiest is not None:
+                    progress.set_postfix_str(f"busiest host: {busiest[0]} {busiest[1]}")
+        finally:
+            progress.close()
+            for task in running:
+                task.cancel()
+            for host, queue in pending.items():
+                for _, coro in queue:
+                    coro.close()
+                    _decrement(self.queued, host)
+
+        return results
+
+    def queue_depths(self) -> dict:
+        """
+        Per host: jobs not started yet, requests waiting for a slot, requests in flight.
+        Busiest hosts first.
+        """
+        hosts = set(self.queued) | set(self.waiting) | set(self.active)
+        return {
+            host: {
+                "queued": self.queued[host],
+                "waiting": self.waiting[host],
+                "active": self.active[host],
+            }
+            for host in sorted(
+                hosts,
+                key=lambda h: -(self.queued[h] + self.waiting[h] + self.active[h]),
+            )
+        }
+
+
+@pytest.mark.asyncio
+async def test_crawl_scheduler_spreads_hosts():
+    scheduler = CrawlScheduler(per_host=1, min_interval=0)
+    started = []
+    peak = Counter()
+
+    async def job(url):
+        async with scheduler.slot(url):
+            started.append(host_of(url))
+            peak[host_of(url)] = max(peak[host_of(url)], scheduler.active[host_of(url)])
+            await asyncio.sleep(0.01)
+            return url
+
+    urls = [f"https://ats.com/{i}" for i in range(4)] + [
+        "https://a.com",
+        "https://b.com",
+    ]
+    results = await scheduler.run([(url, job(url)) for url in urls], n=3)
+
+    assert results == urls
+    assert started[:3] == ["ats.com", "a.com", "b.com"]
+    assert max(peak.values()) == 1
+    assert scheduler.queue_depths() == {}
+
+
+@pytest.mark.asyncio
+async def test_crawl_scheduler_spacing():
+    scheduler = CrawlScheduler(per_host=5, min_interval=0.05)
+    starts = []
+
+    async def job():
+        async with scheduler.slot("https://ats.com/jobs"):
+            starts.append(time.monotonic())
+
+    await asyncio.gather(job(), job(), job())
+    assert starts[1] - starts[0] >= 0.045
+    assert starts[2] - starts[1] >= 0.045
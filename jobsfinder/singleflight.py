@@ -0,0 +1,123 @@
+"""
+Single-flight for concurrent identical work: while a scrape of a URL (or an LLM call with
+the same prompt) is in flight, other callers with the same key wait for that one instead
+of starting their own. Nothing is kept once it's done, that's what the caches are for.
+
+A call runs as long as someone waits for it: when the last waiter is cancelled (e.g. a
+discarded prefetch), so is the call.
+"""
+
+import asyncio
+from collections import Counter
+
+import pytest
+
+pytest_plugins = ("pytest_asyncio",)
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls: dict[object, asyncio.Task] = {}
+        self._waiters: Counter = Counter()
+        self.stats = Counter()
+
+    async def do(self, key, make_call):
+        """
+        Result of `make_call()`, or of the call already running for `key`. Errors are
+        shared too.
+
+        :param make_call: Returns the coroutine to run, only called when nothing is
+            running for `key` yet.
+        """
+        loop = asyncio.get_running_loop()
+        task = self._calls.get(key)
+        # a task of another (finished) event loop can't be awaited here
+        if task is None or task.done() or task.get_loop() is not loop:
+            task = loop.create_task(make_call())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self.stats["calls"] += 1
+        else:
+            self.stats["shared"] += 1
+
+        # one caller giving up (cancelled) doesn't cancel the call for the others...
+        self._waiters[task] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+                # ...but the last one does
+                if not task.done():
+                    task.cancel()
+                    self._forget(key, task)
+                    self.stats["cancelled"] += 1
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # the waiters get the error, don't warn about it
+        if task.done() and not task.cancelled():
+            task.exception()
+
+
+@pytest.mark.asyncio
+async def test_single_flight():
+    flights = SingleFlight()
+    started = []
+
+    async def work(x):
+        started.append(x)
+        await asyncio.sleep(0.01)
+        return x * 2
+
+    results = await asyncio.gather(
+        *[flights.do(x % 2, lambda x=x: work(x)) for x in range(6)]
+    )
+    # 0, 2, 4 share the call of 0, and 1, 3, 5 the one of 1
+    assert results == [0, 2, 0, 2, 0, 2]
+    assert started == [0, 1]
+    assert flights.stats == {"calls": 2, "shared": 4}
+
+    # done calls aren't kept
+    assert await flights.do(0, lambda: work(10)) == 20
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    outcomes = await asyncio.gather(
+        flights.do("x", fail), flights.do("x", fail), return_exceptions=True
+    )
+    assert [type(e) for e in outcomes] == [ValueError, ValueError]
+
+
+@pytest.mark.asyncio
+async def test_single_flight_cancel():
+    flights = SingleFlight()
+    finished = []
+
+    async def work():
+        await asyncio.sleep(0.02)
+        finished.append(True)
+        return "done"
+
+    # one waiter leaving doesn't stop the call for the other
+    first = asyncio.create_task(flights.do("x", work))
+    second = asyncio.create_task(flights.do("x", work))
+    await asyncio.sleep(0)
+    first.cancel()
+    assert await second == "done"
+    assert finished == [True]
+
+    # the last one does
+    only = asyncio.create_task(flights.do("y", work))
+    await asyncio.sleep(0)
+    only.cancel()
+    await asyncio.sleep(0.03)
+    assert finished == [True]
+    assert flights.stats["cancelled"] == 1
+
+    # and the next caller starts a new call
+    assert await flights.do("y", work) == "done"
@@ -0,0 +1,142 @@
+"""
+Job data that's already structured in the raw HTML, and gets lost in html2md: schema.org
+JobPosting blocks (JSON-LD), and ATS boards embedded with an iframe or a script tag. When
+a page has either, it doesn't need a jobs_status call.
+
+Like fetch.py this works on regexes over the raw HTML, no full parse.
+"""
+
+import html as html_lib
+import json
+import re
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import date
+
+from .ats import find_adapter
+
+_JSON_LD = re.compile(
+    r"<script\b[^>]*\btype=[\"']?application/ld\+json[\"']?[^>]*>(.*?)</script\s*>",
+    re.IGNORECASE | re.DOTALL,
+)
+_EMBED_SRC = re.compile(
+    r"<(?:iframe|script)\b[^>]*?\bsrc=[\"']([^\"']+)[\"']", re.IGNORECASE
+)
+
+structured_stats = Counter()
+
+
+@dataclass
+class StructuredJobs:
+    titles: list[str] = field(default_factory=list)
+    # Embedded ATS board, see ats.py
+    board: str | None = None
+
+
+def _nodes(data):
+    """
+    All the JSON-LD objects in a block (lists, @graph and nested values included).
+    """
+    if isinstance(data, list):
+        for item in data:
+            yield from _nodes(item)
+    elif isinstance(data, dict):
+        yield data
+        for value in data.values():
+            if isinstance(value, (list, dict)):
+                yield from _nodes(value)
+
+
+def _is_posting(node: dict) -> bool:
+    types = node.get("@type")
+    types = types if isinstance(types, list) else [types]
+    return "JobPosting" in types
+
+
+def _expired(node: dict) -> bool:
+    valid_through = node.get("validThrough")
+    if not isinstance(valid_through, str):
+        return False
+    try:
+        return date.fromisoformat(valid_through[:10]) < date.today()
+    except ValueError:
+        return False
+
+
+def job_posting_titles(html: str) -> list[str]:
+    titles = []
+    for block in _JSON_LD.findall(html):
+        try:
+            data = json.loads(html_lib.unescape(block.strip()), strict=False)
+        except ValueError:
+            continue
+        for node in _nodes(data):
+            title = node.get("title") or node.get("name")
+            if _is_posting(node) and isinstance(title, str) and not _expired(node):
+                title = html_lib.unescape(title).strip()
+                if title and title not in titles:
+                    titles.append(title)
+    return titles
+
+
+def embedded_board(html: str) -> str | None:
+    for src in _EMBED_SRC.findall(html):
+        src = html_lib.unescape(src).strip()
+        if src.startswith("//"):
+            src = "https:" + src
+        if find_adapter(src) is not None:
+            return src
+    return None
+
+
+def structured_jobs(html: str | None) -> StructuredJobs | None:
+    """
+    The job titles / embedded board of a page, or None if it has neither.
+    """
+    if not html:
+        return None
+
+    found = StructuredJobs(job_posting_titles(html), embedded_board(html))
+    structured_stats["pages"] += 1
+    if found.titles:
+        structured_stats["job postings"] += 1
+    elif found.board:
+        structured_stats["embedded board"] += 1
+    else:
+        return None
+    return found
+
+
+def test_structured_jobs():
+    posting = {
+        "@context": "https://schema.org/",
+        "@type": "JobPosting",
+        "title": "Account Executive",
+        "hiringOrganization": {"@type": "Organization", "name": "Acme"},
+    }
+    expired = {**posting, "title": "Old Job", "validThrough": "2001-01-01T00:00"}
+    graph = {
+        "@context": "https://schema.org",
+        "@graph": [{"@type": "WebPage"}, posting],
+    }
+    page = f"""
+<html><head>
+<script type="application/ld+json">{json.dumps(graph)}</script>
+<script type="application/ld+json">{json.dumps([expired, {**posting, "title": "SDR"}])}</script>
+<script type="application/ld+json">{{ not json </script>
+</head><body><h1>Careers</h1></body></html>
+"""
+    assert structured_jobs(page).titles == ["Account Executive", "SDR"]
+
+    embed = """
+<div id="grnhse_app"></div>
+<script src="https://www.googletagmanager.com/gtag/js?id=G-1"></script>
+<script src="https://boards.greenhouse.io/embed/job_board/js?for=acme&amp;b=1"></script>
+"""
+    found = structured_jobs(embed)
+    assert found.titles == []
+    assert found.board == "https://boards.greenhouse.io/embed/job_board/js?for=acme&b=1"
+
+    assert structured_jobs('<iframe src="//jobs.ashbyhq.com/acme/embed"></iframe>')
+    assert structured_jobs("<html><body>We make rockets</body></html>") is None
+    assert structured_jobs(None) is None
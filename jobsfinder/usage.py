@@ -0,0 +1,386 @@
+"""
+Usage ledger for the LLM calls: one small row per call (tokens, cost, latency, model,
+stage, caller) in SQLite, plus hourly totals per stage so cost queries don't read every
+call. Rows are written in batches by a background thread, so recording a call doesn't
+block the event loop. Prompt bodies optionally go to a separate store.
+"""
+
+import atexit
+import contextvars
+import hashlib
+import queue
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+
+import pytest
+
+# The writer thread writes once it has this many rows, or after this many seconds
+USAGE_FLUSH_EVERY = 100
+USAGE_FLUSH_SECONDS = 1.0
+# Granularity of the totals, so of the time windows in cost()
+BUCKET_SECONDS = 3600
+
+_stage = contextvars.ContextVar("usage_stage", default=None)
+
+_STOP = None
+
+
+def set_stage(name: str):
+    """
+    Name the calls that follow get recorded under. Defaults to the running script.
+    """
+    _stage.set(name)
+
+
+def current_stage() -> str:
+    return _stage.get() or Path(sys.argv[0]).stem or "interactive"
+
+
+@dataclass
+class UsageRecord:
+    stage: str
+    caller: str
+    model: str
+    prompt_tokens: int
+    completion_tokens: int
+    cost: float
+    latency: float | None = None
+    attempt: int = 0
+    batch: bool = False
+    system_msg: str | None = None
+    user_msg: str | None = None
+    ts: float = 0.0
+
+    def __post_init__(self):
+        self.ts = self.ts or time.time()
+
+
+def _connect(path: Path) -> sqlite3.Connection:
+    db = sqlite3.connect(path, timeout=30, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    return db
+
+
+class UsageLedger:
+    """
+    :param prompts_path: Where to keep the prompt bodies (compressed, each distinct one
+        stored once). None to not keep them.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS calls (
+            ts REAL NOT NULL,
+            stage TEXT NOT NULL,
+            caller TEXT NOT NULL,
+            model TEXT NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            cost REAL NOT NULL,
+            latency REAL,
+            attempt INTEGER NOT NULL,
+            batch INTEGER NOT NULL,
+            system_hash TEXT,
+            user_hash TEXT
+        );
+        CREATE INDEX IF NOT EXISTS calls_ts ON calls (ts);
+        CREATE TABLE IF NOT EXISTS totals (
+            stage TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            calls INTEGER NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            cost REAL NOT NULL,
+            PRIMARY KEY (stage, bucket)
+        );
+    """
+    PROMPTS_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS prompts (
+            hash TEXT PRIMARY KEY,
+            text BLOB NOT NULL
+        );
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        prompts_path: Path | None = None,
+        flush_every=USAGE_FLUSH_EVERY,
+        flush_seconds=USAGE_FLUSH_SECONDS,
+    ):
+        self.path = path
+        self.prompts_path = prompts_path
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+
+        # This process only, the database has everything
+        self.session = Counter()
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._db = None
+        atexit.register(self.close)
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = _connect(self.path)
+            self._db.executescript(self.SCHEMA)
+        return self._db
+
+    def record(self, record: UsageRecord):
+        """
+        Cheap: the row is written later, by the writer thread.
+        """
+        self.session["calls"] += 1
+        self.session["prompt_tokens"] += record.prompt_tokens
+        self.session["completion_tokens"] += record.completion_tokens
+        self.session["cost"] += record.cost
+
+        self._start()
+        self._queue.put(record)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="usage-ledger", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        db = _connect(self.path)
+        db.executescript(self.SCHEMA)
+        prompts_db = None
+        if self.prompts_path is not None:
+            prompts_db = _connect(self.prompts_path)
+            prompts_db.executescript(self.PROMPTS_SCHEMA)
+
+        stop = False
+        while not stop:
+            records = []
+            deadline = time.monotonic() + self.flush_seconds
+            while len(records) < self.flush_every:
+                try:
+                    item = self._queue.get(
+                        timeout=max(0.0, deadline - time.monotonic())
+                    )
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    self._queue.task_done()
+                    break
+                records.append(item)
+
+            if not records:
+                continue
+            try:
+                self._write(db, prompts_db, records)
+            except Exception as e:
+                print(f"Usage ledger: couldn't write {len(records)} rows: {e}")
+                if db.in_transaction:
+                    db.execute("ROLLBACK")
+            finally:
+                for _ in records:
+                    self._queue.task_done()
+
+        db.close()
+        if prompts_db is not None:
+            prompts_db.close()
+
+    def _write(self, db, prompts_db, records: list[UsageRecord]):
+        rows = []
+        prompts = {}
+        totals = {}
+        for r in records:
+            hashes = [None, None]
+            if prompts_db is not None:
+                for i, text in enumerate([r.system_msg, r.user_msg]):
+                    if text is not None:
+                        data = text.encode("utf-8")
+                        hashes[i] = hashlib.sha256(data).hexdigest()
+                        prompts[hashes[i]] = data
+
+            rows.append(
+                (
+                    r.ts,
+                    r.stage,
+                    r.caller,
+                    r.model,
+                    r.prompt_tokens,
+                    r.completion_tokens,
+                    r.cost,
+                    r.latency,
+                    r.attempt,
+                    int(r.batch),
+                    *hashes,
+                )
+            )
+
+            total = totals.setdefault(
+                (r.stage, int(r.ts // BUCKET_SECONDS)), [0, 0, 0, 0.0]
+            )
+            total[0] += 1
+            total[1] += r.prompt_tokens
+            total[2] += r.completion_tokens
+            total[3] += r.cost
+
+        if prompts:
+            prompts_db.executemany(
+                "INSERT OR IGNORE INTO prompts (hash, text) VALUES (?, ?)",
+                [(h, zlib.compress(data)) for h, data in prompts.items()],
+            )
+
+        db.execute("BEGIN")
+        db.executemany(
+            "INSERT INTO calls VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+        )
+        db.executemany(
+            """
+            INSERT INTO totals VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (stage, bucket) DO UPDATE SET
+                calls = calls + excluded.calls,
+                prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                completion_tokens = completion_tokens + excluded.completion_tokens,
+                cost = cost + excluded.cost
+            """,
+            [(stage, bucket, *total) for (stage, bucket), total in totals.items()],
+        )
+        db.execute("COMMIT")
+
+    def flush(self):
+        """
+        Wait until everything recorded so far is written.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.join()
+
+    def _totals(self, stage=None, since=None, until=None) -> tuple:
+        """
+        Sum of the hourly totals, so the time window is rounded out to whole hours.
+        """
+        self.flush()
+        query = """
+            SELECT COALESCE(SUM(calls), 0), COALESCE(SUM(prompt_tokens), 0),
+                   COALESCE(SUM(completion_tokens), 0), COALESCE(SUM(cost), 0)
+            FROM totals WHERE 1
+        """
+        params = []
+        if stage is not None:
+            query += " AND stage = ?"
+            params.append(stage)
+        if since is not None:
+            query += " AND bucket >= ?"
+            params.append(int(since // BUCKET_SECONDS))
+        if until is not None:
+            query += " AND bucket <= ?"
+            params.append(int(until // BUCKET_SECONDS))
+        return self.db.execute(query, params).fetchone()
+
+    def cost(self, stage=None, since=None, until=None) -> float:
+        """
+        :param since: / until: Unix timestamps.
+        """
+        return self._totals(stage, since, until)[3]
+
+    def summary(self, since=None, until=None) -> dict:
+        """
+        {stage: {calls, prompt_tokens, completion_tokens, cost}}
+        """
+        self.flush()
+        stages = [
+            row[0] for row in self.db.execute("SELECT DISTINCT stage FROM totals")
+        ]
+        result = {}
+        for stage in stages:
+            calls, prompt_tokens, completion_tokens, cost = self._totals(
+                stage, since, until
+            )
+            if calls:
+                result[stage] = {
+                    "calls": calls,
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "cost": cost,
+                }
+        return result
+
+    def prompt(self, digest: str) -> str | None:
+        """
+        A prompt body from the prompt store, by the hash in calls.system_hash / user_hash.
+        """
+        if self.prompts_path is None:
+            return None
+        self.flush()
+        db = _connect(self.prompts_path)
+        db.executescript(self.PROMPTS_SCHEMA)
+        try:
+            row = db.execute(
+                "SELECT text FROM prompts WHERE hash = ?", (digest,)
+            ).fetchone()
+        finally:
+            db.close()
+        return zlib.decompress(row[0]).decode("utf-8") if row else None
+
+    def close(self):
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+        self._thread = None
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+def test_usage_ledger(tmp_path):
+    ledger = UsageLedger(
+        tmp_path / "usage.sqlite",
+        prompts_path=tmp_path / "prompts.sqlite",
+        flush_every=3,
+        flush_seconds=0.05,
+    )
+    hour = 1_700_000_000 // BUCKET_SECONDS * BUCKET_SECONDS
+
+    for i in range(10):
+        ledger.record(
+            UsageRecord(
+                stage="03_valid_website" if i < 6 else "04_job_list",
+                caller="WebsiteClassification",
+                model="gpt-4o-mini",
+                prompt_tokens=1000,
+                completion_tokens=100,
+                cost=0.01,
+                latency=0.5,
+                system_msg="Classify this",
+                user_msg=f"# Page {i}",
+                ts=hour + i * 1000,
+            )
+        )
+
+    assert ledger.cost() == pytest.approx(0.1)
+    assert ledger.cost(stage="04_job_list") == pytest.approx(0.04)
+    # 0-3 are in the first hour, 4-7 in the second
+    assert ledger.cost(until=hour) == pytest.approx(0.04)
+    assert ledger.cost(since=hour + BUCKET_SECONDS) == pytest.approx(0.06)
+    assert ledger.summary()["03_valid_website"]["prompt_tokens"] == 6000
+    assert ledger.session["calls"] == 10
+
+    system_hash, user_hash = ledger.db.execute(
+        "SELECT system_hash, user_hash FROM calls ORDER BY ts LIMIT 1"
+    ).fetchone()
+    assert ledger.prompt(system_hash) == "Classify this"
+    assert ledger.prompt(user_hash) == "# Page 0"
+    # the shared system prompt is stored once
+    db = sqlite3.connect(tmp_path / "prompts.sqlite")
+    assert db.execute("SELECT COUNT(*) FROM prompts").fetchone()[0] == 11
+    db.close()
+
+    ledger.close()
+    assert UsageLedger(tmp_path / "usage.sqlite").cost() == pytest.approx(0.1)
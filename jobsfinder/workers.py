@@ -0,0 +1,127 @@
+"""
+Scrape with several processes, each with its own event loop and browser pool, so big
+crawls aren't stuck on one core. Results stream back to the caller (the single writer).
+"""
+
+import asyncio
+import multiprocessing as mp
+import os
+import queue
+import zlib
+
+from .core import CRAWL_SCHEDULER, close_clients, scrape_url
+from .scheduler import host_of
+
+WORKERS = os.cpu_count() or 1
+
+_DONE = None
+
+
+def shard_by_host(jobs: list[tuple], shards: int) -> list[list[tuple]]:
+    """
+    Split (key, url) jobs so that each host ends up in exactly one shard, which keeps the
+    per host limits of the crawl scheduler correct.
+    """
+    result = [[] for _ in range(shards)]
+    for key, url in jobs:
+        result[zlib.crc32(host_of(url).encode()) % shards].append((key, url))
+    return result
+
+
+def test_shard_by_host():
+    jobs = [(i, f"https://host{i % 5}.com/page{i}") for i in range(50)]
+    shards = shard_by_host(jobs, 3)
+
+    assert sorted(job for shard in shards for job in shard) == jobs
+    for shard in shards:
+        for other in shards:
+            if shard is not other:
+                assert not {host_of(u) for _, u in shard} & {
+                    host_of(u) for _, u in other
+                }
+
+
+async def _scrape_shard(shard, results, n, scrape_fn):
+    async def scrape(key, url):
+        results.put((key, await scrape_fn(url)))
+
+    try:
+        await CRAWL_SCHEDULER.run(
+            [(url, scrape(key, url)) for key, url in shard], n=n, show_progress=False
+        )
+    finally:
+        await close_clients()
+
+
+def _worker(shard, results, n, scrape_fn):
+    try:
+        asyncio.run(_scrape_shard(shard, results, n, scrape_fn))
+    finally:
+        results.put(_DONE)
+
+
+def scrape_in_workers(jobs: list[tuple], processes=WORKERS, n=10, scrape_fn=scrape_url):
+    """
+    Scrape (key, url) jobs in `processes` worker processes, with up to n pages in flight
+    in each. Yields (key, content) as they finish, in no particular order. content is
+    None when the scrape failed.
+
+    :param scrape_fn: Async url -> content, a module level function (the workers are
+        spawned, so it's pickled by name).
+    """
+    shards = [shard for shard in shard_by_host(list(jobs), processes) if shard]
+
+    # playwright doesn't survive a fork
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    procs = [
+        ctx.Process(target=_worker, args=(shard, results, n, scrape_fn), daemon=True)
+        for shard in shards
+    ]
+    for proc in procs:
+        proc.start()
+
+    remaining = len(procs)
+    try:
+        while remaining:
+            try:
+                item = results.get(timeout=1)
+            except queue.Empty:
+                if any(proc.is_alive() for proc in procs):
+                    continue
+                print(f"{remaining} worker(s) died before finishing their shard")
+                break
+
+            if item is _DONE:
+                remaining -= 1
+                continue
+            yield item
+    finally:
+        for proc in procs:
+            proc.join(timeout=10)
+            if proc.is_alive():
+                proc.terminate()
+
+
+async def _fake_scrape(url):
+    await asyncio.sleep(0.01)
+    if "broken" in url:
+        return None
+    return f"{url} by {os.getpid()}"
+
+
+def test_scrape_in_workers():
+    jobs = [(i, f"https://host{i % 3}.com/page{i}") for i in range(9)]
+    jobs.append((9, "https://broken.com/"))
+
+    results = dict(scrape_in_workers(jobs, processes=2, n=2, scrape_fn=_fake_scrape))
+
+    assert sorted(results) == list(range(10))
+    assert results[9] is None
+    pids = {}
+    for key, url in jobs[:9]:
+        content_url, pid = results[key].split(" by ")
+        assert content_url == url
+        # each host is scraped by one worker, none of them this process
+        assert pids.setdefault(host_of(url), pid) == pid
+        assert int(pid) != os.getpid()
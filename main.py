@@ -5,7 +5,7 @@ from pathlib import Path
 
 from fasthtml.common import *
 
-from jobsfinder.core import html2md, scrape_url
+from jobsfinder.core import close_clients, html2md_async, scrape_url
 from jobsfinder.gpts import has_sales_roles, jobs_status, prep_link
 
 
@@ -20,7 +20,8 @@ css = Script(src="https://cdn.tailwindcss.com")
 hdrs = (Script(src="https://unpkg.com/htmx-ext-sse@2.2.1/sse.js"), css)
 
 
-app = FastHTML(hdrs=hdrs, static_path="public")
+# the browsers, connections and html2md processes outlive the requests
+app = FastHTML(hdrs=hdrs, static_path="public", on_shutdown=[close_clients])
 
 count = 0
 
@@ -128,7 +129,7 @@ async def message_gen(url: str):
 
             try:
                 content = await scrape_url(_next_link)
-                md = html2md(content)
+                md = await html2md_async(content)
 
                 if not md:
                     yield sse_message(Article("Could not scrape the page :("))
@@ -1,9 +1,12 @@
+import argparse
 import asyncio
 import json
 
 import pandas as pd
+from tqdm import tqdm
 
-from jobsfinder.core import DATA_DIR, limit_parallel, scrape_url
+from jobsfinder.core import CRAWL_SCHEDULER, DATA_DIR, close_clients, scrape_url
+from jobsfinder.workers import scrape_in_workers
 
 SAVEFILE = DATA_DIR / "01_subset_enriched.csv"
 LIMITED_SAVEFILE = DATA_DIR / "01_subset_enriched_limited.csv"
@@ -58,6 +61,29 @@ def get_data():
     return df
 
 
+def _store_scrape(df, i, content):
+    if content is None:
+        df.loc[i, "scrape_status"] = "Failed"
+        return
+
+    df.loc[i, "scrape_status"] = "Success"
+    df.loc[i, "homepage_content"] = content
+
+
+def save_data(df):
+    df.to_csv(SAVEFILE, index=False)
+
+    print("Data saved.")
+
+    # Save git friendly version
+    df["homepage_content"] = df["homepage_content"].apply(
+        lambda x: str(x)[:100] if x is not None else None
+    )
+    df.to_csv(LIMITED_SAVEFILE, index=False)
+
+    print("Git friendly data saved.")
+
+
 async def enrich_homepage_scrapes():
     """
     Scrape homepages of companies
@@ -71,35 +97,60 @@ async def enrich_homepage_scrapes():
             return
 
         content = await scrape_url(url)
-
-        if content is None:
-            df.loc[i, "scrape_status"] = "Failed"
-            return
-
-        df.loc[i, "scrape_status"] = "Success"
-        df.loc[i, "homepage_content"] = content
+        _store_scrape(df, i, content)
 
         if i % 25 == 0:
             df.to_csv(SAVEFILE, index=False)
 
-    await limit_parallel(
-        [scrape_homepage(i, row["Website"]) for i, row in df.iterrows()], n=10
+    await CRAWL_SCHEDULER.run(
+        [
+            (row["Website"], scrape_homepage(i, row["Website"]))
+            for i, row in df.iterrows()
+        ],
+        n=10,
     )
+    await close_clients()
 
     print("Job finished.")
 
-    df.to_csv(SAVEFILE, index=False)
+    save_data(df)
 
-    print("Data saved.")
 
-    # Save git friendly version
-    df["homepage_content"] = df["homepage_content"].apply(
-        lambda x: str(x)[:100] if x is not None else None
-    )
-    df.to_csv(LIMITED_SAVEFILE, index=False)
+def enrich_homepage_scrapes_in_workers(workers):
+    """
+    Same, but the scraping is sharded over worker processes. This process only writes.
+    """
+    df = get_data()
 
-    print("Git friendly data saved.")
+    print("Data loaded")
+
+    jobs = [
+        (i, row["Website"])
+        for i, row in df.iterrows()
+        if row["scrape_status"] not in ["Failed", "Success"]
+    ]
+
+    for done, (i, content) in enumerate(
+        tqdm(scrape_in_workers(jobs, processes=workers), total=len(jobs))
+    ):
+        _store_scrape(df, i, content)
+
+        if done % 25 == 0:
+            df.to_csv(SAVEFILE, index=False)
+
+    print("Job finished.")
+
+    save_data(df)
 
 
 if __name__ == "__main__":
-    asyncio.run(enrich_homepage_scrapes())
+    parser = argparse.ArgumentParser(description="Scrape company homepages")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Number of scraping processes"
+    )
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        enrich_homepage_scrapes_in_workers(args.workers)
+    else:
+        asyncio.run(enrich_homepage_scrapes())
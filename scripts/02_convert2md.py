@@ -1,11 +1,14 @@
 import pandas as pd
 from tqdm import tqdm
 
-from jobsfinder.core import DATA_DIR, html2md
+from jobsfinder.core import DATA_DIR, close_md_pool, html2md_many
 
 INPUTFILE = DATA_DIR / "01_subset_enriched.csv"
 SAVEFILE = DATA_DIR / "02_adding_markdown.csv"
 
+# Rows sent to the html2md processes at once
+CHUNK_SIZE = 200
+
 
 def get_data():
     if SAVEFILE.exists():
@@ -24,24 +27,26 @@ def enrich_md():
 
     print("Data loaded")
 
-    for i, row in tqdm(df.iterrows()):
-        if row["scrape_status"] != "Success":
-            continue
+    todo = df[
+        (df.scrape_status == "Success") & ~df.md_status.isin(["Failed", "Success"])
+    ].index
 
-        if row["md_status"] in ["Failed", "Success"]:
-            continue
+    for start in tqdm(range(0, len(todo), CHUNK_SIZE)):
+        chunk = todo[start : start + CHUNK_SIZE]
+        mds = html2md_many(df.loc[chunk, "homepage_content"].tolist())
 
-        try:
-            md = html2md(row["homepage_content"]).strip()
+        for i, md in zip(chunk, mds):
+            md = md.strip() if md else md
 
             if not md or len(md) < 100:
-                raise Exception("No content")
+                print("No content")
+                df.loc[i, "md_status"] = "Failed"
+                continue
 
             df.loc[i, "md"] = md
             df.loc[i, "md_status"] = "Success"
-        except Exception as e:
-            print(e)
-            df.loc[i, "md_status"] = "Failed"
+
+    close_md_pool()
 
     print(f"converted to markdown, length: {len(df)}")
 
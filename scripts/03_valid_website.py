@@ -1,9 +1,11 @@
+import argparse
 import asyncio
 
 import pandas as pd
 
-from jobsfinder.core import DATA_DIR, limit_parallel
-from jobsfinder.gpts import valid_website
+from jobsfinder.batch import run_batch
+from jobsfinder.core import DATA_DIR, close_clients, limit_parallel
+from jobsfinder.gpts import NEAR_DUPS, valid_website, valid_website_prompt
 
 INPUTFILE = DATA_DIR / "02_adding_markdown.csv"
 SAVEFILE = DATA_DIR / "03_valid_website.csv"
@@ -20,27 +22,42 @@ def get_data():
     return df
 
 
-async def enrich_md():
+async def enrich_md(batch=False):
+    """
+    :param batch: Classify through the Batch API first, whatever it couldn't do is then
+        classified live.
+    """
     df = get_data()
 
     print("Data loaded")
 
+    batched = {}
+    if batch:
+        batched = await run_batch(
+            "03_valid_website",
+            {
+                str(i): valid_website_prompt(row["md"])
+                for i, row in df.iterrows()
+                if df.loc[i, "valid_website"] is None
+            },
+        )
+
     async def _is_valid(i, md):
         if df.loc[i, "valid_website"] is not None:
             return
 
-        result = await valid_website(md)
+        result = batched.get(str(i)) or await valid_website(md)
 
         df.loc[i, "valid_website"] = result.classification
 
         if i % 25 == 0:
             df.to_csv(SAVEFILE, index=False)
 
-    await limit_parallel(
-        [_is_valid(i, row["Website"]) for i, row in df.iterrows()], n=25
-    )
+    await limit_parallel([_is_valid(i, row["md"]) for i, row in df.iterrows()], n=25)
+    await close_clients()
 
     print("Job finished.")
+    print(f"Near duplicates: {NEAR_DUPS.stats()}")
 
     df.to_csv(SAVEFILE, index=False)
 
@@ -48,4 +65,10 @@ async def enrich_md():
 
 
 if __name__ == "__main__":
-    asyncio.run(enrich_md())
+    parser = argparse.ArgumentParser(description="Classify valid websites")
+    parser.add_argument(
+        "--batch", action="store_true", help="Use the Batch API (slower, cheaper)"
+    )
+    args = parser.parse_args()
+
+    asyncio.run(enrich_md(args.batch))
@@ -1,22 +1,36 @@
+import argparse
 import asyncio
 import json
 
 import pandas as pd
 
-from jobsfinder.core import DATA_DIR, limit_parallel
-from jobsfinder.gpts import follow_scrape
+from jobsfinder.batch import run_batch
+from jobsfinder.core import CRAWL_SCHEDULER, DATA_DIR, close_clients
+from jobsfinder.gpts import (
+    NEAR_DUPS,
+    follow_scrape,
+    homepage_prompt,
+    jobs_status_prompt,
+)
+from jobsfinder.prefetch import prefetch_stats
 
 INPUTFILE = DATA_DIR / "03_valid_website.csv"
+# --fused does the validity check of 03 in the same call, so it starts from 02
+FUSED_INPUTFILE = DATA_DIR / "02_adding_markdown.csv"
 SAVEFILE = DATA_DIR / "04_jobs.csv"
+# The homepage HTML the markdown was made from (02 drops it), for its structured job data
+HTML_INPUTFILE = DATA_DIR / "01_subset_enriched.csv"
 
 
-def get_data():
+def get_data(fused=False):
     if SAVEFILE.exists():
         print("There is already a save file, loading that")
         return pd.read_csv(SAVEFILE)
-    df = pd.read_csv(INPUTFILE)
+    df = pd.read_csv(FUSED_INPUTFILE if fused else INPUTFILE)
     assert len(df) == 2000
     assert all(df.md_status == "Success")
+    if fused:
+        df["valid_website"] = None
     df["history"] = None
     df["status"] = None
     df["error"] = None
@@ -24,11 +38,42 @@ def get_data():
     return df
 
 
-async def enrich_md():
-    df = get_data()
+def get_homepages() -> dict[str, str]:
+    if not HTML_INPUTFILE.exists():
+        print(f"{HTML_INPUTFILE} not found, no structured data from the homepages")
+        return {}
+    df = pd.read_csv(HTML_INPUTFILE, usecols=["Website", "homepage_content"])
+    df = df[df.homepage_content.notna()]
+    return dict(zip(df.Website, df.homepage_content))
+
+
+async def enrich_md(batch=False, fused=False, speculative=False):
+    """
+    :param batch: Get the homepage classifications through the Batch API first. Following
+        the links (scrape + classify) still happens live.
+    :param fused: Classify the homepages with homepage_status, which also fills in
+        valid_website.
+    :param speculative: Prefetch the likely careers links while pages are classified.
+    """
+    df = get_data(fused)
+    homepages = get_homepages()
+    prompt = homepage_prompt if fused else jobs_status_prompt
 
     print("Data loaded")
 
+    batched = {}
+    if batch:
+        batched = await run_batch(
+            "04_job_list_fused" if fused else "04_job_list",
+            {
+                str(i): prompt(row["md"])
+                for i, row in df.iterrows()
+                if pd.notna(row["md"])
+                and row["valid_website"] != "invalid"
+                and df.loc[i, "status"] is None
+            },
+        )
+
     async def _get_jobs(i, url, md, _valid):
         if _valid == "invalid":
             return
@@ -36,7 +81,17 @@ async def enrich_md():
         if df.loc[i, "status"] is not None:
             return
 
-        res = await follow_scrape(url, md)
+        res = await follow_scrape(
+            url,
+            md,
+            status=batched.get(str(i)),
+            fused=fused,
+            speculative=speculative,
+            html=homepages.get(url),
+        )
+
+        if fused:
+            df.loc[i, "valid_website"] = res.get("valid_website")
 
         df.loc[i, "history"] = json.dumps(res["history"])
         df.loc[i, "status"] = res["status"]
@@ -46,15 +101,22 @@ async def enrich_md():
         if i % 5 == 0:
             df.to_csv(SAVEFILE, index=False)
 
-    await limit_parallel(
+    await CRAWL_SCHEDULER.run(
         [
-            _get_jobs(i, row["Website"], row["md"], row["valid_website"])
+            (
+                row["Website"],
+                _get_jobs(i, row["Website"], row["md"], row["valid_website"]),
+            )
             for i, row in df.iterrows()
         ],
         n=25,
     )
+    await close_clients()
 
     print("Job finished.")
+    print(f"Near duplicates: {NEAR_DUPS.stats()}")
+    if speculative:
+        print(f"Prefetches: {dict(prefetch_stats)}")
 
     df.to_csv(SAVEFILE, index=False)
 
@@ -62,4 +124,20 @@ async def enrich_md():
 
 
 if __name__ == "__main__":
-    asyncio.run(enrich_md())
+    parser = argparse.ArgumentParser(description="Find the job lists of homepages")
+    parser.add_argument(
+        "--batch", action="store_true", help="Use the Batch API (slower, cheaper)"
+    )
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        help="Classify validity and job status in one call (no need to run 03)",
+    )
+    parser.add_argument(
+        "--speculative",
+        action="store_true",
+        help="Fetch the likely careers pages while the homepage is classified",
+    )
+    args = parser.parse_args()
+
+    asyncio.run(enrich_md(args.batch, args.fused, args.speculative))
@@ -1,30 +1,60 @@
+import argparse
 import asyncio
 
 import pandas as pd
 
-from jobsfinder.core import DATA_DIR, limit_parallel
-from jobsfinder.gpts import jobs_status
+from jobsfinder.batch import run_batch
+from jobsfinder.core import DATA_DIR, close_clients, limit_parallel
+from jobsfinder.gpts import (
+    NEAR_DUPS,
+    homepage_prompt,
+    homepage_status,
+    jobs_status,
+    jobs_status_prompt,
+)
 
 INPUTFILE = DATA_DIR / "03_valid_website.csv"
+# --fused does the validity check of 03 in the same call, so it starts from 02
+FUSED_INPUTFILE = DATA_DIR / "02_adding_markdown.csv"
 SAVEFILE = DATA_DIR / "04b_first_status.csv"
 
 
-def get_data():
+def get_data(fused=False):
     if SAVEFILE.exists():
         print("There is already a save file, loading that")
         return pd.read_csv(SAVEFILE)
-    df = pd.read_csv(INPUTFILE)
+    df = pd.read_csv(FUSED_INPUTFILE if fused else INPUTFILE)
     assert len(df) == 2000
     assert all(df.md_status == "Success")
+    if fused:
+        df["valid_website"] = None
     df["status"] = None
     return df
 
 
-async def enrich_md():
-    df = get_data()
+async def enrich_md(batch=False, fused=False):
+    """
+    :param batch: Classify through the Batch API first, whatever it couldn't do is then
+        classified live.
+    :param fused: Use homepage_status, which also fills in valid_website.
+    """
+    df = get_data(fused)
+    prompt = homepage_prompt if fused else jobs_status_prompt
+    classify = homepage_status if fused else jobs_status
 
     print("Data loaded")
 
+    batched = {}
+    if batch:
+        batched = await run_batch(
+            "04b_first_status_fused" if fused else "04b_first_status",
+            {
+                str(i): prompt(row["md"])
+                for i, row in df.iterrows()
+                if row["valid_website"] != "invalid" and df.loc[i, "status"] is None
+            },
+        )
+
     async def _get_jobs(i, url, md, _valid):
         if _valid == "invalid":
             return
@@ -32,8 +62,10 @@ async def enrich_md():
         if df.loc[i, "status"] is not None:
             return
 
-        status = await jobs_status(md)
+        status = batched.get(str(i)) or await classify(md)
 
+        if fused:
+            df.loc[i, "valid_website"] = status.validity
         df.loc[i, "status"] = status.classification
 
         if i % 5 == 0:
@@ -46,8 +78,10 @@ async def enrich_md():
         ],
         n=25,
     )
+    await close_clients()
 
     print("Job finished.")
+    print(f"Near duplicates: {NEAR_DUPS.stats()}")
 
     df.to_csv(SAVEFILE, index=False)
 
@@ -55,4 +89,15 @@ async def enrich_md():
 
 
 if __name__ == "__main__":
-    asyncio.run(enrich_md())
+    parser = argparse.ArgumentParser(description="Classify the job status of homepages")
+    parser.add_argument(
+        "--batch", action="store_true", help="Use the Batch API (slower, cheaper)"
+    )
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        help="Classify validity and job status in one call (no need to run 03)",
+    )
+    args = parser.parse_args()
+
+    asyncio.run(enrich_md(args.batch, args.fused))
@@ -0,0 +1,104 @@
+"""
+Compare the html2md engines (original html.parser + markdownify vs the single pass lxml
+one): speed, and how many pages come out different.
+
+Needs the full 01 stage output: the git friendly one has the HTML cut to 100 characters,
+which is no use for comparing the output of real pages (pass --truncated to run on it
+anyway, e.g. to try the script).
+"""
+
+import argparse
+import difflib
+import time
+
+import pandas as pd
+from tqdm import tqdm
+
+from jobsfinder.core import DATA_DIR, TEMP_DIR, html2md
+
+INPUTFILE = DATA_DIR / "01_subset_enriched.csv"
+TRUNCATED_INPUTFILE = DATA_DIR / "01_subset_enriched_limited.csv"
+SAVEFILE = TEMP_DIR / "bench_html2md.csv"
+
+
+def get_data(limit=None, truncated=False):
+    inputfile = TRUNCATED_INPUTFILE if truncated else INPUTFILE
+    if not inputfile.exists():
+        raise SystemExit(f"{inputfile} not found, run scripts/01_prep_data.py first")
+    print(f"Loading {inputfile}")
+    df = pd.read_csv(inputfile)
+    df = df[df.scrape_status == "Success"].reset_index(drop=True)
+    if limit:
+        df = df.head(limit)
+    return df
+
+
+def _timed(html, engine):
+    start = time.perf_counter()
+    md = html2md(html, engine=engine)
+    return md, time.perf_counter() - start
+
+
+def compare(limit=None, truncated=False):
+    df = get_data(limit, truncated)
+
+    rows = []
+    for i, row in tqdm(df.iterrows(), total=len(df)):
+        html = row["homepage_content"]
+        old, old_time = _timed(html, "html.parser")
+        new, new_time = _timed(html, "lxml")
+
+        old, new = (old or "").strip(), (new or "").strip()
+        same = old == new
+        rows.append(
+            {
+                "Website": row["Website"],
+                "html_length": len(html),
+                "old_time": old_time,
+                "new_time": new_time,
+                "same": same,
+                "similarity": (
+                    1.0 if same else difflib.SequenceMatcher(None, old, new).ratio()
+                ),
+                "old_length": len(old),
+                "new_length": len(new),
+            }
+        )
+
+    results = pd.DataFrame(rows)
+    results.to_csv(SAVEFILE, index=False)
+
+    print(f"\nPages: {len(results)}")
+    print(
+        f"html.parser: {results.old_time.sum():.2f}s, lxml: {results.new_time.sum():.2f}s, "
+        f"speedup: {results.old_time.sum() / results.new_time.sum():.2f}x"
+    )
+    print(
+        f"Identical output (ignoring surrounding whitespace): "
+        f"{results.same.sum()} / {len(results)}"
+    )
+
+    different = results[~results.same].sort_values("similarity")
+    if len(different):
+        print(
+            f"Mean similarity of the different ones: {different.similarity.mean():.3f}"
+        )
+        print("Least similar:")
+        print(different.head(10)[["Website", "similarity", "old_length", "new_length"]])
+
+    print(f"Per page results saved to {SAVEFILE}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare html2md engines")
+    parser.add_argument(
+        "--limit", type=int, default=None, help="Only the first N pages"
+    )
+    parser.add_argument(
+        "--truncated",
+        action="store_true",
+        help="Use the truncated git friendly data (not a real comparison)",
+    )
+    args = parser.parse_args()
+
+    compare(args.limit, args.truncated)
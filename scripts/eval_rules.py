@@ -0,0 +1,79 @@
+"""
+Coverage and precision of the invalid website rules (jobsfinder/rules.py).
+
+The rules were written and tuned on the testcases.py suites, so those numbers are only a
+sanity check. The held out numbers are the ones to go by: the pages of the stage outputs,
+which the rules were never tuned on. Their valid_website column was classified from the
+URL, so these pages are labelled again by GPT from the page (gpts.page_validity, cached).
+
+coverage: share of the invalid pages the rules catch (so the calls they save)
+precision: share of the pages the rules reject that really are invalid
+"""
+
+import asyncio
+
+import pandas as pd
+
+from jobsfinder import testcases
+from jobsfinder.core import DATA_DIR
+from jobsfinder.gpts import page_validity
+from jobsfinder.rules import invalid_reason
+
+HELD_OUT_FILES = [
+    DATA_DIR / "04b_first_status.csv",
+    DATA_DIR / "05_ft_validation.csv",
+]
+
+
+def evaluate(name, pages: list, labels: list):
+    reasons = [invalid_reason(md) if isinstance(md, str) else None for md in pages]
+    df = pd.DataFrame({"md": pages, "label": labels, "reason": reasons})
+    flagged = df[df.reason.notna()]
+    invalid = df[df.label == "invalid"]
+    caught = (flagged.label == "invalid").sum()
+
+    print(f"\n== {name}: {len(df)} pages, {len(invalid)} invalid")
+    print(
+        f"Coverage: {caught} / {len(invalid)}"
+        + (f" ({caught / len(invalid):.0%})" if len(invalid) else "")
+    )
+    print(
+        f"Precision: {caught} / {len(flagged)}"
+        + (f" ({caught / len(flagged):.0%})" if len(flagged) else "")
+    )
+    print(f"LLM calls saved: {len(flagged)} / {len(df)}")
+    if len(flagged):
+        print(flagged.reason.value_counts().to_string())
+
+    wrong = flagged[flagged.label != "invalid"]
+    if len(wrong):
+        print("Flagged, but labelled valid:")
+        for _, row in wrong.iterrows():
+            print(f"  [{row.reason}] {row.md.strip()[:100]!r}")
+
+
+def main():
+    evaluate(
+        "testcases.py (tuned on)",
+        testcases.websites_invalid + testcases.websites_valid,
+        ["invalid"] * len(testcases.websites_invalid)
+        + ["valid"] * len(testcases.websites_valid),
+    )
+
+    frames = []
+    for path in HELD_OUT_FILES:
+        if not path.exists():
+            print(f"\n{path} not found, skipping")
+            continue
+        frames.append(pd.read_csv(path)[["Website", "md"]])
+    if not frames:
+        return
+
+    df = pd.concat(frames).drop_duplicates("Website", keep="last")
+    pages = df[df.md.notna()].md.tolist()
+    print(f"\nLabelling {len(pages)} held out pages")
+    evaluate("held out", pages, asyncio.run(page_validity(pages)))
+
+
+if __name__ == "__main__":
+    main()
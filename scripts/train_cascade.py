@@ -0,0 +1,168 @@
+"""
+Train the local classifiers of the cascade (jobsfinder/cascade.py) on the GPT labels of the
+stage outputs, pick their confidence thresholds on held out pages, and report how many GPT
+calls they'd save on the testcases.py suites.
+"""
+
+import argparse
+import asyncio
+import typing
+
+import numpy as np
+import pandas as pd
+
+from jobsfinder import testcases
+from jobsfinder.cascade import (
+    MIN_ANSWERED,
+    MODEL_DIR,
+    TARGET_ACCURACY,
+    LinearClassifier,
+)
+from jobsfinder.core import DATA_DIR
+from jobsfinder.gpts import (
+    LOCAL_JOBS_ANSWERS,
+    JobsClassification,
+    WebsiteClassification,
+    page_validity,
+)
+
+# Not 03_valid_website.csv: its valid_website labels were classified from the URL instead
+# of the page. The later stages carry that column over, so the valid_website task is
+# labelled again from the pages (see "relabel").
+LABEL_FILES = [
+    DATA_DIR / "04b_first_status.csv",
+    DATA_DIR / "05_ft_validation.csv",
+]
+HOLDOUT = 0.2
+
+TASKS = {
+    "valid_website": {
+        "column": "valid_website",
+        "schema": WebsiteClassification,
+        "allowed": None,
+        "relabel": page_validity,
+        # suite: labels that count as correct
+        "suites": {
+            "websites_invalid": ["invalid"],
+            "websites_valid": ["valid"],
+        },
+    },
+    "jobs_status": {
+        "column": "status",
+        "schema": JobsClassification,
+        "allowed": LOCAL_JOBS_ANSWERS,
+        "relabel": None,
+        # same expectations as the tests in gpts.py
+        "suites": {
+            "jobs_list": ["Job list"],
+            "jobs_none": ["No jobs"],
+            "jobs_links": ["Link to jobs"],
+            "jobs_open_apply": ["No jobs", "Job open apply"],
+            "jobs_zero": ["No jobs", "Job open apply"],
+        },
+    },
+}
+
+
+def get_data(column, classes, relabel=None) -> pd.DataFrame:
+    """
+    :param relabel: Async pages -> labels, to label the pages again instead of using
+        `column`.
+    """
+    frames = []
+    for path in LABEL_FILES:
+        if not path.exists():
+            continue
+        df = pd.read_csv(path)
+        if column in df.columns and "md" in df.columns:
+            print(f"Loading {path}")
+            frames.append(df[["Website", "md", column]])
+
+    df = pd.concat(frames).drop_duplicates("Website", keep="last")
+    df = df[df.md.notna()].reset_index(drop=True)
+    if relabel is not None:
+        print(f"Labelling {len(df)} pages again")
+        df[column] = asyncio.run(relabel(df.md.tolist()))
+    df = df[df[column].isin(classes)]
+    return df.reset_index(drop=True)
+
+
+def print_curve(curve, threshold):
+    print(f"{'threshold':>10} {'coverage':>9} {'accuracy':>9}")
+    for step in np.linspace(0, len(curve) - 1, min(len(curve), 10)).astype(int):
+        t, coverage, accuracy = curve[step]
+        print(f"{t:>10.3f} {coverage:>9.1%} {accuracy:>9.1%}")
+    print(f"Chosen threshold: {threshold:.3f}")
+
+
+def report_suites(model, task) -> tuple[int, int]:
+    """
+    :return: (GPT calls saved, pages) over the suites
+    """
+    saved = total = 0
+    print(f"{'suite':>16} {'pages':>6} {'local':>6} {'correct':>8}")
+    for suite, expected in task["suites"].items():
+        cases = getattr(testcases, suite)
+        answers = [model.answer(case, allowed=task["allowed"]) for case in cases]
+        local = [a for a in answers if a is not None]
+        correct = sum(a in expected for a in local)
+        print(f"{suite:>16} {len(cases):>6} {len(local):>6} {correct:>8}")
+        saved += len(local)
+        total += len(cases)
+    return saved, total
+
+
+def train(target=TARGET_ACCURACY, min_answered=MIN_ANSWERED, seed=0):
+    for name, task in TASKS.items():
+        classes = list(
+            typing.get_args(task["schema"].model_fields["classification"].annotation)
+        )
+        df = get_data(task["column"], classes, task["relabel"])
+        print(f"\n== {name}: {len(df)} labelled pages")
+        print(df[task["column"]].value_counts().to_string())
+
+        order = np.random.default_rng(seed).permutation(len(df))
+        n_holdout = max(1, int(len(df) * HOLDOUT))
+        test, train_ = df.iloc[order[:n_holdout]], df.iloc[order[n_holdout:]]
+
+        model = LinearClassifier(classes)
+        model.fit(train_.md.tolist(), train_[task["column"]].tolist())
+        curve = model.calibrate(
+            test.md.tolist(),
+            test[task["column"]].tolist(),
+            target=target,
+            min_answered=min_answered,
+        )
+        print(f"\nHeld out ({len(test)} pages), target accuracy {target:.0%}:")
+        print_curve(curve, model.threshold)
+        if model.threshold >= 1.0:
+            print(
+                f"No threshold reaches the target on at least {min_answered} pages, "
+                "the model won't answer anything"
+            )
+
+        print("\ntestcases.py suites:")
+        saved, total = report_suites(model, task)
+        print(f"GPT calls saved: {saved} / {total} ({saved / total:.0%})")
+
+        model.save(MODEL_DIR / f"{name}.npz")
+        print(f"Saved to {MODEL_DIR / name}.npz")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the local classifier cascade")
+    parser.add_argument(
+        "--target",
+        type=float,
+        default=TARGET_ACCURACY,
+        help="Accuracy the local answers must have",
+    )
+    parser.add_argument(
+        "--min-answered",
+        type=int,
+        default=MIN_ANSWERED,
+        help="Held out pages a threshold has to answer to be trusted",
+    )
+    args = parser.parse_args()
+
+    train(args.target, args.min_answered)